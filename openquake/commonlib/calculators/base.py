@@ -28,11 +28,13 @@ from openquake.hazardlib.geo.mesh import Mesh
 from openquake.baselib import general
 from openquake.baselib.performance import DummyMonitor
 from openquake.commonlib import readinput, datastore, logictree, export
-from openquake.commonlib.parallel import apply_reduce
+from openquake.commonlib.parallel import (
+    cached, TaskManager, TracingMonitor, tracer)
 from openquake.risklib import riskinput
 
 get_taxonomy = operator.attrgetter('taxonomy')
 get_weight = operator.attrgetter('weight')
+split_riskinput = operator.methodcaller('split')
 get_trt = operator.attrgetter('trt_model_id')
 get_imt = operator.attrgetter('imt')
 
@@ -63,6 +65,7 @@ class BaseCalculator(object):
     taxonomies = datastore.persistent_attribute('/taxonomies')
     source_info = datastore.persistent_attribute('/source_info')
     performance = datastore.persistent_attribute('/performance')
+    performance_spans = datastore.persistent_attribute('/performance_spans')
 
     pre_calculator = None  # to be overridden
     is_stochastic = False  # True for scenario and event based calculators
@@ -86,6 +89,8 @@ class BaseCalculator(object):
         Run the calculation and return the exported outputs.
         """
         vars(self.oqparam).update(kw)
+        TaskManager.set_executor(self.oqparam.executor)
+        tracer.flush()  # discard the spans of previous calculations
         try:
             if pre_execute:
                 with self.monitor('pre_execute', autoflush=True):
@@ -107,6 +112,17 @@ class BaseCalculator(object):
         """
         raise NotImplementedError
 
+    def task_monitor(self, operation):
+        """
+        :param operation: the name of the operation performed by the tasks
+        :returns:
+            a :class:`openquake.commonlib.parallel.TracingMonitor` to be
+            passed to the tasks, with an attribute .oqparam
+        """
+        monitor = TracingMonitor(operation)
+        monitor.oqparam = self.oqparam
+        return monitor
+
     @abc.abstractmethod
     def pre_execute(self):
         """
@@ -154,10 +170,15 @@ class BaseCalculator(object):
     def clean_up(self):
         """
         Collect the monitoring information, then close the datastore.
+        The spans collected by the tasks, if any, are stored in bulk
+        in /performance_spans.
         """
         performance = self.monitor.collect_performance()
         if performance is not None:
             self.performance = performance
+        spans = tracer.flush()
+        if len(spans):
+            self.performance_spans = spans
         self.datastore.close()
 
 
@@ -414,16 +435,16 @@ class RiskCalculator(HazardCalculator):
         Require a `.core_func` to be defined with signature
         (riskinputs, riskmodel, rlzs_assoc, monitor).
         """
-        with self.monitor('execute risk', autoflush=True) as monitor:
-            monitor.oqparam = self.oqparam
-            if self.pre_calculator == 'event_based_rupture':
-                monitor.assets_by_site = self.assets_by_site
-                monitor.num_assets = self.count_assets()
-            res = apply_reduce(
-                self.core_func.__func__,
-                (self.riskinputs, self.riskmodel, self.rlzs_assoc, monitor),
+        monitor = self.task_monitor(self.core_func.__name__)
+        self.taskman = TaskManager(self.core_func.__func__)
+        with self.monitor('execute risk', autoflush=True):
+            res = self.taskman.apply(
+                (self.riskinputs, self.riskmodel,
+                 cached(self.rlzs_assoc), monitor),
                 concurrent_tasks=self.oqparam.concurrent_tasks,
-                weight=get_weight, key=self.riskinput_key)
+                weight=get_weight, key=self.riskinput_key,
+                split=(split_riskinput if self.oqparam.dynamic_scheduling
+                       else None))
         return res
 
 # functions useful for the calculators ScenarioDamage and ScenarioRisk
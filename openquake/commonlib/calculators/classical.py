@@ -29,7 +29,7 @@ from openquake.hazardlib.calc.hazard_curve import (
 from openquake.hazardlib.calc.filters import source_site_distance_filter, \
     rupture_site_distance_filter
 from openquake.risklib import scientific
-from openquake.commonlib import parallel, datastore
+from openquake.commonlib import parallel, datastore, costmodel, source
 from openquake.baselib.general import AccumDict, split_in_blocks, groupby
 
 from openquake.commonlib.calculators import base, calc
@@ -89,21 +89,61 @@ class ClassicalCalculator(base.HazardCalculator):
         parallelizing on the sources according to their weight and
         tectonic region type.
         """
-        monitor = self.monitor(self.core_func.__name__)
-        monitor.oqparam = self.oqparam
+        monitor = self.task_monitor(self.core_func.__name__)
         sources = self.composite_source_model.get_sources()
         zc = zero_curves(len(self.sitecol), self.oqparam.imtls)
         zerodict = AccumDict((key, zc) for key in self.rlzs_assoc)
         gsims_assoc = self.rlzs_assoc.get_gsims_by_trt_id()
-        curves_by_trt_gsim = parallel.apply_reduce(
-            self.core_func.__func__,
-            (sources, self.sitecol, gsims_assoc, monitor),
+        cost_model = self.get_cost_model()
+        asd = self.oqparam.area_source_discretization
+        split = (partial(source.split_and_weight,
+                         area_source_discretization=asd)
+                 if self.oqparam.dynamic_scheduling else None)
+        self.taskman = parallel.TaskManager(self.core_func.__func__)
+        curves_by_trt_gsim = self.taskman.apply(
+            (sources, parallel.cached(self.sitecol),
+             parallel.cached(gsims_assoc), monitor),
             agg=agg_dicts, acc=zerodict,
             concurrent_tasks=self.oqparam.concurrent_tasks,
-            weight=operator.attrgetter('weight'),
-            key=operator.attrgetter('trt_model_id'))
+            weight=cost_model,
+            key=operator.attrgetter('trt_model_id'),
+            split=split)
+        self.save_task_info(cost_model, self.taskman)
         return curves_by_trt_gsim
 
+    def get_cost_model(self):
+        """
+        :returns:
+            a CostModel for the sources, with coefficients fitted on
+            the task durations of the previous calculation of the same
+            job, if any
+        """
+        calc_id = getattr(self.datastore, 'calc_id', None)
+        coeffs = (costmodel.read_coeffs(
+            self.core_func.__name__, calc_id,
+            costmodel.job_fingerprint(self.oqparam)) if calc_id else {})
+        return costmodel.CostModel(
+            costmodel.source_kind, operator.attrgetter('weight'), coeffs)
+
+    def save_task_info(self, cost_model, taskman):
+        """
+        Store the predicted and actual durations of the tasks
+        in /task_info/<task name> and log a report.
+
+        :param cost_model: the CostModel used to split the sources
+        :param taskman: the TaskManager which run the tasks
+        """
+        task_info = cost_model.get_task_info(
+            taskman.chunks, taskman.durations)
+        if len(task_info):
+            key = '/task_info/' + self.core_func.__name__
+            self.datastore[key] = task_info
+            if getattr(self.datastore, 'calc_id', None):  # persistent
+                self.datastore[key].attrs['fingerprint'] = \
+                    costmodel.job_fingerprint(self.oqparam)
+            logging.info('Predicted vs actual task durations:\n%s',
+                         costmodel.report(task_info))
+
     def post_execute(self, curves_by_trt_gsim):
         """
         Collect the hazard curves by realization and export them.
@@ -114,34 +154,36 @@ class ClassicalCalculator(base.HazardCalculator):
         self.curves_by_trt_gsim = curves_by_trt_gsim
         oq = self.oqparam
         zc = zero_curves(len(self.sitecol), oq.imtls)
-        curves_by_rlz = self.rlzs_assoc.combine_curves(
-            curves_by_trt_gsim, agg_curves, zc)
         rlzs = self.rlzs_assoc.realizations
         nsites = len(self.sitecol)
-        if oq.individual_curves:
-            for rlz, curves in curves_by_rlz.iteritems():
-                self.store_curves('rlz-%d' % rlz.ordinal, curves)
-
-        if len(rlzs) == 1:  # cannot compute statistics
-            [self.mean_curves] = curves_by_rlz.values()
-            return
-
         weights = (None if oq.number_of_logic_tree_samples
                    else [rlz.weight for rlz in rlzs])
+        # the statistics are updated one realization at the time
+        stats = {imt: scientific.StreamingStats(
+            len(rlzs), (nsites, len(imls)), oq.quantile_hazard_curves,
+            weights, oq.quantile_sketch_bins)
+            for imt, imls in oq.imtls.iteritems()}
+        for i, (rlz, curves) in enumerate(self.rlzs_assoc.gen_curves_by_rlz(
+                curves_by_trt_gsim, agg_curves, zc)):
+            if oq.individual_curves:
+                self.store_curves('rlz-%d' % rlz.ordinal, curves)
+            if len(rlzs) == 1:  # cannot compute statistics
+                self.mean_curves = curves
+                return
+            for imt in oq.imtls:
+                stats[imt].add(i, curves[imt])
+
         mean = oq.mean_hazard_curves
         if mean:
             self.mean_curves = numpy.array(zc)
             for imt in oq.imtls:
-                self.mean_curves[imt] = scientific.mean_curve(
-                    [curves_by_rlz[rlz][imt] for rlz in rlzs], weights)
+                self.mean_curves[imt] = stats[imt].mean
 
         self.quantile = {}
         for q in oq.quantile_hazard_curves:
             self.quantile[q] = qc = numpy.array(zc)
             for imt in oq.imtls:
-                curves = [curves_by_rlz[rlz][imt] for rlz in rlzs]
-                qc[imt] = scientific.quantile_curve(
-                    curves, q, weights).reshape((nsites, -1))
+                qc[imt] = stats[imt].get_quantile(q)
 
         if mean:
             self.store_curves('mean', self.mean_curves)
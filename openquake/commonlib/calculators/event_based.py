@@ -281,13 +281,13 @@ class EventBasedRuptureCalculator(base.HazardCalculator):
         parallelizing on the sources according to their weight and
         tectonic region type.
         """
-        monitor = self.monitor(self.core_func.__name__)
-        monitor.oqparam = self.oqparam
+        monitor = self.task_monitor(self.core_func.__name__)
         csm = self.composite_source_model
         sources = csm.get_sources()
         ruptures_by_trt = parallel.apply_reduce(
             self.core_func.__func__,
-            (sources, self.sitecol, csm.info, monitor),
+            (sources, parallel.cached(self.sitecol),
+             parallel.cached(csm.info), monitor),
             concurrent_tasks=self.oqparam.concurrent_tasks,
             weight=operator.attrgetter('weight'),
             key=operator.attrgetter('trt_model_id'))
@@ -455,14 +455,14 @@ class EventBasedCalculator(ClassicalCalculator):
         oq = self.oqparam
         if not oq.hazard_curves_from_gmfs and not oq.ground_motion_fields:
             return
-        monitor = self.monitor(self.core_func.__name__)
-        monitor.oqparam = oq
+        monitor = self.task_monitor(self.core_func.__name__)
         zc = zero_curves(len(self.sitecol), self.oqparam.imtls)
         zerodict = AccumDict((key, zc) for key in self.rlzs_assoc)
         self.gmf_dict = collections.defaultdict(AccumDict)
         curves_by_trt_gsim = parallel.apply_reduce(
             self.core_func.__func__,
-            (self.sesruptures, self.sitecol, self.rlzs_assoc, monitor),
+            (self.sesruptures, parallel.cached(self.sitecol),
+             parallel.cached(self.rlzs_assoc), monitor),
             concurrent_tasks=self.oqparam.concurrent_tasks,
             acc=zerodict, agg=self.combine_curves_and_save_gmfs,
             key=operator.attrgetter('col_id'))
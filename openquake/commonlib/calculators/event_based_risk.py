@@ -17,16 +17,190 @@
 #  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-import operator
 import functools
-import collections
 
 import numpy
 
-from openquake.baselib.general import AccumDict, groupby
+from openquake.baselib.general import AccumDict
 from openquake.commonlib.calculators import base
 from openquake.commonlib import readinput, parallel, datastore
-from openquake.risklib import riskinput, scientific
+from openquake.risklib import riskinput, scientific, workflows
+
+
+U8 = numpy.uint8
+U16 = numpy.uint16
+U32 = numpy.uint32
+F64 = numpy.float64
+
+# losses per asset and rupture
+elt_dt = numpy.dtype([('rlz', U16), ('loss_type', U8), ('rup', U32),
+                      ('ass', U32), ('loss', F64), ('ins_loss', F64)])
+
+# losses aggregated on the assets, with the number of nonzero losses
+agg_elt_dt = numpy.dtype([('rlz', U16), ('loss_type', U8), ('rup', U32),
+                          ('loss', F64), ('ins_loss', F64),
+                          ('nonzero', U32), ('total', U32)])
+
+# the same records, as stored in the datastore for each rlz and loss type
+ass_loss_dt = numpy.dtype([(name, elt_dt.fields[name][0])
+                           for name in elt_dt.names[2:]])
+rup_loss_dt = numpy.dtype([(name, agg_elt_dt.fields[name][0])
+                           for name in agg_elt_dt.names[2:]])
+
+
+def split_by_rlz_lt(array, dtype):
+    """
+    Split an array of event losses by realization and loss type.
+
+    :param array: an array of dtype elt_dt or agg_elt_dt
+    :param dtype: the dtype of the output arrays, without rlz and loss_type
+    :returns: a list of triples (rlz ordinal, loss type index, array)
+    """
+    keys = array['rlz'].astype(numpy.int64) * 256 + array['loss_type']
+    triples = []
+    for key in numpy.unique(keys):
+        selected = array[keys == key]
+        data = numpy.zeros(len(selected), dtype)
+        for name in dtype.names:
+            data[name] = selected[name]
+        triples.append((key // 256, key % 256, data))
+    return triples
+
+
+def _gen_chunks(dset, size):
+    # yield slices of the given dataset containing at most size elements
+    for start in xrange(0, len(dset), size):
+        yield dset[start:start + size]
+
+
+class EventLossTable(object):
+    """
+    A columnar container for the event losses computed by the
+    event_based_risk tasks. The losses are stored in arrays; the
+    rupture ordinals and the asset ordinals refer to the complete list
+    of ruptures sorted by tag and to the assets sorted by asset_id
+    respectively. Event loss tables are merged by concatenation; the
+    exceedance counts (if any) are kept only for the assets seen by
+    the task, as pairs (ordinals, counts), and can be summed per asset
+    with the method `compact_counts`:
+
+    >>> elt = EventLossTable() + EventLossTable()
+    >>> len(elt.assets), len(elt.agg), len(elt.counts)
+    (0, 0, 0)
+    >>> elt1 = EventLossTable()
+    >>> elt1.add_counts((0, 0, 'loss'), [0, 2], numpy.array([[2, 1], [1, 0]]))
+    >>> elt2 = EventLossTable()
+    >>> elt2.add_counts((0, 0, 'loss'), [2], numpy.array([[3, 1]]))
+    >>> elt = elt1 + elt2
+    >>> elt.compact_counts()
+    >>> [(ordinals, counts)] = elt.counts[0, 0, 'loss']
+    >>> print(ordinals)
+    [0 2]
+    >>> print(counts)
+    [[2 1]
+     [4 1]]
+    """
+    def __init__(self, asset_chunks=(), agg_chunks=(), counts=()):
+        self.asset_chunks = list(asset_chunks)
+        self.agg_chunks = list(agg_chunks)
+        # (rlz, loss_type, field) -> list of pairs (ordinals, counts)
+        self.counts = AccumDict(counts)
+
+    def append(self, rlz, loss_type, out, specific):
+        """
+        Add the losses contained in an output of the ProbabilisticEventBased
+        workflow.
+
+        :param rlz: the realization ordinal
+        :param loss_type: the loss type index
+        :param out: an Output with fields assets (an AssetCollection),
+                    event_loss_per_asset, insured_loss_per_asset and eids,
+                    and possibly counts_matrix and insured_counts_matrix
+        :param specific: a set of asset IDs for which to store the losses
+        """
+        for field, counts in [
+                ('loss', getattr(out, 'counts_matrix', None)),
+                ('ins_loss', getattr(out, 'insured_counts_matrix', None))]:
+            if counts is not None:
+                self.add_counts((rlz, loss_type, field),
+                                out.assets.ordinals, counts)
+
+        losses = out.event_loss_per_asset  # shape (R, N)
+        ins_losses = out.insured_loss_per_asset  # shape (R, N)
+        R, N = losses.shape
+
+        agg = numpy.zeros(R, agg_elt_dt)
+        agg['rlz'] = rlz
+        agg['loss_type'] = loss_type
+        agg['rup'] = out.eids
+        agg['loss'] = losses.sum(axis=1)
+        agg['ins_loss'] = ins_losses.sum(axis=1)
+        agg['nonzero'] = (losses != 0).sum(axis=1)
+        agg['total'] = N
+        self.agg_chunks.append(agg)
+
+        ok = numpy.in1d(out.assets.ids, list(specific))
+        if not ok.any():
+            return
+        ordinals = out.assets.ordinals[ok]
+        losses = losses[:, ok]
+        rups, asss = losses.nonzero()
+        data = numpy.zeros(len(rups), elt_dt)
+        data['rlz'] = rlz
+        data['loss_type'] = loss_type
+        data['rup'] = out.eids[rups]
+        data['ass'] = ordinals[asss]
+        data['loss'] = losses[rups, asss]
+        data['ins_loss'] = ins_losses[:, ok][rups, asss]
+        self.asset_chunks.append(data)
+
+    def add_counts(self, key, ordinals, counts):
+        """
+        Add exceedance counts to the counts of the given assets.
+
+        :param key: a triple (rlz, loss_type, field)
+        :param ordinals: the ordinals of N' distinct assets
+        :param counts: an array of exceedance counts of shape (N', C)
+        """
+        self.counts += {key: [(numpy.array(ordinals, U32),
+                               counts.astype(U32))]}
+
+    def compact_counts(self):
+        """
+        Sum the exceedance counts of the same asset, so that there is
+        a single pair (ordinals, counts) per key, with distinct ordinals.
+        """
+        for key, pairs in self.counts.items():
+            if len(pairs) > 1:
+                ordinals = numpy.concatenate([o for o, c in pairs])
+                counts = numpy.concatenate([c for o, c in pairs])
+                uniq, inv = numpy.unique(ordinals, return_inverse=True)
+                summed = numpy.zeros((len(uniq), counts.shape[1]), U32)
+                numpy.add.at(summed, inv, counts)
+                self.counts[key] = [(uniq, summed)]
+
+    @property
+    def assets(self):
+        """
+        :returns: an array of dtype elt_dt with the losses per asset
+        """
+        if not self.asset_chunks:
+            return numpy.zeros(0, elt_dt)
+        return numpy.concatenate(self.asset_chunks)
+
+    @property
+    def agg(self):
+        """
+        :returns: an array of dtype agg_elt_dt with the aggregate losses
+        """
+        if not self.agg_chunks:
+            return numpy.zeros(0, agg_elt_dt)
+        return numpy.concatenate(self.agg_chunks)
+
+    def __add__(self, other):
+        return self.__class__(self.asset_chunks + other.asset_chunks,
+                              self.agg_chunks + other.agg_chunks,
+                              self.counts + other.counts)
 
 
 @parallel.litetask
@@ -41,43 +215,19 @@ def event_based_risk(riskinputs, riskmodel, rlzs_assoc, monitor):
     :param monitor:
         :class:`openquake.commonlib.parallel.PerformanceMonitor` instance
     :returns:
-        a dictionary rlz.ordinal -> (loss_type, tag) -> AccumDict()
+        an :class:`EventLossTable` instance
     """
     specific = set(monitor.oqparam.specific_assets)
     if monitor.num_assets <= 10:  # hack
-        specific = set(a.id for assets in monitor.assets_by_site
-                       for a in assets)
-    acc = AccumDict({rlz.ordinal: AccumDict()
-                     for rlz in rlzs_assoc.realizations})
-    # rlz.ordinal -> (loss_type, tag) -> AccumDict
+        specific = set(monitor.assetcol.ids)
+    lti = {lt: i for i, lt in enumerate(riskmodel.get_loss_types())}
+    elt = EventLossTable()
     for out_by_rlz in riskmodel.gen_outputs(riskinputs, rlzs_assoc, monitor):
         for out in out_by_rlz:
-            acc_rlz = acc[out.hid]
-            acc_rlz[out.loss_type, 'counts_matrix'] = AccumDict(
-                zip(out.assets, out.counts_matrix))
-            for tag, losses, ins_losses in zip(
-                    out.tags, out.event_loss_per_asset,
-                    out.insured_loss_per_asset):
-                data = [(asset.id, loss, ins_loss)
-                        for asset, loss, ins_loss in zip(
-                            out.assets, losses, ins_losses)
-                        if loss and asset.id in specific]
-                ad = AccumDict(
-                    data=data, loss=sum(losses), ins_loss=sum(ins_losses),
-                    nonzero=sum(1 for loss in losses if loss),
-                    total=len(losses))
-                # TODO: the names of the variables here are really bad:
-                # things like (acc_rlz, ad, a) for the inner dictionaries.
-                # The solution will be to refactor the input/output
-                # and use more arrays instead than a dictionary of dictionaries
-                # of dictionaries (bleah!)
-                try:
-                    a = acc_rlz[out.loss_type, tag]
-                except KeyError:
-                    acc_rlz[out.loss_type, tag] = ad
-                else:
-                    a += ad
-    return acc
+            elt.append(out.hid, lti[out.loss_type], out, specific)
+    # send back only the counts of the assets seen by the task
+    elt.compact_counts()
+    return elt
 
 
 def _mean_quantiles(quantiles):
@@ -111,6 +261,58 @@ def extract_avglosses(dstore, pattern):
     return data
 
 
+def build_stats(dstore, loss_curve_key, block, rlzs, loss_types, builder):
+    """
+    Compute the statistics of the stored loss curves of a block of assets.
+    Yield a statistical output object for each loss type.
+
+    :param dstore: a datastore (or an open HDF5 file)
+    :param loss_curve_key: the key of the loss curves in the datastore
+    :param block: a slice of assets; only their curves are read
+    :param rlzs: the realizations
+    :param loss_types: the loss types
+    :param builder: a :class:`openquake.risklib.scientific.StatsBuilder`
+    """
+    for loss_type in loss_types:
+        outputs = []
+        for rlz in rlzs:
+            key = '%s-rlzs/%s' % (loss_curve_key, rlz.uid)
+            lcs = dstore[key][block][loss_type]
+            losses_poes = numpy.array(  # -> shape (N, 2, C)
+                [lcs['losses'], lcs['poes']]).transpose(1, 0, 2)
+            out = scientific.Output(
+                [None] * len(lcs), loss_type, rlz.ordinal, rlz.weight,
+                loss_curves=losses_poes, insured_curves=None)
+            outputs.append(out)
+        yield builder.build(outputs)
+
+
+@parallel.litetask
+def compute_stats(blocks, hdf5path, loss_curve_key, rlzs, loss_types,
+                  builder, monitor):
+    """
+    :param blocks: a list of pairs (start, stop) of asset indices
+    :param hdf5path: the path of the HDF5 file of the datastore
+    :param loss_curve_key: the key of the loss curves in the datastore
+    :param rlzs: the realizations
+    :param loss_types: the loss types
+    :param builder: a :class:`openquake.risklib.scientific.StatsBuilder`
+    :param monitor: a :class:`openquake.commonlib.parallel.TracingMonitor`
+    :returns:
+        a dictionary (start, stop) -> list of tuples (loss_type, curves,
+        insured curves, maps), one for each loss type
+    """
+    acc = AccumDict()
+    with datastore.h5py.File(hdf5path, 'r') as h5:
+        for start, stop in blocks:
+            acc[start, stop] = [
+                (stat.loss_type,) + scientific.get_stat_curves(stat)
+                for stat in build_stats(h5, loss_curve_key,
+                                        slice(start, stop), rlzs,
+                                        loss_types, builder)]
+    return acc
+
+
 @base.calculators.add('event_based_risk')
 class EventBasedRiskCalculator(base.RiskCalculator):
     """
@@ -118,10 +320,13 @@ class EventBasedRiskCalculator(base.RiskCalculator):
     """
     pre_calculator = 'event_based_rupture'
     core_func = event_based_risk
+    assets_per_block = 10000  # used in the computation of the statistics
+    epsilon_store_size = 1024 ** 3  # maximum size in bytes of the store
 
     event_loss_asset = datastore.persistent_attribute('event_loss_asset')
     event_loss = datastore.persistent_attribute('event_loss')
     is_stochastic = True
+    chunksize = 1000000  # number of losses read at once from the datastore
 
     def riskinput_key(self, ri):
         """
@@ -144,22 +349,106 @@ class EventBasedRiskCalculator(base.RiskCalculator):
         correl_model = readinput.get_correl_model(oq)
         gsims_by_col = self.rlzs_assoc.get_gsims_by_col()
         assets_by_site = self.assets_by_site
-        logging.info('Building the epsilons')
+        self.assets = riskinput.sorted_assets(assets_by_site)
+        for ordinal, asset in enumerate(self.assets):
+            asset.ordinal = ordinal
+        self.assetcol = workflows.AssetCollection.from_assets(assets_by_site)
 
         logging.info('Populating the risk inputs')
         rup_by_tag = sum(self.datastore['sescollection'], AccumDict())
-        all_ruptures = [rup_by_tag[tag] for tag in sorted(rup_by_tag)]
+        self.tags = sorted(rup_by_tag)
+        all_ruptures = [rup_by_tag[tag] for tag in self.tags]
         num_samples = min(len(all_ruptures), epsilon_sampling)
-        eps_dict = riskinput.make_eps_dict(
-            assets_by_site, num_samples, oq.master_seed, oq.asset_correlation)
-        logging.info('Generated %d epsilons', num_samples * len(eps_dict))
+        epsilon_provider = scientific.CounterEpsilonProvider(
+            oq.master_seed, oq.asset_correlation or 0, num_samples)
+        # by default the tasks generate the epsilons they need; if the
+        # events are more than the samples the same epsilons would be
+        # generated many times, so they are generated once and shared
+        # with the tasks, if the store is not too big
+        self.epsilon_store = None
+        if oq.epsilon_generator == 'numpy':
+            # the epsilons generated on the master with the global numpy
+            # RNG, as before the counter-based generator; the event of
+            # ordinal E gets the epsilons of the sample E % num_samples
+            eps_dict = riskinput.make_eps_dict(
+                assets_by_site, num_samples, oq.master_seed,
+                oq.asset_correlation)
+            self.epsilon_store = scientific.EpsilonStore(
+                numpy.array([eps_dict[aid] for aid in self.assetcol.ids]))
+        elif (num_samples < len(all_ruptures) and len(self.assetcol) *
+                num_samples * 8 <= self.epsilon_store_size):
+            logging.info('Building %s epsilons',
+                         (len(self.assetcol), num_samples))
+            self.epsilon_store = scientific.EpsilonStore.build(
+                epsilon_provider, self.assetcol.ordinals, num_samples,
+                self.assetcol.taxonomy_indices)
 
         self.riskinputs = list(self.riskmodel.build_inputs_from_ruptures(
             self.sitecol.complete, all_ruptures, gsims_by_col,
-            oq.truncation_level, correl_model, eps_dict,
+            oq.truncation_level, correl_model, epsilon_provider,
             oq.concurrent_tasks or 1))
         logging.info('Built %d risk inputs', len(self.riskinputs))
 
+    def execute(self):
+        """
+        Run the event_based_risk tasks and store their event loss tables
+        in the datastore as soon as they arrive.
+
+        :returns: the number of stored losses per asset
+        """
+        monitor = self.task_monitor(self.core_func.__name__)
+        monitor.assetcol = self.assetcol
+        # the big arrays in the monitor are shared with the tasks
+        # via memory-mapped files (see parallel.SharedArrays)
+        monitor.epsilon_store = self.epsilon_store
+        monitor.num_assets = self.count_assets()
+        self.counts = {}  # exceedance counts of shape (N, C)
+        self.taskman = parallel.TaskManager(self.core_func.__func__)
+        with self.monitor('execute risk', autoflush=True):
+            res = self.taskman.apply(
+                (self.riskinputs, parallel.cached(self.riskmodel),
+                 parallel.cached(self.rlzs_assoc), monitor),
+                agg=self.save_event_loss_table, acc=0,
+                concurrent_tasks=self.oqparam.concurrent_tasks,
+                weight=base.get_weight, key=self.riskinput_key,
+                split=(base.split_riskinput
+                       if self.oqparam.dynamic_scheduling else None))
+        rlzs = self.rlzs_assoc.realizations
+        loss_types = self.riskmodel.get_loss_types()
+        for (rlz, lt, field), counts in self.counts.iteritems():
+            self.datastore['/loss_counts-rlzs/%s/%s/%s' % (
+                rlzs[rlz].uid, loss_types[lt], field)] = counts
+        self.datastore.hdf5.flush()
+        return res
+
+    def save_event_loss_table(self, acc, elt):
+        """
+        Append the losses of an event loss table to the extendable
+        datasets /event_loss_table-rlzs/<uid>/<loss_type> and
+        /agg_loss_table-rlzs/<uid>/<loss_type> and add its exceedance
+        counts (if any) to the counts of all the assets received so far.
+
+        :param acc: the number of losses per asset stored so far
+        :param elt: an :class:`EventLossTable` instance
+        :returns: the updated number of stored losses per asset
+        """
+        rlzs = self.rlzs_assoc.realizations
+        loss_types = self.riskmodel.get_loss_types()
+        for key, pairs in elt.counts.iteritems():
+            for ordinals, counts in pairs:
+                if key not in self.counts:
+                    self.counts[key] = numpy.zeros(
+                        (len(self.assetcol), counts.shape[1]), U32)
+                self.counts[key][ordinals] += counts
+        assets = elt.assets
+        for rlz, lt, data in split_by_rlz_lt(assets, ass_loss_dt):
+            self.datastore.extend('/event_loss_table-rlzs/%s/%s' % (
+                rlzs[rlz].uid, loss_types[lt]), data)
+        for rlz, lt, data in split_by_rlz_lt(elt.agg, rup_loss_dt):
+            self.datastore.extend('/agg_loss_table-rlzs/%s/%s' % (
+                rlzs[rlz].uid, loss_types[lt]), data)
+        return acc + len(assets)
+
     def zeros(self, shape, dtype):
         """
         Build a composite dtype from the given loss_types and dtype and
@@ -171,9 +460,11 @@ class EventBasedRiskCalculator(base.RiskCalculator):
 
     def post_execute(self, result):
         """
-        Extract from the result dictionary
-        rlz.ordinal -> (loss_type, tag) -> [(asset.id, loss), ...]
-        several interesting outputs.
+        Extract from the event loss tables stored in the datastore
+        several interesting outputs. The tables are read in chunks, so
+        that the memory occupation does not depend on their size.
+
+        :param result: the number of stored losses per asset
         """
         oq = self.oqparam
         # take the cached self.rlzs_assoc and write it on the datastore
@@ -189,13 +480,15 @@ class EventBasedRiskCalculator(base.RiskCalculator):
             lm_names = _loss_map_names(oq.conditional_loss_poes)
             self.loss_map_dt = numpy.dtype([(f, float) for f in lm_names])
 
-        self.assets = assets = riskinput.sorted_assets(self.assets_by_site)
-
+        assets = self.assets
         self.specific_assets = specific_assets = [
             a for a in assets if a.id in self.oqparam.specific_assets]
         specific_asset_refs = set(self.oqparam.specific_assets)
+        is_specific = numpy.array(
+            [a.id in specific_asset_refs for a in assets], bool)
 
         N = len(assets)
+        R = len(self.tags)
 
         event_loss_asset = [{} for rlz in rlzs]
         event_loss = [{} for rlz in rlzs]
@@ -204,78 +497,88 @@ class EventBasedRiskCalculator(base.RiskCalculator):
         ins_curves = self.zeros(N, self.loss_curve_dt)
         if oq.conditional_loss_poes:
             loss_maps = self.zeros(N, self.loss_map_dt)
-        agg_loss_curve = self.zeros(1, self.loss_curve_dt)
-
-        for i in sorted(result):
-            rlz = rlzs[i]
 
-            data_by_lt_tag = result[i]
-            # (loss_type, asset_id) -> [(tag, loss, ins_loss), ...]
-            elass = {(loss_type, asset.id): [] for asset in assets
-                     for loss_type in loss_types}
-            elagg = []  # aggregate event loss
+        no_asset_losses = numpy.zeros(0, ass_loss_dt)
+        no_rup_losses = numpy.zeros(0, rup_loss_dt)
+        for i, rlz in enumerate(rlzs):
             nonzero = total = 0
-            for loss_type, tag in data_by_lt_tag:
-                d = data_by_lt_tag[loss_type, tag]
-                if tag == 'counts_matrix':
-                    # the counts_matrix management is left for the future
+            has_agg = False
+            # reallocated for each realization, since the loss types
+            # without aggregate losses are skipped
+            agg_loss_curve = self.zeros(1, self.loss_curve_dt)
+            for loss_type in loss_types:
+                dset = self.datastore.get('/event_loss_table-rlzs/%s/%s' % (
+                    rlz.uid, loss_type), no_asset_losses)
+                if len(dset):
+                    rows = []
+                    for data in _gen_chunks(dset, self.chunksize):
+                        rows.extend(
+                            (self.tags[rup], assets[ass].id, loss, ins_loss)
+                            for rup, ass, loss, ins_loss in data
+                            if is_specific[ass])
+                    event_loss_asset[i][loss_type] = sorted(rows)
+
+                # build the loss curves per asset
+                if oq.loss_curves_from_counts:
+                    lc = self.build_loss_curves_from_counts(
+                        rlz, loss_type, 'loss')
+                else:
+                    lc = self.build_loss_curves(dset, 'loss')
+                loss_curves[loss_type] = lc
+
+                if oq.insured_losses:
+                    # build the insured loss curves per asset
+                    if oq.loss_curves_from_counts:
+                        ic = self.build_loss_curves_from_counts(
+                            rlz, loss_type, 'ins_loss')
+                    else:
+                        ic = self.build_loss_curves(dset, 'ins_loss')
+                    ins_curves[loss_type] = ic
+
+                if oq.conditional_loss_poes:
+                    # build the loss maps per asset, array of shape (N, P)
+                    losses_poes = numpy.array(  # shape (N, 2, C)
+                        [lc['losses'], lc['poes']]).transpose(1, 0, 2)
+                    lmaps = scientific.loss_map_matrix(
+                        oq.conditional_loss_poes, losses_poes)  # (P, N)
+                    for lm, lmap in zip(lm_names, lmaps):
+                        loss_maps[loss_type][lm] = lmap
+
+                dset = self.datastore.get('/agg_loss_table-rlzs/%s/%s' % (
+                    rlz.uid, loss_type), no_rup_losses)
+                if not len(dset):
                     continue
-
-                for aid, loss, ins_loss in d['data']:
-                    elass[loss_type, aid].append((tag, loss, ins_loss))
-
-                # aggregates
-                elagg.append((loss_type, tag, d['loss'], d['ins_loss']))
-                nonzero += d['nonzero']
-                total += d['total']
+                # sum the contributions of the different tasks
+                losses = numpy.zeros(R)
+                ins_losses = numpy.zeros(R)
+                seen = numpy.zeros(R, bool)
+                for data in _gen_chunks(dset, self.chunksize):
+                    losses += numpy.bincount(
+                        data['rup'], data['loss'], minlength=R)
+                    ins_losses += numpy.bincount(
+                        data['rup'], data['ins_loss'], minlength=R)
+                    seen[data['rup']] = True
+                    nonzero += data['nonzero'].sum()
+                    total += data['total'].sum()
+                rups, = seen.nonzero()
+                event_loss[i][loss_type] = [
+                    (self.tags[rup], losses[rup], ins_losses[rup])
+                    for rup in rups]
+                # aggregate loss curve for all tags
+                losses, poes, avg, _ = self.build_agg_loss_curve_and_map(
+                    losses[rups])
+                # NB: there is no aggregate insured loss curve
+                agg_loss_curve[loss_type][0] = (losses, poes, avg)
+                # NB: the aggregated loss_map is not stored
+                has_agg = True
             logging.info('rlz=%d: %d/%d nonzero losses', i, nonzero, total)
 
-            if elass:
-                data_by_lt = collections.defaultdict(list)
-                for (loss_type, asset_id), rows in elass.iteritems():
-                    for tag, loss, ins_loss in rows:
-                        data_by_lt[loss_type].append(
-                            (tag, asset_id, loss, ins_loss))
-                for loss_type, data in data_by_lt.iteritems():
-                    event_loss_asset[i][loss_type] = sorted(
-                        # data contains rows (tag, asset, loss, ins_loss)
-                        (t, a, l, i) for t, a, l, i in data
-                        if a in specific_asset_refs)
-
-                    # build the loss curves per asset
-                    lc = self.build_loss_curves(elass, loss_type, 1)
-                    loss_curves[loss_type] = lc
-
-                    if oq.insured_losses:
-                        # build the insured loss curves per asset
-                        ic = self.build_loss_curves(elass, loss_type, 2)
-                        ins_curves[loss_type] = ic
-
-                    if oq.conditional_loss_poes:
-                        # build the loss maps per asset, array of shape (N, P)
-                        losses_poes = numpy.array(  # shape (N, 2, C)
-                            [lc['losses'], lc['poes']]).transpose(1, 0, 2)
-                        lmaps = scientific.loss_map_matrix(
-                            oq.conditional_loss_poes, losses_poes)  # (P, N)
-                        for lm, lmap in zip(lm_names, lmaps):
-                            loss_maps[loss_type][lm] = lmap
-
             self.store('/loss_curves', rlz, loss_curves)
             if oq.insured_losses:
                 self.store('/ins_curves', rlz, ins_curves)
             if oq.conditional_loss_poes:
                 self.store('/loss_maps', rlz, loss_maps)
-
-            if elagg:
-                for loss_type, rows in groupby(
-                        elagg, operator.itemgetter(0)).iteritems():
-                    event_loss[i][loss_type] = [row[1:] for row in rows]
-                    # aggregate loss curve for all tags
-                    losses, poes, avg, _ = self.build_agg_loss_curve_and_map(
-                        [loss for _lt, _tag, loss, _ins_loss in rows])
-                    # NB: there is no aggregate insured loss curve
-                    agg_loss_curve[loss_type][0] = (losses, poes, avg)
-                    # NB: the aggregated loss_map is not stored
+            if has_agg:
                 self.store('/agg_loss_curve', rlz, agg_loss_curve)
 
         if specific_assets:
@@ -322,32 +625,54 @@ class EventBasedRiskCalculator(base.RiskCalculator):
         return (losses_poes[0], losses_poes[1],
                 scientific.average_loss(losses_poes), loss_map)
 
-    def build_loss_curves(self, elass, loss_type, i):
+    def build_loss_curves(self, dset, field):
         """
         Build loss curves per asset from a set of losses with length given by
-        the parameter loss_curve_resolution.
+        the parameter loss_curve_resolution. The losses are read in chunks.
+
+        :param dset: a dataset (or an array) of dtype ass_loss_dt for a
+                     given realization and loss type
+        :param field: 'loss' for loss curves or 'ins_loss' for insured curves
+        :returns: an array of loss curves, one for each asset
+        """
+        oq = self.oqparam
+        C = oq.loss_curve_resolution
+        N = len(self.assets)
+        max_losses = numpy.zeros(N)
+        for data in _gen_chunks(dset, self.chunksize):
+            numpy.maximum.at(max_losses, data['ass'], data[field])
+        counts = numpy.zeros((N, C), numpy.uint32)
+        for data in _gen_chunks(dset, self.chunksize):
+            counts += scientific.exceedance_counts(
+                data['ass'], data[field], max_losses, C)
+        return scientific.loss_curves_from_counts(
+            scientific.reference_losses(max_losses, C), counts,
+            oq.tses, oq.risk_investigation_time)
+
+    def build_loss_curves_from_counts(self, rlz, loss_type, field):
+        """
+        Build loss curves per asset from the exceedance counts of the
+        loss ratios merged during the computation; the losses of each
+        curve are the loss ratios of the grid times the asset value.
 
-        :param elass: a dict (loss_type, asset_id) -> (tag, loss, ins_loss)
-        :param loss_type: the loss_type
-        :param i: 1 for loss curves or 2 for insured losses
+        :param rlz: a realization object
+        :param loss_type: a loss type string
+        :param field: 'loss' for loss curves or 'ins_loss' for insured curves
         :returns: an array of loss curves, one for each asset
         """
         oq = self.oqparam
         C = oq.loss_curve_resolution
-        lcs = []
-        for asset in self.assets:
-            all_losses = [loss[i] for loss in elass[loss_type, asset.id]]
-            if all_losses:
-                losses, poes = scientific.event_based(
-                    all_losses, tses=oq.tses,
-                    time_span=oq.risk_investigation_time,
-                    curve_resolution=C)
-                avg = scientific.average_loss((losses, poes))
-            else:
-                losses, poes = numpy.zeros(C), numpy.zeros(C)
-                avg = 0
-            lcs.append((losses, poes, avg))
-        return numpy.array(lcs, self.loss_curve_dt)
+        N = len(self.assets)
+        counts = self.datastore.get(
+            '/loss_counts-rlzs/%s/%s/%s' % (rlz.uid, loss_type, field),
+            numpy.zeros((N, C), U32))[:]
+        # the assets without a value have no losses
+        values = numpy.nan_to_num(
+            workflows.get_column('value', loss_type, self.assetcol))
+        ratios = scientific.CurveBuilder(C).ratios
+        return scientific.loss_curves_from_counts(
+            values[:, None] * ratios, counts,
+            oq.tses, oq.risk_investigation_time)
 
     def store(self, name, dset, curves):
         """
@@ -366,37 +691,11 @@ class EventBasedRiskCalculator(base.RiskCalculator):
 
     # ################### methods to compute statistics  #################### #
 
-    def build_stats(self, loss_curve_key):
-        """
-        Compute all statistics for the specified assets starting from the
-        stored loss curves. Yield a statistical output object for each
-        loss type.
-        """
-        oq = self.oqparam
-        rlzs = self.rlzs_assoc.realizations
-        stats = scientific.StatsBuilder(
-            oq.quantile_loss_curves, oq.conditional_loss_poes, [],
-            scientific.normalize_curves_eb)
-        # NB: should we encounter memory issues in the future, the easy
-        # solution is to split the specific assets in blocks and perform
-        # the computation one block at the time
-        for loss_type in self.riskmodel.get_loss_types():
-            outputs = []
-            for rlz in rlzs:
-                key = '%s-rlzs/%s' % (loss_curve_key, rlz.uid)
-                lcs = self.datastore[key][loss_type]
-                assets = [None] if key.startswith('/agg') else self.assets
-                losses_poes = numpy.array(  # -> shape (N, 2, C)
-                    [lcs['losses'], lcs['poes']]).transpose(1, 0, 2)
-                out = scientific.Output(
-                    assets, loss_type, rlz.ordinal, rlz.weight,
-                    loss_curves=losses_poes, insured_curves=None)
-                outputs.append(out)
-            yield stats.build(outputs)
-
     def compute_store_stats(self, loss_curve_key):
         """
-        Compute and store the statistical outputs
+        Compute and store the statistical outputs. The assets are
+        processed in blocks, in parallel, to avoid reading in memory
+        the curves of all the assets for all the realizations.
         """
         oq = self.oqparam
         N = 1 if loss_curve_key.startswith('/agg_') else len(self.assets)
@@ -406,14 +705,32 @@ class EventBasedRiskCalculator(base.RiskCalculator):
         if oq.conditional_loss_poes:
             loss_map_stats = self.zeros((Q, N), self.loss_map_dt)
 
-        for stat in self.build_stats(loss_curve_key):
+        builder = scientific.StatsBuilder(
+            oq.quantile_loss_curves, oq.conditional_loss_poes, [],
+            scientific.normalize_curves_eb)
+        blocks = [(start, min(start + self.assets_per_block, N))
+                  for start in range(0, N, self.assets_per_block)]
+        # the file is closed, so that the tasks can open it for reading
+        self.datastore.close()
+        try:
+            stats_by_block = parallel.apply_reduce(
+                compute_stats,
+                (blocks, self.datastore.hdf5path, loss_curve_key,
+                 self.rlzs_assoc.realizations,
+                 self.riskmodel.get_loss_types(), builder,
+                 self.task_monitor('compute_stats')),
+                concurrent_tasks=oq.concurrent_tasks)
+        finally:
+            self.datastore.open()
+        for (start, stop), stats in stats_by_block.iteritems():
+            block = slice(start, stop)
             # there is one stat for each loss_type
-            curves, ins_curves, maps = scientific.get_stat_curves(stat)
-            loss_curve_stats[:][stat.loss_type] = curves
-            if oq.insured_losses:
-                ins_curve_stats[:][stat.loss_type] = ins_curves
-            if oq.conditional_loss_poes:
-                loss_map_stats[:][stat.loss_type] = maps
+            for loss_type, curves, ins_curves, maps in stats:
+                loss_curve_stats[:, block][loss_type] = curves
+                if oq.insured_losses:
+                    ins_curve_stats[:, block][loss_type] = ins_curves
+                if oq.conditional_loss_poes:
+                    loss_map_stats[:, block][loss_type] = maps
 
         for i, stats in enumerate(_mean_quantiles(oq.quantile_loss_curves)):
             self.store(loss_curve_key, stats, loss_curve_stats[i])
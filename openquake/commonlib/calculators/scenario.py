@@ -93,7 +93,8 @@ class ScenarioCalculator(base.HazardCalculator):
         Compute the GMFs in parallel and return a dictionary gmf_by_trt_gsim
         """
         logging.info('Computing the GMFs')
-        args = (self.tag_seed_pairs, self.computer, self.monitor('calc_gmfs'))
+        args = (self.tag_seed_pairs, self.computer,
+                self.task_monitor('calc_gmfs'))
         gmf_by_tag = parallel.apply_reduce(
             self.core_func.__func__, args,
             concurrent_tasks=self.oqparam.concurrent_tasks)
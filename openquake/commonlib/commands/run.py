@@ -20,11 +20,11 @@ import logging
 
 from openquake.baselib import performance
 from openquake.commonlib import sap, readinput, valid
-from openquake.commonlib.parallel import executor
+from openquake.commonlib.parallel import num_tasks_hint
 from openquake.commonlib.calculators import base
 
 
-def run(job_ini, concurrent_tasks=executor.num_tasks_hint,
+def run(job_ini, concurrent_tasks=num_tasks_hint,
         loglevel='info', hc=None, exports=''):
     """
     Run a calculation. Optionally, set the number of concurrent_tasks
@@ -0,0 +1,222 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2015, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A cost model predicting the duration of the tasks spawned by
+:func:`openquake.commonlib.parallel.apply_reduce` from the static
+weights of the items they process. The items are classified by kind
+(for instance by source class and tectonic region type) and each kind
+has a coefficient, fitted on the durations of the tasks of a previous
+calculation, which are stored in the datastore under `/task_info`.
+Only the calculations with the same job fingerprint, i.e. the same
+calculation mode and the same input files, are considered.
+"""
+import os
+import hashlib
+import logging
+import functools
+
+import numpy
+from scipy.optimize import nnls
+
+from openquake.baselib.general import AccumDict
+from openquake.commonlib import datastore
+
+# the input files are read in blocks of this size by job_fingerprint
+BLOCKSIZE = 1024 * 1024
+
+
+def build_task_info_dt(kind_len):
+    """
+    :param kind_len: the length of the longest kind
+    :returns: the dtype of the arrays stored under `/task_info`
+    """
+    return numpy.dtype(
+        [('task_no', numpy.uint32),
+         ('kind', (str, kind_len)),
+         ('weight', float),
+         ('predicted', float),
+         ('duration', float)])
+
+
+def source_kind(src):
+    """
+    :param src: a hazardlib source object
+    :returns: a string <source class>/<tectonic region type>
+    """
+    return '%s/%s' % (src.__class__.__name__, src.tectonic_region_type)
+
+
+class CostModel(object):
+    """
+    A model predicting the cost of an item as `coeff * weight`, where
+    the coefficient depends on the kind of the item; kinds without a
+    coefficient get the average coefficient, or 1 if there are no
+    coefficients at all. Instances of CostModel can be passed
+    as `weight` function to `apply_reduce`.
+
+    :param kind: a function item -> string
+    :param weight: a function item -> static weight
+    :param coeffs: a dictionary kind -> coefficient
+    """
+    def __init__(self, kind, weight, coeffs=None):
+        self.kind = kind
+        self.weight = weight
+        self.coeffs = coeffs or {}
+        self.default = (numpy.mean(self.coeffs.values())
+                        if self.coeffs else 1.)
+
+    def __call__(self, item):
+        """
+        :returns: the predicted cost of the item
+        """
+        return self.coeffs.get(self.kind(item), self.default) * self.weight(
+            item)
+
+    def get_task_info(self, chunks, durations):
+        """
+        :param chunks: the chunks processed by the tasks
+        :param durations: the durations of the tasks
+        :returns:
+            an array with a row for each task and kind of item,
+            containing the sum of the static weights, the predicted cost
+            of the task and its duration; the kind field is large
+            enough to contain the longest kind
+        """
+        rows = []
+        for task_no, (chunk, duration) in enumerate(zip(chunks, durations)):
+            weights = AccumDict()
+            for item in chunk:
+                weights += {self.kind(item): self.weight(item)}
+            predicted = sum(self.coeffs.get(kind, self.default) * weight
+                            for kind, weight in weights.iteritems())
+            for kind in sorted(weights):
+                rows.append(
+                    (task_no, kind, weights[kind], predicted, duration))
+        kind_len = max([1] + [len(row[1]) for row in rows])
+        return numpy.array(rows, build_task_info_dt(kind_len))
+
+    @staticmethod
+    def fit(task_info):
+        """
+        Fit the coefficients with a non-negative least squares, by
+        requiring the duration of each task to be the sum of the costs
+        of its items.
+
+        :param task_info: an array as returned by `get_task_info`
+        :returns: a dictionary kind -> coefficient
+        """
+        task_info = task_info[~numpy.isnan(task_info['duration'])]
+        if len(task_info) == 0:
+            return {}
+        kinds = numpy.unique(task_info['kind'])
+        tasks, tidx = numpy.unique(task_info['task_no'], return_inverse=True)
+        kidx = numpy.searchsorted(kinds, task_info['kind'])
+        weights = numpy.zeros((len(tasks), len(kinds)))
+        numpy.add.at(weights, (tidx, kidx), task_info['weight'])
+        durations = numpy.zeros(len(tasks))
+        durations[tidx] = task_info['duration']
+        coeffs, _residual = nnls(weights, durations)
+        # the kinds with a zero coefficient are not determined by the data
+        return {kind: coeff for kind, coeff in zip(kinds, coeffs) if coeff}
+
+
+def job_fingerprint(oqparam):
+    """
+    :param oqparam: an :class:`openquake.commonlib.oqvalidation.OqParam`
+    :returns:
+        a checksum of the calculation mode and of the contents of the
+        input files (job.ini, logic trees, source models, ...)
+    """
+    checksum = hashlib.md5(oqparam.calculation_mode)
+    for key in sorted(oqparam.inputs):
+        fnames = oqparam.inputs[key]
+        if key == 'job_ini':
+            fnames = fnames.split(',')
+        elif isinstance(fnames, basestring):
+            fnames = [fnames]
+        for fname in fnames:
+            checksum.update(key)
+            # the source models can be huge: read them in blocks
+            with open(fname, 'rb') as f:
+                for block in iter(functools.partial(f.read, BLOCKSIZE), ''):
+                    checksum.update(block)
+    return checksum.hexdigest()
+
+
+def read_coeffs(taskname, calc_id, fingerprint, datadir=datastore.DATADIR,
+                max_calcs=10):
+    """
+    Fit the coefficients of a CostModel on the durations of the given task
+    in the most recent calculation before `calc_id` with the given job
+    fingerprint, if any. Only the last `max_calcs` calculations are
+    considered.
+
+    :param taskname: the name of the task
+    :param calc_id: the ID of the current calculation
+    :param fingerprint: the job fingerprint (see :func:`job_fingerprint`)
+    :param datadir: the directory containing the calculations
+    :param max_calcs: the maximum number of calculations to consider
+    :returns: a dictionary kind -> coefficient, possibly empty
+    """
+    for cid in range(calc_id - 1, max(calc_id - 1 - max_calcs, 0), -1):
+        path = os.path.join(datadir, 'calc_%d' % cid, 'output.hdf5')
+        if not os.path.exists(path):
+            continue
+        try:
+            with datastore.h5py.File(path, 'r') as h5:
+                dset = h5['/task_info/' + taskname]
+                if dset.attrs.get('fingerprint') != fingerprint:
+                    continue  # a different job
+                task_info = dset.value
+        except (IOError, KeyError):
+            continue
+        logging.info('Using the durations of %s in calculation #%d',
+                     taskname, cid)
+        return CostModel.fit(task_info)
+    return {}
+
+
+def report(task_info):
+    """
+    Compare the predicted costs and the actual durations of the tasks.
+    The predicted costs are rescaled to have the same total of the
+    durations, since they are not in seconds if no coefficients were
+    available.
+
+    :param task_info: an array as returned by `CostModel.get_task_info`
+    :returns: a string with a table and a summary
+    """
+    tasks, idx = numpy.unique(task_info['task_no'], return_index=True)
+    predicted = task_info['predicted'][idx]
+    actual = task_info['duration'][idx]
+    ok = ~numpy.isnan(actual)
+    if not ok.any():
+        return 'The durations of the tasks are unknown'
+    tasks, predicted, actual = tasks[ok], predicted[ok], actual[ok]
+    predicted = predicted * actual.sum() / (predicted.sum() or 1)
+    lines = ['task predicted actual']
+    for i in numpy.argsort(actual)[::-1]:
+        lines.append('%4d %9.3f %6.3f' % (tasks[i], predicted[i], actual[i]))
+    lines.append('max/mean: predicted=%.2f, actual=%.2f; mean relative '
+                 'error=%.2f' % (
+                     predicted.max() / predicted.mean(),
+                     actual.max() / actual.mean(),
+                     numpy.mean(numpy.abs(predicted - actual) /
+                                numpy.maximum(actual, 1E-6))))
+    return '\n'.join(lines)
@@ -112,6 +112,14 @@ class DataStore(collections.MutableMapping):
             os.mkdir(self.calc_dir)
         self.export_dir = '.'
         self.hdf5path = os.path.join(self.calc_dir, 'output.hdf5')
+        self.open()
+
+    def open(self):
+        """
+        Open the underlying hdf5 file; this is done at instantiation time,
+        but it can be done again after a :meth:`close`, for instance after
+        letting other processes read the file.
+        """
         mode = 'r+' if os.path.exists(self.hdf5path) else 'w'
         self.hdf5 = h5py.File(self.hdf5path, mode, libver='latest')
 
@@ -176,6 +184,28 @@ class DataStore(collections.MutableMapping):
         except (KeyError, IOError):
             return default
 
+    def extend(self, key, array):
+        """
+        Extend the HDF5 dataset associated to the given key with the
+        elements of the given array. If the dataset does not exist yet,
+        it is created with an unlimited first dimension.
+
+        :param key: a key starting with '/'
+        :param array: an array with the same dtype of the dataset
+        :returns: the extended dataset
+        """
+        try:
+            dset = self.hdf5[key]
+        except KeyError:
+            shape = array.shape[1:]
+            dset = self.hdf5.create_dataset(
+                key, (0,) + shape, array.dtype, chunks=True,
+                maxshape=(None,) + shape)
+        length = len(dset)
+        dset.resize((length + len(array),) + array.shape[1:])
+        dset[length:] = array
+        return dset
+
     def __getitem__(self, key):
         if key.startswith('/'):
             try:
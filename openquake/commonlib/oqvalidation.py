@@ -46,14 +46,18 @@ class OqParam(valid.ParamSet):
     base_path = valid.Param(valid.utf8, '.')
     calculation_mode = valid.Param(valid.Choice(*CALCULATORS), '')
     concurrent_tasks = valid.Param(
-        valid.positiveint, parallel.executor.num_tasks_hint)
+        valid.positiveint, parallel.num_tasks_hint)
     coordinate_bin_width = valid.Param(valid.positivefloat)
     conditional_loss_poes = valid.Param(valid.probabilities, [])
     continuous_fragility_discretization = valid.Param(valid.positiveint, 20)
     description = valid.Param(valid.utf8_not_empty)
     distance_bin_width = valid.Param(valid.positivefloat)
+    dynamic_scheduling = valid.Param(valid.boolean, False)
     mag_bin_width = valid.Param(valid.positivefloat)
+    epsilon_generator = valid.Param(
+        valid.Choice('counter', 'numpy'), 'counter')
     epsilon_sampling = valid.Param(valid.positiveint, 1000)
+    executor = valid.Param(valid.Choice('', *sorted(parallel.executors)), '')
     export_dir = valid.Param(valid.utf8, None)
     export_multi_curves = valid.Param(valid.boolean, False)
     exports = valid.Param(valid.export_formats, ())
@@ -79,6 +83,7 @@ class OqParam(valid.ParamSet):
     interest_rate = valid.Param(valid.positivefloat)
     investigation_time = valid.Param(valid.positivefloat, None)
     loss_curve_resolution = valid.Param(valid.positiveint, 50)
+    loss_curves_from_counts = valid.Param(valid.boolean, False)
     lrem_steps_per_interval = valid.Param(valid.positiveint, 0)
     steps_per_interval = valid.Param(valid.positiveint, 0)
     master_seed = valid.Param(valid.positiveint, 0)
@@ -93,6 +98,7 @@ class OqParam(valid.ParamSet):
     poes_disagg = valid.Param(valid.probabilities, [])
     quantile_hazard_curves = valid.Param(valid.probabilities, [])
     quantile_loss_curves = valid.Param(valid.probabilities, [])
+    quantile_sketch_bins = valid.Param(valid.positiveint, 0)
     random_seed = valid.Param(valid.positiveint, 42)
     reference_depth_to_1pt0km_per_sec = valid.Param(valid.positivefloat, 1.)
     reference_depth_to_2pt5km_per_sec = valid.Param(valid.positivefloat, 1.)
@@ -117,6 +123,7 @@ class OqParam(valid.ParamSet):
     time_event = valid.Param(str, None)
     truncation_level = valid.Param(valid.NoneOr(valid.positivefloat), None)
     uniform_hazard_spectra = valid.Param(valid.boolean, False)
+    vulnerability_table_resolution = valid.Param(valid.positiveint, 0)
     width_of_mfd_bin = valid.Param(valid.positivefloat)
 
     def __init__(self, **names_vals):
@@ -22,15 +22,24 @@ TODO: write documentation.
 
 import os
 import sys
+import shutil
 import cPickle
 import logging
 import operator
+import hashlib
+import tempfile
 import functools
 import traceback
+import multiprocessing
 import time
+from cStringIO import StringIO
 from datetime import datetime
-from concurrent.futures import as_completed, ProcessPoolExecutor
+from collections import OrderedDict, deque
+from concurrent.futures import (
+    as_completed, wait, FIRST_COMPLETED, Future, ProcessPoolExecutor,
+    ThreadPoolExecutor)
 
+import numpy
 import psutil
 
 
@@ -57,17 +66,59 @@ else:  # Ubuntu 12.04
 
 
 from openquake.baselib.general import split_in_blocks, AccumDict
+from openquake.commonlib.socketpool import SocketPoolExecutor
 
 
-executor = ProcessPoolExecutor()
-# the num_tasks_hint is chosen to be 4 times bigger than the name of
+# the number of workers of the executors, one per core
+num_workers = multiprocessing.cpu_count()
+
+# the num_tasks_hint is chosen to be 4 times bigger than the number of
 # cores; it is a heuristic number to get a decent distribution of the
 # load; it has no more significance than that
-executor.num_tasks_hint = executor._max_workers * 4
+num_tasks_hint = num_workers * 4
+
+
+def thread_pool():
+    """A pool of threads, one per core"""
+    return ThreadPoolExecutor(num_workers)
+
+# the available executors; the threads are convenient for tasks spending
+# most of their time in numpy routines releasing the GIL; the sockets
+# are a stand-in for a multi-host cluster
+executors = {
+    'processes': ProcessPoolExecutor,
+    'threads': thread_pool,
+    'sockets': SocketPoolExecutor.from_environ,
+}
+
+
+def get_executor(name=''):
+    """
+    Instantiate an executor. If the name is empty, it is taken from
+    the variable OQ_EXECUTOR, with default 'processes'.
+
+    :param name: the name of the executor, a key in `executors`
+    """
+    name = name or os.environ.get('OQ_EXECUTOR', 'processes')
+    try:
+        executor = executors[name]()
+    except KeyError:
+        raise ValueError('Unknown executor %r, expected one of %s' %
+                         (name, ', '.join(sorted(executors))))
+    executor.name = name
+    executor.num_tasks_hint = executor._max_workers * 4
+    return executor
 
 
 ONE_MB = 1024 * 1024
 
+# arrays bigger than this are passed to the workers via memory-mapped files
+SHARED_ARRAY_SIZE = ONE_MB
+
+# task arguments marked with :func:`cached` and with a pickled size bigger
+# than this are unpickled only once per worker, see :class:`CachedPickle`
+CACHED_PICKLE_SIZE = ONE_MB // 10
+
 
 def no_distribute():
     """
@@ -77,6 +128,68 @@ def no_distribute():
     return nd in ('1', 'true', 'yes')
 
 
+# in the dynamic mode of apply_reduce the number of chunks is OVERSPLIT
+# times the number of concurrent tasks
+OVERSPLIT = 4
+
+
+def split_heavy(items, max_weight, weight, split):
+    """
+    Yield the items, by splitting recursively the ones heavier than
+    `max_weight`. An item is not split further if `split` returns
+    a single element. For instance, if only the even numbers can be
+    split:
+
+    >>> halve = lambda x: [x // 2, x // 2] if x % 2 == 0 else [x]
+    >>> list(split_heavy([1, 8, 3], 2, float, halve))
+    [1, 2, 2, 2, 2, 3]
+
+    :param items: a sequence of items
+    :param max_weight: the maximum weight of an item
+    :param weight: a function item -> weight
+    :param split: a function item -> list of items
+    """
+    for item in items:
+        if weight(item) > max_weight:
+            parts = list(split(item))
+            if len(parts) > 1:
+                for part in split_heavy(parts, max_weight, weight, split):
+                    yield part
+                continue
+        yield item
+
+
+def dynamic_chunks(items, num_chunks, weight, key, split):
+    """
+    Split the items in chunks for the dynamic scheduling mode of
+    `apply_reduce`. The items heavier than the average weight of a chunk
+    are split first (see :func:`split_heavy`), then the chunks are
+    ordered by decreasing weight, so that the heaviest are submitted
+    first and the workers finish with the lightest ones.
+
+    :param items: a sequence of items
+    :param num_chunks: hint about how many chunks to generate
+    :param weight: a function item -> weight
+    :param key: a function item -> kind
+    :param split: a function item -> list of items
+    :returns: a list of chunks
+    """
+    max_weight = sum(weight(item) for item in items) / float(num_chunks)
+    items = list(split_heavy(items, max_weight, weight, split))
+    chunks = list(split_in_blocks(items, num_chunks, weight, key))
+    chunks.sort(key=lambda chunk: sum(weight(item) for item in chunk),
+                reverse=True)
+    return chunks
+
+
+def get_max_in_flight():
+    """
+    The maximum number of tasks submitted and not completed, as set by the
+    variable OQ_MAX_IN_FLIGHT; None (no limit) if the variable is not set
+    """
+    return int(os.environ.get('OQ_MAX_IN_FLIGHT', 0)) or None
+
+
 def check_mem_usage(soft_percent=90, hard_percent=100):
     """
     Display a warning if we are running out of memory
@@ -104,8 +217,11 @@ def safely_call(func, args, pickle=False):
     :param args: the arguments
     :param pickle:
         if set, the input arguments are unpickled and the return value
-        is pickled; otherwise they are left unchanged
+        is pickled, with an attribute `.duration` containing the time
+        spent in the call and an attribute `.spans` containing the spans
+        collected by the tracer; otherwise they are left unchanged
     """
+    t0 = time.time()
     try:
         if pickle:
             args = [a.unpickle() for a in args]
@@ -115,7 +231,32 @@ def safely_call(func, args, pickle=False):
         tb_str = ''.join(traceback.format_tb(tb))
         res = '\n%s%s: %s' % (tb_str, etype.__name__, exc), etype
     if pickle:
-        return Pickled(res)
+        pik = Pickled(res)
+        pik.duration = time.time() - t0  # measured on the worker
+        pik.spans = tracer.flush()  # collected by the TracingMonitors
+        return pik
+    return res
+
+
+class TimedResult(tuple):
+    """
+    A pair (result, exc_type) as returned by :func:`safely_call`, with
+    an attribute `.duration` containing the time spent in the call
+    """
+
+
+def timed_call(func, args):
+    """
+    Call :func:`safely_call` and measure the time spent. This is used
+    by the pool of threads, where there is nothing to pickle.
+
+    :param func: the function to call
+    :param args: the arguments
+    :returns: a :class:`TimedResult` instance
+    """
+    t0 = time.time()
+    res = TimedResult(safely_call(func, args))
+    res.duration = time.time() - t0
     return res
 
 
@@ -155,10 +296,44 @@ class Pickled(object):
     of the pickled bytestring.
 
     :param obj: the object to pickle
+    :param shared:
+        if given, a :class:`SharedArrays` instance where to store the
+        big arrays contained in the object, which are then not pickled;
+        their total size in bytes is stored in the attribute
+        `shared_nbytes`
     """
-    def __init__(self, obj):
+    def __init__(self, obj, shared=None):
         self.clsname = obj.__class__.__name__
-        self.pik = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+        self.shared_nbytes = 0
+        if shared is None:
+            self.pik = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+        else:
+            nbytes = {}  # path -> size of the shared array
+
+            def persistent_id(obj):
+                path = shared.persistent_id(obj)
+                if path is not None:
+                    nbytes[path] = obj.nbytes
+                return path
+            io = StringIO()
+            pickler = cPickle.Pickler(io, cPickle.HIGHEST_PROTOCOL)
+            # inst_persistent_id is called only for objects which are not
+            # of builtin types, so it is faster than persistent_id
+            pickler.inst_persistent_id = persistent_id
+            pickler.dump(obj)
+            self.pik = io.getvalue()
+            self.shared_nbytes = sum(nbytes.itervalues())
+
+    @classmethod
+    def frombytes(cls, clsname, pik):
+        """
+        Build a Pickled instance from an already pickled bytestring
+        """
+        self = cls.__new__(cls)
+        self.clsname = clsname
+        self.pik = pik
+        self.shared_nbytes = 0
+        return self
 
     def __repr__(self):
         """String representation of the pickled object"""
@@ -170,7 +345,213 @@ class Pickled(object):
 
     def unpickle(self):
         """Unpickle the underlying object"""
-        return cPickle.loads(self.pik)
+        loaded = {}  # path -> array, to preserve the identity of the arrays
+
+        def persistent_load(path):
+            if path not in loaded:
+                loaded[path] = SharedArrays.persistent_load(path)
+            return loaded[path]
+        unpickler = cPickle.Unpickler(StringIO(self.pik))
+        unpickler.persistent_load = persistent_load
+        return unpickler.load()
+
+
+class LRUCache(object):
+    """
+    A dictionary-like cache discarding the least recently used values
+    when the total size of the stored values exceeds `maxsize`:
+
+    >>> cache = LRUCache(maxsize=10)
+    >>> cache.get('a', lambda: ('A', 4))
+    'A'
+    >>> cache.get('b', lambda: ('B', 4))
+    'B'
+    >>> cache.get('a', lambda: ('X', 4))  # 'a' is cached
+    'A'
+    >>> cache.get('c', lambda: ('C', 4))  # discards 'b'
+    'C'
+    >>> sorted(cache.data)
+    ['a', 'c']
+
+    :param maxsize: the maximum total size of the values
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()  # key -> (value, size)
+        self.size = 0
+
+    def get(self, key, load):
+        """
+        Return the value associated to the key; if missing, it is computed
+        by calling load(), which must return a pair (value, size).
+        """
+        try:
+            value, size = self.data.pop(key)
+        except KeyError:
+            value, size = load()
+            self.size += size
+            while self.size > self.maxsize and self.data:
+                self.size -= self.data.popitem(last=False)[1][1]
+        self.data[key] = value, size  # now it is the most recently used
+        return value
+
+
+# the cache of the task arguments in the worker processes; its size
+# can be set with the environment variable OQ_WORKER_CACHE_MB
+worker_cache = LRUCache(
+    int(os.environ.get('OQ_WORKER_CACHE_MB', 512)) * ONE_MB)
+
+
+class Cached(object):
+    """
+    A task argument marked as read-only, see :func:`cached`.
+
+    :param obj: the wrapped object
+    """
+    def __init__(self, obj):
+        if isinstance(obj, (PerformanceMonitor, TracingMonitor)):
+            raise TypeError('A monitor cannot be cached: %r' % obj)
+        self.obj = obj
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__,
+                            self.obj.__class__.__name__)
+
+
+def cached(obj):
+    """
+    Mark a task argument as read-only: if it is big, it is sent to the
+    workers as a :class:`CachedPickle` and the tasks running in the same
+    worker share a single unpickled instance. The tasks receive the
+    object itself, not the wrapper. Only objects which are never modified
+    by the tasks can be marked; monitors are never cached.
+
+    :param obj: the object to pass to the tasks
+    :returns: a :class:`Cached` instance
+    """
+    return Cached(obj)
+
+
+def unwrap(args):
+    """
+    :param args: a sequence of task arguments, possibly :class:`Cached`
+    :returns: the list of the underlying objects
+    """
+    return [arg.obj if isinstance(arg, Cached) else arg for arg in args]
+
+
+class CachedPickle(object):
+    """
+    A reference to a pickled object saved in a file, to be sent to the
+    workers instead of the object itself. Each worker process unpickles
+    the object only the first time it sees it and then takes it from
+    the `worker_cache`, where it is identified by the SHA1 digest of the
+    pickled bytestring. Only the arguments marked with :func:`cached`
+    are sent in this way, since the object is shared by the tasks.
+    The size of the object in the cache includes the big arrays it
+    refers to, since the cache keeps them mapped in memory.
+
+    :param pickled: a :class:`Pickled` instance
+    :param path: the file where the pickled bytestring is saved
+    """
+    def __init__(self, pickled, path):
+        self.clsname = pickled.clsname
+        self.size = len(pickled) + pickled.shared_nbytes
+        self.digest = hashlib.sha1(pickled.pik).hexdigest()
+        self.path = path
+
+    def __repr__(self):
+        return '<CachedPickle %s %dK>' % (self.clsname, self.size / 1024)
+
+    def __len__(self):
+        """The number of bytes sent"""
+        return len(self.digest) + len(self.path)
+
+    def load(self):
+        """Unpickle the object from the file and return it with its size"""
+        with open(self.path, 'rb') as f:
+            pickled = Pickled.frombytes(self.clsname, f.read())
+        return pickled.unpickle(), self.size
+
+    def unpickle(self):
+        """Return the object, from the worker cache if possible"""
+        return worker_cache.get(self.digest, self.load)
+
+
+class SharedArrays(object):
+    """
+    A store for big numpy arrays to be sent to the workers. Each array
+    is saved only once in a .npy file in a temporary directory (in
+    /dev/shm, if available) and the workers map it in memory, without
+    copying it. Arrays containing Python objects and arrays smaller than
+    `size` bytes are pickled as usual. The store can also contain
+    pickled objects, see :meth:`cache`.
+
+    :param size: the minimum size in bytes of the shared arrays
+    """
+    dirname = '/dev/shm' if os.access('/dev/shm', os.W_OK) else None
+
+    def __init__(self, size=SHARED_ARRAY_SIZE):
+        self.size = size
+        self.tmpdir = None
+        self.arrays = {}  # id -> (array, path)
+        self.cached = {}  # digest -> CachedPickle
+        self.nbytes = 0
+
+    def _path(self, name):
+        if self.tmpdir is None:
+            self.tmpdir = tempfile.mkdtemp(
+                prefix='oq-shared-', dir=self.dirname)
+        return os.path.join(self.tmpdir, name)
+
+    def persistent_id(self, obj):
+        """
+        Return the path of the .npy file associated to big arrays,
+        None for all other objects.
+        """
+        if (not isinstance(obj, numpy.ndarray) or obj.dtype.hasobject or
+                obj.nbytes < self.size):
+            return None
+        try:  # keeping a reference to the array, so that its id is not reused
+            return self.arrays[id(obj)][1]
+        except KeyError:
+            path = self._path('%d.npy' % len(self.arrays))
+            numpy.save(path, obj)
+            self.arrays[id(obj)] = obj, path
+            self.nbytes += obj.nbytes
+            return path
+
+    @staticmethod
+    def persistent_load(path):
+        """
+        Map in memory the array saved in the given path; the array is
+        copy-on-write, so that the tasks can modify it locally.
+        """
+        return numpy.load(path, mmap_mode='c')
+
+    def cache(self, pickled):
+        """
+        Save the pickled bytestring in a file (only once) and return
+        a :class:`CachedPickle` instance referring to it.
+        """
+        cached = CachedPickle(pickled, None)
+        if cached.digest not in self.cached:
+            cached.path = self._path(cached.digest + '.pik')
+            with open(cached.path, 'wb') as f:
+                f.write(pickled.pik)
+            self.cached[cached.digest] = cached
+        return self.cached[cached.digest]
+
+    def clear(self):
+        """
+        Remove the temporary files
+        """
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = None
+        self.arrays.clear()
+        self.cached.clear()
+        self.nbytes = 0
 
 
 def get_pickled_sizes(obj):
@@ -195,7 +576,7 @@ def get_pickled_sizes(obj):
         sizes, key=lambda pair: pair[1], reverse=True)
 
 
-def pickle_sequence(objects):
+def pickle_sequence(objects, shared=None):
     """
     Convert an iterable of objects into a list of pickled objects.
     If the iterable contains copies, the pickling will be done only once.
@@ -203,6 +584,7 @@ def pickle_sequence(objects):
     pickled again.
 
     :param objects: a sequence of objects to pickle
+    :param shared: a :class:`SharedArrays` instance or None
     """
     cache = {}
     out = []
@@ -212,7 +594,7 @@ def pickle_sequence(objects):
             if isinstance(obj, Pickled):  # already pickled
                 cache[obj_id] = obj
             else:  # pickle the object
-                cache[obj_id] = Pickled(obj)
+                cache[obj_id] = Pickled(obj, shared)
         out.append(cache[obj_id])
     return out
 
@@ -229,42 +611,77 @@ class TaskManager(object):
 
     Progress report is built-in.
     """
-    executor = executor
+    executor = None  # instantiated when the first task is submitted
     progress = staticmethod(logging.info)
 
+    @classmethod
+    def init_executor(cls):
+        """
+        Instantiate the executor, if it was not instantiated already,
+        and return it. In this way importing the module does not
+        start a pool of workers.
+        """
+        if cls.executor is None:
+            cls.executor = get_executor()
+        return cls.executor
+
     @classmethod
     def restart(cls):
-        cls.executor.shutdown()
-        cls.executor = ProcessPoolExecutor()
+        if cls.executor is not None:
+            cls.executor.shutdown()
+            cls.executor = get_executor(cls.executor.name)
 
     @classmethod
-    def starmap(cls, task, task_args, name=None):
+    def set_executor(cls, name=''):
+        """
+        Replace the current executor, if a different one is requested.
+
+        :param name: the name of the executor (see :func:`get_executor`)
         """
-        Spawn a bunch of tasks with the given list of arguments
+        name = name or os.environ.get('OQ_EXECUTOR', 'processes')
+        if cls.executor is None:
+            cls.executor = get_executor(name)
+        elif name != cls.executor.name:
+            new = get_executor(name)
+            cls.executor.shutdown()
+            cls.executor = new
 
+    @classmethod
+    def starmap(cls, task, task_args, name=None, max_in_flight=None):
+        """
+        Spawn a bunch of tasks with the given list of arguments.
+        If `max_in_flight` is set, only that many tasks are submitted
+        at the beginning; the others are pickled and submitted in the
+        `.reduce` method, each time a task completes, so that the pickled
+        arguments do not fill the memory of the master process.
+
+        :param task: a task to run in parallel
+        :param task_args: the list of arguments to be passed to the task
+        :param name: the name of the task (default the function name)
+        :param max_in_flight:
+            the maximum number of tasks submitted and not completed
+            (default from the variable OQ_MAX_IN_FLIGHT)
         :returns: a TaskManager object with a .result method.
         """
         self = cls(task, name)
-        for i, a in enumerate(task_args, 1):
-            cls.progress('Submitting task %s #%d', self.name, i)
-            self.submit(*a)
+        self.submit_all(task_args, max_in_flight)
         return self
 
     @classmethod
     def apply_reduce(cls, task, task_args, agg=operator.add, acc=None,
-                     concurrent_tasks=executor._max_workers,
+                     concurrent_tasks=num_workers,
                      weight=lambda item: 1,
                      key=lambda item: 'Unspecified',
-                     name=None):
+                     name=None, max_in_flight=None, split=None):
         """
         Apply a task to a tuple of the form (sequence, \*other_args)
         by first splitting the sequence in chunks, according to the weight
         of the elements and possibly to a key (see :function:
         `openquake.baselib.general.split_in_blocks`).
         Then reduce the results with an aggregation function.
-        The chunks which are generated internally can be seen directly (
-        useful for debugging purposes) by looking at the attribute `._chunks`,
-        right after the `apply_reduce` function has been called.
+        This is a shortcut for `TaskManager(task, name).apply(...)`;
+        use the method :meth:`apply` directly if you need the chunks and
+        the durations of the tasks.
 
         :param task: a task to run in parallel
         :param task_args: the arguments to be passed to the task function
@@ -273,50 +690,138 @@ class TaskManager(object):
         :param concurrent_tasks: hint about how many tasks to generate
         :param weight: function to extract the weight of an item in arg0
         :param key: function to extract the kind of an item in arg0
+        :param name: the name of the task (default the function name)
+        :param max_in_flight:
+            the maximum number of tasks submitted and not completed
+            (default from the variable OQ_MAX_IN_FLIGHT)
+        :param split:
+            if given, a function item -> list of items, used in the
+            dynamic scheduling mode; see :func:`dynamic_chunks`
+        """
+        return cls(task, name).apply(
+            task_args, agg, acc, concurrent_tasks, weight, key,
+            max_in_flight, split)
+
+    def apply(self, task_args, agg=operator.add, acc=None,
+              concurrent_tasks=num_workers,
+              weight=lambda item: 1,
+              key=lambda item: 'Unspecified',
+              max_in_flight=None, split=None):
+        """
+        Implementation of :meth:`apply_reduce`, with the same parameters.
+        The chunks which are generated internally can be seen directly (
+        useful for debugging purposes) by looking at the attribute
+        `.chunks` after the call; the attribute `.durations` contains the
+        time spent on each chunk (NaN if unknown).
         """
         arg0 = task_args[0]  # this is assumed to be a sequence
         num_items = len(arg0)
         args = task_args[1:]
-        task_func = getattr(task, 'task_func', task)
         if acc is None:
             acc = AccumDict()
-        if num_items == 0:  # nothing to do
+        if num_items == 0:
+            self.chunks = []
+        elif split is not None:  # dynamic scheduling
+            # even a single item is split, if it is heavy
+            self.chunks = dynamic_chunks(
+                arg0, (concurrent_tasks or 1) * OVERSPLIT, weight, key, split)
+            if max_in_flight is None and not no_distribute():
+                # the workers pull the chunks
+                max_in_flight = self.init_executor()._max_workers
+        elif num_items == 1:
+            self.chunks = [arg0]
+        else:
+            self.chunks = list(split_in_blocks(
+                arg0, concurrent_tasks or 1, weight, key))
+        if not self.chunks:  # nothing to do
             return acc
-        elif num_items == 1:  # apply the function in the master process
-            return agg(acc, task_func(arg0, *args))
-        chunks = list(split_in_blocks(
-            arg0, concurrent_tasks or 1, weight, key))
-        cls.apply_reduce.__func__._chunks = chunks
-        if not concurrent_tasks or no_distribute():
-            for chunk in chunks:
-                acc = agg(acc, task_func(chunk, *args))
+        elif (len(self.chunks) == 1 or not concurrent_tasks or
+              no_distribute()):
+            # apply the function in the master process
+            for chunk in self.chunks:
+                t0 = time.time()
+                res = self.task_func(chunk, *unwrap(args))
+                self.durations.append(time.time() - t0)
+                acc = agg(acc, res)
             return acc
-        tm = cls.starmap(task, [(chunk,) + args for chunk in chunks], name)
-        return tm.reduce(agg, acc)
+        self.submit_all([(chunk,) + args for chunk in self.chunks],
+                        max_in_flight)
+        return self.reduce(agg, acc)
+
+    def submit_all(self, task_args, max_in_flight=None):
+        """
+        Submit a task for each tuple of arguments, possibly keeping
+        in `.pending` the ones exceeding `max_in_flight` (see
+        :meth:`starmap`).
+        """
+        if max_in_flight is None:
+            max_in_flight = get_max_in_flight()
+        if max_in_flight and not no_distribute():
+            task_args = list(task_args)
+            self.pending.extend(task_args[max_in_flight:])
+            task_args = task_args[:max_in_flight]
+        for a in task_args:
+            self.submit_task(*a)
 
     def __init__(self, oqtask, name=None):
         self.oqtask = oqtask
         self.task_func = getattr(oqtask, 'task_func', oqtask)
+        # the task function wrapped by the 'total' monitor, if any
+        self.monitored_func = getattr(oqtask, 'monitored_func', self.task_func)
         self.name = name or oqtask.__name__
+        self.chunks = []  # set by .apply
         self.results = []
+        self.pending = deque()  # arguments of the tasks not submitted yet
+        self.submitted = 0
+        self.durations = []  # the time spent in each task, in seconds
+        self.task_no = {}  # future -> task number
         self.sent = 0
         self.received = 0
+        self.shared = SharedArrays()
+
+    def submit_task(self, *args):
+        """
+        Submit a task with the given arguments, logging its number
+        """
+        self.submitted += 1
+        self.progress('Submitting task %s #%d', self.name, self.submitted)
+        self.submit(*args)
 
     def submit(self, *args):
         """
-        Submit a function with the given arguments to the process pool
+        Submit a function with the given arguments to the executor
         and add a Future to the list `.results`. If the variable
         OQ_NO_DISTRIBUTE is set, the function is run in process and the
         result is returned.
         """
         check_mem_usage()
         # log a warning if too much memory is used
+        self.durations.append(numpy.nan)  # set when the task completes
+        objs = unwrap(args)
         if no_distribute():
-            res = safely_call(self.task_func, args)
+            t0 = time.time()
+            res = safely_call(self.task_func, objs)
+            self.durations[-1] = time.time() - t0
+        elif isinstance(self.init_executor(), ThreadPoolExecutor):
+            # the threads share the memory, so there is nothing to pickle
+            res = self.executor.submit(timed_call, self.monitored_func, objs)
+        elif getattr(self.executor, 'remote', False):
+            # the workers may be on other machines: no shared files
+            piks = pickle_sequence(objs)
+            self.sent += sum(len(p) for p in piks)
+            res = self._submit(piks)
         else:
-            piks = pickle_sequence(args)
+            piks = pickle_sequence(objs, self.shared)
+            # the read-only arguments are usually the same for all tasks:
+            # if they are big, send only a reference to them
+            for i, arg in enumerate(args):
+                if (isinstance(arg, Cached) and
+                        len(piks[i]) > CACHED_PICKLE_SIZE):
+                    piks[i] = self.shared.cache(piks[i])
             self.sent += sum(len(p) for p in piks)
             res = self._submit(piks)
+        if isinstance(res, Future):
+            self.task_no[res] = len(self.durations) - 1
         self.results.append(res)
 
     def _submit(self, piks):
@@ -336,16 +841,40 @@ class TaskManager(object):
         :param acc: the initial value of the accumulator
         :returns: the final value of the accumulator
         """
-        for future in as_completed(self.results):
+        for future in self._gen_completed():
             check_mem_usage()
             # log a warning if too much memory is used
             result = future.result()
+            task_no = self.task_no.pop(future)
             if isinstance(result, BaseException):
                 raise result
-            self.received += len(result)
-            acc = agg(acc, result.unpickle())
+            elif isinstance(result, Pickled):
+                self.received += len(result)
+                self.durations[task_no] = result.duration
+                tracer.extend(result.spans)
+                result = result.unpickle()
+            elif isinstance(result, TimedResult):
+                self.durations[task_no] = result.duration
+            acc = agg(acc, result)
         return acc
 
+    def _gen_completed(self):
+        # yield the futures as they complete; if there are pending tasks,
+        # submit a new one for each completed future
+        if not self.pending:
+            for future in as_completed(self.results):
+                yield future
+            return
+        futures = set(self.results)
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                self.results.remove(future)  # release the memory
+                if self.pending:
+                    self.submit_task(*self.pending.popleft())
+                    futures.add(self.results[-1])
+                yield future
+
     def reduce(self, agg=operator.add, acc=None):
         """
         Loop on a set of results and update the accumulator
@@ -358,7 +887,7 @@ class TaskManager(object):
         if acc is None:
             acc = AccumDict()
         log_percent = log_percent_gen(
-            self.name, len(self.results), self.progress)
+            self.name, len(self.results) + len(self.pending), self.progress)
         log_percent.next()
 
         def agg_and_percent(acc, (val, exc)):
@@ -371,12 +900,25 @@ class TaskManager(object):
         if no_distribute():
             agg_result = reduce(agg_and_percent, self.results, acc)
         else:
-            self.progress('Sent %dM of data', self.sent // ONE_MB)
-            agg_result = self.aggregate_result_set(agg_and_percent, acc)
+            lazy = bool(self.pending)
+            if not lazy:  # all the data has been sent already
+                self._log_sent()
+            try:
+                agg_result = self.aggregate_result_set(agg_and_percent, acc)
+            finally:
+                self.pending.clear()
+                if lazy:
+                    self._log_sent()
+                self.shared.clear()
             self.progress('Received %dM of data', self.received // ONE_MB)
         self.results = []
         return agg_result
 
+    def _log_sent(self):
+        self.progress('Sent %dM of data', self.sent // ONE_MB)
+        if self.shared.nbytes:
+            self.progress('Shared %dM of data', self.shared.nbytes // ONE_MB)
+
     def wait(self):
         """
         Wait until all the task terminate. Discard the results.
@@ -420,9 +962,141 @@ def litetask(func):
             return func(*args)
     wrapped = functools.wraps(func)(lambda *a: safely_call(w, a, pickle=True))
     wrapped.task_func = func
+    wrapped.monitored_func = w
     return wrapped
 
 
+# the memory of the process is measured once every MEMORY_SAMPLING entries
+# in the blocks controlled by a TracingMonitor (0 means never), unless the
+# monitor has the flag measuremem set
+MEMORY_SAMPLING = int(os.environ.get('OQ_MEMORY_SAMPLING', 100))
+
+span_dt = numpy.dtype(
+    [('operation', (str, 50)),
+     ('pid', numpy.uint32),
+     ('start', numpy.float64),
+     ('duration', numpy.float64),
+     ('memory_mb', numpy.float32),
+     ('counts', numpy.uint32)])
+
+
+class Tracer(object):
+    """
+    A buffer of spans, i.e. tuples (operation, pid, start, duration,
+    memory_mb, counts), collected in the current process by the
+    TracingMonitors. The spans collected by a task are sent back to
+    the master together with the result (see :func:`safely_call`) and
+    the master adds them to its own tracer.
+    """
+    def __init__(self):
+        self.spans = []  # tuples
+        self.arrays = []  # arrays of spans received from the workers
+        self._proc = None
+
+    def add(self, span):
+        """Add a span tuple"""
+        self.spans.append(span)
+
+    def extend(self, spans):
+        """Add an array of spans"""
+        if len(spans):
+            self.arrays.append(spans)
+
+    def memory(self):
+        """The resident memory of the current process in bytes"""
+        if self._proc is None or self._proc.pid != os.getpid():
+            self._proc = psutil.Process(os.getpid())
+        return memory_info(self._proc).rss
+
+    def flush(self):
+        """
+        :returns: the buffered spans as an array of dtype span_dt
+        """
+        spans = numpy.array(self.spans, span_dt)
+        del self.spans[:]
+        if self.arrays:
+            spans = numpy.concatenate(self.arrays + [spans])
+            del self.arrays[:]
+        return spans
+
+tracer = Tracer()
+
+
+class TracingMonitor(object):
+    """
+    A monitor with the same interface of :class:`PerformanceMonitor`, but
+    which never writes on the filesystem: at each flush a span with the
+    total time spent in the block (and the number of times the block
+    was entered) is added to the `tracer` of the process. The memory is
+    measured if the flag `measuremem` is set, otherwise only once every
+    MEMORY_SAMPLING entries in the block, so that the monitor can be used
+    in hot loops.
+
+    :param operation: the name of the operation
+    :param autoflush: if set, flush at the exit of each block
+    :param measuremem: if set, measure the memory at each entry and exit
+    """
+    def __init__(self, operation, autoflush=False, measuremem=False):
+        self.operation = operation
+        self.autoflush = autoflush
+        self.measuremem = measuremem
+        self.start = None  # time of the first entry after a flush
+        self.duration = 0
+        self.mem = 0
+        self.counts = 0
+        self._entries = 0  # not reset by flush, used for the sampling
+        self._t0 = None
+        self._mem0 = None
+
+    def __enter__(self):
+        self._t0 = time.time()
+        if self.start is None:
+            self.start = self._t0
+        if self.measuremem or (
+                MEMORY_SAMPLING and self._entries % MEMORY_SAMPLING == 0):
+            self._mem0 = tracer.memory()
+        else:
+            self._mem0 = None
+        return self
+
+    def __exit__(self, etype, exc, tb):
+        self.duration += time.time() - self._t0
+        if self._mem0 is not None:
+            self.mem = max(self.mem, tracer.memory() - self._mem0)
+        self.counts += 1
+        self._entries += 1
+        if self.autoflush:
+            self.flush()
+
+    def flush(self):
+        """
+        Add a span to the tracer and reset the monitor
+        """
+        if self.counts:
+            tracer.add((self.operation, os.getpid(), self.start,
+                        self.duration, self.mem / 1024. / 1024.,
+                        self.counts))
+        self.start = None
+        self.duration = 0
+        self.mem = 0
+        self.counts = 0
+
+    def __call__(self, operation, **kw):
+        """
+        Return a new monitor for a different operation, with the same
+        additional attributes (like .oqparam) of the current one.
+        """
+        new = self.__class__(operation, **kw)
+        for name, value in vars(self).iteritems():
+            if name not in vars(new):
+                setattr(new, name, value)
+        return new
+
+    def __repr__(self):
+        return '<%s %s duration=%s>' % (
+            self.__class__.__name__, self.operation, self.duration)
+
+
 # this is not thread-safe
 class PerformanceMonitor(object):
     """
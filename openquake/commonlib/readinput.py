@@ -546,6 +546,20 @@ def get_imts(oqparam):
     return map(imt.from_string, sorted(oqparam.imtls))
 
 
+def set_table_resolution(vfs, oqparam):
+    """
+    Enable the lookup tables of the vulnerability functions, if
+    the parameter `vulnerability_table_resolution` is set.
+
+    :param vfs: a dictionary loss_type -> vulnerability function
+    :param oqparam:
+        an :class:`openquake.commonlib.oqvalidation.OqParam` instance
+    """
+    if oqparam.vulnerability_table_resolution:
+        for vf in vfs.itervalues():
+            vf.set_table_resolution(oqparam.vulnerability_table_resolution)
+
+
 def get_risk_model(oqparam):
     """
     Return a :class:`openquake.risklib.riskinput.RiskModel` instance
@@ -575,6 +589,8 @@ def get_risk_model(oqparam):
         for (imt_taxo, vf_orig), (imt_taxo_, vf_retro) in \
                 zip(vfs_orig, vfs_retro):
             assert imt_taxo == imt_taxo_  # same imt and taxonomy
+            set_table_resolution(vf_orig, oqparam)
+            set_table_resolution(vf_retro, oqparam)
             risk_models[imt_taxo] = workflows.get_workflow(
                 imt_taxo[0], imt_taxo[1], oqparam,
                 vulnerability_functions_orig=vf_orig,
@@ -582,6 +598,7 @@ def get_risk_model(oqparam):
     else:
         # classical, event based and scenario calculators
         for imt_taxo, vfs in get_vfs(oqparam.inputs).iteritems():
+            set_table_resolution(vfs, oqparam)
             risk_models[imt_taxo] = workflows.get_workflow(
                 imt_taxo[0], imt_taxo[1], oqparam,
                 vulnerability_functions=vfs)
@@ -0,0 +1,220 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2015, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+An executor sending the tasks to worker processes connected via sockets.
+The workers can run on the same machine (they are spawned by the executor
+itself) or on remote machines; in the second case they must be started
+with
+
+  $ python -m openquake.commonlib.socketpool <host>:<port> <authkey>
+
+where <host>:<port> is the address of the executor, which must be
+instantiated with `num_workers=0` and the same `authkey`. When the
+executor is selected with `executor = sockets` in the job.ini file (or
+with OQ_EXECUTOR=sockets) these parameters are read from the variables
+OQ_SOCKETPOOL_ADDRESS (for instance 0.0.0.0:1999), OQ_SOCKETPOOL_AUTHKEY
+and OQ_SOCKETPOOL_WORKERS, see :meth:`SocketPoolExecutor.from_environ`.
+"""
+import os
+import sys
+import logging
+import threading
+import traceback
+import multiprocessing
+from Queue import Queue
+from multiprocessing.connection import Listener, Client
+from concurrent.futures import Executor, Future
+
+
+def parse_address(address):
+    """
+    :param address: a string <host>:<port>
+    :returns: a pair (host, port)
+
+    >>> parse_address('localhost:1999')
+    ('localhost', 1999)
+    """
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def worker(address, authkey):
+    """
+    Connect to the executor and run the tasks received, until a None
+    is received. The results are sent back as pairs (result, error),
+    where error is None or a string with the traceback of the exception,
+    since the exception itself may be not picklable.
+
+    :param address: the address (host, port) of the executor
+    :param authkey: the authentication key of the executor
+    """
+    conn = Client(address, authkey=authkey)
+    try:
+        while True:
+            msg = conn.recv()
+            if msg is None:
+                break
+            func, args, kw = msg
+            try:
+                res = func(*args, **kw), None
+                conn.send(res)
+            except Exception:  # in the function or in pickling the result
+                etype, exc, tb = sys.exc_info()
+                tb_str = ''.join(traceback.format_tb(tb))
+                conn.send((None, '\n%s%s: %s' % (tb_str, etype.__name__, exc)))
+    finally:
+        conn.close()
+
+
+class SocketPoolExecutor(Executor):
+    """
+    An executor sending the submitted functions to worker processes
+    connected via sockets. Functions and arguments must be picklable,
+    as for a ProcessPoolExecutor; moreover the workers may run on
+    different machines, so they must not rely on temporary files.
+
+    :param address: the address (host, port) where to listen
+    :param num_workers: the number of workers to spawn locally
+    :param authkey: the authentication key (random if not given)
+    """
+    remote = True  # the workers may not share the filesystem
+
+    def __init__(self, address=('localhost', 0), num_workers=None,
+                 authkey=None):
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        self.authkey = authkey or os.urandom(20)
+        self.listener = Listener(address, authkey=self.authkey)
+        self.address = self.listener.address
+        self.num_workers = num_workers
+        self._max_workers = num_workers or multiprocessing.cpu_count()
+        self.tasks = Queue()  # (future, func, args, kw) or None
+        self.procs = []
+        self.threads = []
+        self._accepting = None
+
+    @classmethod
+    def from_environ(cls):
+        """
+        Instantiate the executor with the parameters in the variables
+        OQ_SOCKETPOOL_ADDRESS (<host>:<port>, by default localhost and
+        a free port), OQ_SOCKETPOOL_AUTHKEY (random by default) and
+        OQ_SOCKETPOOL_WORKERS (the number of workers to spawn locally,
+        by default one per core; 0 means that the workers are started
+        on remote machines).
+        """
+        address = os.environ.get('OQ_SOCKETPOOL_ADDRESS')
+        workers = os.environ.get('OQ_SOCKETPOOL_WORKERS')
+        authkey = os.environ.get('OQ_SOCKETPOOL_AUTHKEY')
+        num_workers = None if workers is None else int(workers)
+        if num_workers == 0 and not authkey:
+            raise ValueError('The remote workers need OQ_SOCKETPOOL_AUTHKEY')
+        return cls(parse_address(address) if address else ('localhost', 0),
+                   num_workers, authkey)
+
+    def _start(self):
+        # start the workers and the thread accepting their connections
+        for _ in range(self.num_workers):
+            proc = multiprocessing.Process(
+                target=worker, args=(self.address, self.authkey))
+            proc.daemon = True
+            proc.start()
+            self.procs.append(proc)
+        self._accepting = threading.Thread(target=self._accept)
+        self._accepting.daemon = True
+        self._accepting.start()
+
+    def _accept(self):
+        # serve each connected worker in a separate thread
+        while True:
+            try:
+                conn = self.listener.accept()
+            except Exception:  # the listener has been closed
+                break
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _serve(self, conn):
+        # send the tasks to the worker and set the results on the futures
+        try:
+            while True:
+                task = self.tasks.get()
+                if task is None:  # shutdown
+                    conn.send(None)
+                    break
+                future, func, args, kw = task
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    conn.send((func, args, kw))
+                    res, err = conn.recv()
+                except Exception as exc:  # the worker died
+                    future.set_exception(exc)
+                    break
+                if err is None:
+                    future.set_result(res)
+                else:
+                    future.set_exception(RuntimeError(err))
+        finally:
+            conn.close()
+
+    def submit(self, func, *args, **kw):
+        """
+        Send the function and its arguments to the first free worker.
+
+        :returns: a Future object
+        """
+        if self._accepting is None:
+            self._start()
+        future = Future()
+        self.tasks.put((future, func, args, kw))
+        return future
+
+    def shutdown(self, wait=True):
+        """
+        Stop the workers and close the listener
+        """
+        if self._accepting is None:  # never started
+            self.listener.close()
+            return
+        for _ in range(max(len(self.threads), len(self.procs))):
+            self.tasks.put(None)  # one for each worker
+        if wait:
+            for thread in self.threads:
+                thread.join()
+            for proc in self.procs:
+                proc.join()
+        self.listener.close()
+        self._accepting = None
+        self.tasks = Queue()
+        self.threads = []
+        self.procs = []
+
+
+def main(address, authkey):
+    """
+    Start a worker connecting to the executor at the given address
+    """
+    logging.info('Connecting to %s', address)
+    worker(parse_address(address), authkey)
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
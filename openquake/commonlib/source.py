@@ -340,6 +340,26 @@ class RlzsAssoc(collections.Mapping):
                 ad[rlz] = agg(ad[rlz], value)
         return ad
 
+    def gen_curves_by_rlz(self, results, agg, acc):
+        """
+        Same as `combine_curves`, but the curves are generated one
+        realization at the time, so that they do not need to be kept
+        in memory all together.
+
+        :param results: dictionary (trt_model_id, gsim_name) -> curves
+        :param agg: aggregation function (composition of probabilities)
+        :yields: pairs (rlz, aggregated curves) in order of realization
+        """
+        keys_by_rlz = collections.defaultdict(list)
+        for key in results:
+            for rlz in self.rlzs_assoc[key]:
+                keys_by_rlz[rlz].append(key)
+        for rlz in self.realizations:
+            curves = acc
+            for key in keys_by_rlz[rlz]:
+                curves = agg(curves, results[key])
+            yield rlz, curves
+
     def combine_gmfs(self, results):
         """
         :param results: a dictionary (trt_model_id, gsim_name) -> gmf_by_tag
@@ -655,6 +675,21 @@ def _collect_source_model_paths(smlt):
 
 # ########################## SourceProcessor ############################# #
 
+def split_and_weight(src, area_source_discretization):
+    """
+    Split the source and set the `.weight` attribute of the sub sources.
+
+    :param src: a hazardlib source object
+    :param area_source_discretization: area source discretization
+    :returns: a list of sources
+    """
+    out = []
+    for ss in sourceconverter.split_source(src, area_source_discretization):
+        ss.weight = get_weight(ss)
+        out.append(ss)
+    return out
+
+
 def filter_and_split(src, sourceprocessor):
     """
     Filter and split the source by using the source processor.
@@ -675,10 +710,7 @@ def filter_and_split(src, sourceprocessor):
     else:  # only split
         filter_time = 0
     t1 = time.time()
-    out = []
-    for ss in sourceconverter.split_source(src, sourceprocessor.asd):
-        ss.weight = get_weight(ss)
-        out.append(ss)
+    out = split_and_weight(src, sourceprocessor.asd)
     split_time = time.time() - t1
     return SourceInfo(src.trt_model_id, src.source_id,
                       src.__class__.__name__, out, filter_time, split_time)
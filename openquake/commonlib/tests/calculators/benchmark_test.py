@@ -0,0 +1,72 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2015, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks comparing the static and the dynamic scheduling of the tasks
+on the QA tests. They are slow and they only log the timings, so they
+are skipped in the normal test runs; use something like
+
+  $ OQ_BENCHMARK=1 nosetests --nologcapture -a benchmark \
+      openquake/commonlib/tests/calculators
+
+to run them.
+"""
+import logging
+
+import numpy
+from nose.plugins.attrib import attr
+
+from openquake.risklib.tests.utils import benchmark, timeit
+from openquake.commonlib.tests.calculators import CalculatorTestCase
+from openquake.qa_tests_data.classical import case_4, case_5, case_6
+from openquake.qa_tests_data.classical_risk import case_3 as cr_case_3
+from openquake.qa_tests_data.event_based_risk import case_2 as ebr_case_2
+
+
+@attr('slow', 'benchmark')
+@benchmark
+class SchedulingBenchmarkTestCase(CalculatorTestCase):
+
+    def run_scheduling(self, testfile, dynamic):
+        _, wall_time = timeit(
+            self.run_calc, testfile, 'job.ini', dynamic_scheduling=dynamic)
+        durations = numpy.array(self.calc.taskman.durations)
+        durations = durations[~numpy.isnan(durations)]
+        return wall_time, durations
+
+    def compare(self, testfile):
+        logging.info(testfile)
+        for dynamic in ('false', 'true'):
+            wall_time, durations = self.run_scheduling(testfile, dynamic)
+            # throughput in tasks per second, tail latency as the ratio
+            # between the slowest task and the average task
+            logging.info('dynamic=%s: %d tasks, wall time %.2fs, '
+                         '%.1f tasks/s, max/mean task time %.2f',
+                         dynamic, len(durations), wall_time,
+                         len(durations) / wall_time,
+                         durations.max() / durations.mean())
+
+    def test_classical(self):
+        for case in (case_4, case_5, case_6):
+            self.compare(case.__file__)
+
+    def test_classical_risk(self):
+        self.compare(cr_case_3.__file__)
+
+    def test_event_based_risk(self):
+        self.compare(ebr_case_2.__file__)
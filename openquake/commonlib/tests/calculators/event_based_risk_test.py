@@ -1,4 +1,6 @@
 import os
+
+import numpy
 from nose.plugins.attrib import attr
 
 from openquake.commonlib.tests.calculators import CalculatorTestCase
@@ -49,6 +51,21 @@ class EventBasedRiskTestCase(CalculatorTestCase):
         self.assertEqualFiles(
             'expected/rlz-000-structural-event_loss.csv', fname)
 
+    @attr('qa', 'risk', 'event_based_risk')
+    def test_case_2_counts(self):
+        # the loss curves are built from the exceedance counts of the
+        # loss ratios merged from the tasks
+        self.run_calc(case_2.__file__, 'job_haz.ini,job_risk.ini',
+                      concurrent_tasks=0, loss_curves_from_counts='true')
+        dstore = self.calc.datastore
+        values = [a.value('structural') for a in self.calc.assets]
+        for rlz in self.calc.rlzs_assoc.realizations:
+            curves = dstore['/loss_curves-rlzs/%s' % rlz.uid]['structural']
+            numpy.testing.assert_allclose(curves['losses'][:, -1], values)
+            self.assertTrue((numpy.diff(curves['poes'], axis=1) <= 0).all())
+            self.assertTrue((curves['avg'] >= 0).all())
+            self.assertTrue(curves['avg'].any())
+
     @attr('qa', 'risk', 'event_based_risk')
     def test_case_3(self):
         self.assert_stats_ok(case_3)
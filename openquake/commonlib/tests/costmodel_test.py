@@ -0,0 +1,115 @@
+import os
+import shutil
+import operator
+import tempfile
+import unittest
+import collections
+import mock
+import numpy
+from openquake.commonlib import parallel, datastore
+from openquake.commonlib.costmodel import (
+    CostModel, report, read_coeffs, job_fingerprint)
+
+Item = collections.namedtuple('Item', 'kind weight')
+
+
+def process(items):
+    return {'n': len(items)}
+
+
+class CostModelTestCase(unittest.TestCase):
+    items = [Item('A', 1), Item('B', 2), Item('A', 3), Item('B', 1),
+             Item('A', 2), Item('B', 4)]
+    coeffs = {'A': 0.5, 'B': 2.0}
+
+    def new_model(self, coeffs=None):
+        return CostModel(operator.attrgetter('kind'),
+                         operator.attrgetter('weight'), coeffs)
+
+    def test_fit(self):
+        model = self.new_model()
+        chunks = [self.items[:2], self.items[2:4], self.items[4:]]
+        durations = [sum(self.coeffs[i.kind] * i.weight for i in chunk)
+                     for chunk in chunks]
+        task_info = model.get_task_info(chunks, durations)
+        self.assertEqual(list(task_info['task_no']), [0, 0, 1, 1, 2, 2])
+        self.assertEqual(list(task_info['predicted']), [3, 3, 4, 4, 6, 6])
+        coeffs = CostModel.fit(task_info)
+        self.assertAlmostEqual(coeffs['A'], 0.5)
+        self.assertAlmostEqual(coeffs['B'], 2.0)
+        self.assertIn('max/mean', report(task_info))
+
+        # the fitted model predicts exactly the durations
+        new = self.new_model(coeffs).get_task_info(chunks, durations)
+        numpy.testing.assert_allclose(new['predicted'], new['duration'])
+
+    def test_long_kinds(self):
+        # the kinds are not truncated, so that the fitted coefficients
+        # are found by the model
+        kind = 'PointSource/' + 'Active Shallow Crust ' * 5
+        chunks = [[Item(kind, 1)], [Item('B', 2)]]
+        task_info = self.new_model().get_task_info(chunks, [3, 4])
+        self.assertEqual(task_info['kind'][0], kind)
+        coeffs = CostModel.fit(task_info)
+        self.assertAlmostEqual(self.new_model(coeffs)(chunks[0][0]), 3)
+
+    def test_unknown_kind(self):
+        model = self.new_model(self.coeffs)
+        self.assertEqual(model(Item('C', 2)), 2.5)  # average coefficient
+
+    def test_apply_reduce(self):
+        model = self.new_model(self.coeffs)
+        tm = parallel.TaskManager(process)
+        res = tm.apply((self.items,), concurrent_tasks=2, weight=model)
+        self.assertEqual(res, {'n': 6})
+        task_info = model.get_task_info(tm.chunks, tm.durations)
+        self.assertFalse(numpy.isnan(task_info['duration']).any())
+
+
+class ReadCoeffsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def save(self, calc_id, coeffs, fingerprint):
+        model = CostModel(operator.attrgetter('kind'),
+                          operator.attrgetter('weight'))
+        chunks = [CostModelTestCase.items[:3], CostModelTestCase.items[3:]]
+        durations = [sum(coeffs[i.kind] * i.weight for i in chunk)
+                     for chunk in chunks]
+        calc_dir = os.path.join(self.datadir, 'calc_%d' % calc_id)
+        os.mkdir(calc_dir)
+        path = os.path.join(calc_dir, 'output.hdf5')
+        with datastore.h5py.File(path, 'w') as h5:
+            h5['/task_info/process'] = model.get_task_info(chunks, durations)
+            h5['/task_info/process'].attrs['fingerprint'] = fingerprint
+
+    def test_same_job(self):
+        self.save(1, {'A': 0.5, 'B': 2.0}, 'job1')
+        self.save(2, {'A': 1.0, 'B': 1.0}, 'job2')
+        coeffs = read_coeffs('process', 3, 'job1', self.datadir)
+        self.assertAlmostEqual(coeffs['A'], 0.5)
+        self.assertAlmostEqual(coeffs['B'], 2.0)
+        coeffs = read_coeffs('process', 3, 'job2', self.datadir)
+        self.assertAlmostEqual(coeffs['A'], 1.0)
+        # no calculation of a different job is used
+        self.assertEqual(read_coeffs('process', 3, 'job3', self.datadir), {})
+
+    def test_job_fingerprint(self):
+        fname = os.path.join(self.datadir, 'source_model.xml')
+        with open(fname, 'w') as f:
+            f.write('<sourceModel/>')
+        oq = collections.namedtuple('OqParam', 'calculation_mode inputs')
+        fp1 = job_fingerprint(oq('classical', {'source': [fname]}))
+        fp2 = job_fingerprint(oq('event_based', {'source': [fname]}))
+        self.assertNotEqual(fp1, fp2)
+        with open(fname, 'w') as f:
+            f.write('<sourceModel>changed</sourceModel>')
+        fp3 = job_fingerprint(oq('classical', {'source': [fname]}))
+        self.assertNotEqual(fp1, fp3)
+        # the files are read in blocks, with the same result
+        with mock.patch('openquake.commonlib.costmodel.BLOCKSIZE', 3):
+            fp4 = job_fingerprint(oq('classical', {'source': [fname]}))
+        self.assertEqual(fp3, fp4)
@@ -55,6 +55,21 @@ class DataStoreTestCase(unittest.TestCase):
         numpy.testing.assert_equal(
             self.dstore['/dset'][:], [[1, 2], [0, 0], [0, 0], [4, 5]])
 
+        # test extending a dset
+        self.dstore.extend('/extendable', numpy.array([1, 2]))
+        self.dstore.extend('/extendable', numpy.array([3]))
+        numpy.testing.assert_equal(
+            self.dstore['/extendable'][:], [1, 2, 3])
+
         # notice: it is not possible to store non-arrays
         with self.assertRaises(ValueError):
             self.dstore['/key1'] = 'value1'
+
+        # the file can be closed, read by others and opened again
+        self.dstore.close()
+        with h5py.File(self.dstore.hdf5path, 'r') as h5:
+            numpy.testing.assert_equal(h5['/key1'][:], value1)
+        self.dstore.open()
+        self.dstore['/key3'] = numpy.array([3])
+        self.assertEqual(list(self.dstore), ['/dset', '/extendable',
+                                             '/key1', '/key3'])
@@ -1,30 +1,108 @@
+import os
+import shutil
+import logging
+import tempfile
 import unittest
+import mock
 import numpy
+from nose.plugins.attrib import attr
 from openquake.commonlib import parallel
+from openquake.commonlib.socketpool import SocketPoolExecutor
+from openquake.risklib.tests.utils import benchmark, timeit
 
 
 def get_length(data):
     return {'n': len(data)}
 
 
+def get_sum(data, array):
+    return {'n': sum(array[i] for i in data)}
+
+
+def append_and_count(data, lst):
+    lst.append(None)  # modify the argument
+    return {'n': len(lst)}
+
+
+def get_traced_length(data, monitor):
+    for _ in data:
+        with monitor('counting'):
+            pass
+    with monitor('total', autoflush=True):
+        return {'n': len(data)}
+
+
+def raise_unpicklable():
+    exc = ValueError('unpicklable')
+    exc.func = lambda: None
+    raise exc
+
+
+@parallel.litetask
+def count_items(data, monitor):
+    return {'n': len(data)}
+
+
 class TaskManagerTestCase(unittest.TestCase):
     monitor = parallel.DummyMonitor()
 
     def test_apply_reduce(self):
-        res = parallel.apply_reduce(
-            get_length, (numpy.arange(10),), concurrent_tasks=3)
+        tm = parallel.TaskManager(get_length)
+        res = tm.apply((numpy.arange(10),), concurrent_tasks=3)
+        self.assertEqual(res, {'n': 10})
+        self.assertEqual(map(len, tm.chunks), [4, 4, 2])
+        self.assertEqual(len(tm.durations), 3)
+        self.assertEqual(parallel.apply_reduce(
+            get_length, (numpy.arange(10),), concurrent_tasks=3), {'n': 10})
+
+    def test_apply_reduce_max_in_flight(self):
+        tm = parallel.TaskManager(get_length)
+        res = tm.apply((numpy.arange(10),), concurrent_tasks=5,
+                       max_in_flight=2)
         self.assertEqual(res, {'n': 10})
-        self.assertEqual(map(len, parallel.apply_reduce._chunks), [4, 4, 2])
+        self.assertEqual(map(len, tm.chunks), [2, 2, 2, 2, 2])
+
+    def test_apply_reduce_dynamic(self):
+        # only the even numbers can be split
+        halve = lambda n: [n // 2, n // 2] if n % 2 == 0 else [n]
+        tm = parallel.TaskManager(get_length)
+        res = tm.apply(([1, 16, 3, 2, 1],), concurrent_tasks=2,
+                       weight=lambda n: n, split=halve)
+        self.assertEqual(res, {'n': 12})  # 16 has been split in 8 parts
+        chunks = tm.chunks
+        self.assertEqual(sorted(sum(chunks, [])), [1, 1, 2, 2, 2, 2, 2, 2,
+                                                   2, 2, 2, 3])
+        # the chunks are ordered by decreasing weight
+        weights = map(sum, chunks)
+        self.assertEqual(weights, sorted(weights, reverse=True))
+
+    def test_apply_reduce_single_heavy_item(self):
+        # a single heavy item is split too in the dynamic scheduling mode
+        halve = lambda n: [n // 2, n // 2] if n % 2 == 0 else [n]
+        tm = parallel.TaskManager(get_length)
+        res = tm.apply(([16],), concurrent_tasks=2, weight=lambda n: n,
+                       split=halve)
+        self.assertEqual(res, {'n': 8})
+        self.assertEqual(sorted(sum(tm.chunks, [])), [2] * 8)
+        self.assertEqual(len(tm.durations), len(tm.chunks))
+
+    def test_starmap_max_in_flight(self):
+        if parallel.no_distribute():
+            raise unittest.SkipTest('the tasks are not submitted')
+        tm = parallel.starmap(
+            get_length, [(range(n),) for n in range(1, 6)], max_in_flight=2)
+        self.assertEqual(len(tm.results), 2)
+        self.assertEqual(len(tm.pending), 3)
+        self.assertEqual(tm.reduce(), {'n': 15})
+        self.assertEqual(tm.submitted, 5)
 
     # this case is non-trivial since there is a key, so two groups are
     # generated even if everything is run in a single core
     def test_apply_reduce_no_tasks(self):
-        res = parallel.apply_reduce(
-            get_length, ('aaabb',), concurrent_tasks=0,
-            key=lambda char: char)
+        tm = parallel.TaskManager(get_length)
+        res = tm.apply(('aaabb',), concurrent_tasks=0, key=lambda char: char)
         self.assertEqual(res, {'n': 5})
-        self.assertEqual(parallel.apply_reduce._chunks,
-                         [['a', 'a', 'a'], ['b', 'b']])
+        self.assertEqual(tm.chunks, [['a', 'a', 'a'], ['b', 'b']])
 
     def test_spawn(self):
         all_data = [
@@ -35,3 +113,183 @@ class TaskManagerTestCase(unittest.TestCase):
             res[key] = val.reduce()
         parallel.TaskManager.restart()
         self.assertEqual(res, {'a': {'n': 10}, 'c': {'n': 15}, 'b': {'n': 20}})
+
+    def test_shared_arrays(self):
+        array = numpy.arange(200000)  # bigger than SHARED_ARRAY_SIZE
+        res = parallel.apply_reduce(
+            get_sum, (range(10), array), concurrent_tasks=3)
+        self.assertEqual(res, {'n': 45})
+
+        shared = parallel.SharedArrays()
+        piks = parallel.pickle_sequence([array, array[:10]], shared)
+        self.assertLess(len(piks[0]), 1000)  # the array is not pickled
+        self.assertGreater(len(piks[1]), 80)  # small array, pickled
+        numpy.testing.assert_equal(piks[0].unpickle(), array)
+        shared.clear()
+
+    def test_spans(self):
+        parallel.tracer.flush()
+        monitor = parallel.TracingMonitor('get_traced_length')
+        res = parallel.apply_reduce(
+            get_traced_length, (range(10), monitor), concurrent_tasks=3)
+        self.assertEqual(res, {'n': 10})
+        spans = parallel.tracer.flush()
+        # the 'counting' monitors are never flushed
+        self.assertEqual(list(spans['operation']), ['total'] * 3)
+        self.assertEqual(sorted(spans['counts']), [1, 1, 1])
+        self.assertEqual(len(parallel.tracer.flush()), 0)
+
+    def test_cached_pickle(self):
+        obj = range(100000)  # bigger than CACHED_PICKLE_SIZE
+        shared = parallel.SharedArrays()
+        piks = parallel.pickle_sequence([obj], shared)
+        cached = shared.cache(piks[0])
+        self.assertIs(shared.cache(piks[0]), cached)  # saved only once
+        self.assertLess(len(cached), 200)
+        self.assertEqual(cached.unpickle(), obj)
+        self.assertIs(cached.unpickle(), cached.unpickle())  # from the cache
+        shared.clear()
+
+        res = parallel.apply_reduce(
+            get_sum, (range(10), parallel.cached(obj)), concurrent_tasks=3)
+        self.assertEqual(res, {'n': 45})
+
+        # the size in the cache includes the shared arrays
+        array = numpy.arange(200000)  # bigger than SHARED_ARRAY_SIZE
+        obj = (range(100000), array, array)
+        piks = parallel.pickle_sequence([obj], shared)
+        self.assertEqual(piks[0].shared_nbytes, array.nbytes)
+        cached = shared.cache(piks[0])
+        self.assertEqual(cached.size, len(piks[0]) + array.nbytes)
+        shared.clear()
+
+        # the monitors are never cached
+        with self.assertRaises(TypeError):
+            parallel.cached(parallel.TracingMonitor('task'))
+
+    def test_mutated_argument(self):
+        # a big argument not marked as cached is sent afresh to each task,
+        # so a task modifying it does not affect the others
+        if parallel.no_distribute():
+            raise unittest.SkipTest('the arguments are not pickled')
+        obj = range(100000)  # bigger than CACHED_PICKLE_SIZE
+        tm = parallel.starmap(append_and_count, [(i, obj) for i in range(6)])
+        self.assertFalse(tm.shared.cached)
+        self.assertEqual(tm.reduce(), {'n': 6 * 100001})
+        self.assertEqual(len(obj), 100000)  # unchanged in the master
+
+
+class ExecutorTestCase(unittest.TestCase):
+    def check(self, name):
+        if parallel.no_distribute():
+            raise unittest.SkipTest('the executors are not used')
+        parallel.TaskManager.set_executor(name)
+        try:
+            self.assertEqual(parallel.TaskManager.executor.name, name)
+            res = parallel.apply_reduce(
+                get_sum, (range(10), range(10)), concurrent_tasks=3)
+            self.assertEqual(res, {'n': 45})
+            with self.assertRaises(RuntimeError):  # the task fails
+                parallel.apply_reduce(
+                    get_sum, (range(10), range(5)), concurrent_tasks=3)
+        finally:
+            parallel.TaskManager.set_executor('')  # the default
+
+    def test_threads(self):
+        self.check('threads')
+
+    def test_threads_monitor(self):
+        # the tasks running in threads are wrapped by the 'total' monitor
+        if parallel.no_distribute():
+            raise unittest.SkipTest('the executors are not used')
+        parallel.TaskManager.set_executor('threads')
+        try:
+            parallel.tracer.flush()
+            tm = parallel.starmap(
+                count_items, [(range(i), parallel.TracingMonitor('tm'))
+                              for i in range(3)])
+            self.assertEqual(tm.reduce(), {'n': 3})
+            self.assertFalse(numpy.isnan(tm.durations).any())
+            spans = parallel.tracer.flush()
+            self.assertEqual(list(spans['operation']),
+                             ['total count_items'] * 3)
+        finally:
+            parallel.TaskManager.set_executor('')  # the default
+
+    def test_lazy_executor(self):
+        # the executor is instantiated at the first starmap
+        if parallel.no_distribute():
+            raise unittest.SkipTest('the executors are not used')
+        if parallel.TaskManager.executor is not None:
+            parallel.TaskManager.executor.shutdown()
+            parallel.TaskManager.executor = None
+        tm = parallel.starmap(get_length, [(range(4),)])
+        self.assertIsNotNone(parallel.TaskManager.executor)
+        self.assertEqual(tm.reduce(), {'n': 4})
+
+    def test_sockets(self):
+        self.check('sockets')
+
+    def test_sockets_unpicklable_error(self):
+        # the worker survives an exception which cannot be pickled
+        executor = SocketPoolExecutor(num_workers=1)
+        try:
+            with self.assertRaises(RuntimeError):
+                executor.submit(raise_unpicklable).result()
+            self.assertEqual(executor.submit(len, 'abc').result(), 3)
+        finally:
+            executor.shutdown()
+
+    def test_sockets_from_environ(self):
+        env = dict(OQ_SOCKETPOOL_ADDRESS='localhost:0',
+                   OQ_SOCKETPOOL_WORKERS='0')
+        with mock.patch.dict(os.environ, env):
+            with self.assertRaises(ValueError):  # missing authkey
+                SocketPoolExecutor.from_environ()
+            with mock.patch.dict(os.environ, OQ_SOCKETPOOL_AUTHKEY='key'):
+                executor = SocketPoolExecutor.from_environ()
+        try:
+            self.assertEqual(executor.authkey, 'key')
+            self.assertEqual(executor.num_workers, 0)
+            self.assertEqual(executor.address[0], '127.0.0.1')
+        finally:
+            executor.shutdown()
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            parallel.get_executor('celery')
+
+
+@attr('slow', 'benchmark')
+@benchmark
+class TracingBenchmarkTestCase(unittest.TestCase):
+    # the overhead per span of the monitors, in microseconds
+    N = 10000
+
+    def spans(self, monitor):
+        for _ in xrange(self.N):
+            with monitor:
+                pass
+            monitor.flush()
+
+    def overhead(self, monitor):
+        _, duration = timeit(self.spans, monitor)
+        return duration / self.N * 1E6
+
+    def test_overhead(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            csv = parallel.PerformanceMonitor(
+                'csv', monitor_csv=os.path.join(tmpdir, 'perf.csv'))
+            times = [
+                ('PerformanceMonitor', self.overhead(csv)),
+                ('TracingMonitor', self.overhead(
+                    parallel.TracingMonitor('span'))),
+                ('TracingMonitor(measuremem=True)', self.overhead(
+                    parallel.TracingMonitor('span', measuremem=True)))]
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(len(parallel.tracer.flush()), 2 * self.N)
+        for name, usec in times:
+            logging.info('%s: %.1f us per span', name, usec)
+        self.assertLess(times[1][1], times[0][1])
@@ -0,0 +1,368 @@
+# coding=utf-8
+# Copyright (c) 2015, GEM Foundation.
+#
+# OpenQuake Risklib is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# OpenQuake Risklib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with OpenQuake Risklib. If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+Microbenchmarks comparing the vectorized kernels of risklib with the
+straightforward implementations they replace. They are slow, so they
+are skipped in the normal test runs; use something like
+
+  $ OQ_BENCHMARK=1 nosetests --nologcapture \
+      openquake/risklib/qa_tests/benchmark_test.py
+
+to run them and see the timings.
+"""
+import logging
+import functools
+
+import numpy
+from nose.plugins.attrib import attr
+
+from openquake.baselib.performance import DummyMonitor
+from openquake.risklib import scientific, utils, workflows, riskinput
+from openquake.risklib.tests.utils import (
+    BenchmarkTestCase, timeit, log_speedup)
+
+
+@attr('slow', 'benchmark')
+class LossCurvesBenchmarkTestCase(BenchmarkTestCase):
+    # N assets, E losses, C points per curve
+    N, E, C = 20000, 1000000, 50
+    tses, time_span = 10000, 50
+
+    def setUp(self):
+        rng = numpy.random.RandomState(42)
+        self.ordinals = numpy.sort(rng.randint(0, self.N, self.E))
+        self.losses = rng.lognormal(size=self.E)
+
+    def per_asset_loop(self):
+        # the approach used in EventBasedRiskCalculator.build_loss_curves
+        # before the introduction of scientific.event_based_curves
+        dt = numpy.dtype([('losses', (float, self.C)),
+                          ('poes', (float, self.C)), ('avg', float)])
+        lcs = numpy.zeros(self.N, dt)
+        start = numpy.searchsorted(self.ordinals, numpy.arange(self.N))
+        stop = numpy.append(start[1:], self.E)
+        for ordinal, i1, i2 in zip(range(self.N), start, stop):
+            if i2 > i1:
+                losses, poes = scientific.event_based(
+                    self.losses[i1:i2], self.tses, self.time_span, self.C)
+                lcs[ordinal] = (losses, poes, scientific.average_loss(
+                    (losses, poes)))
+        return lcs
+
+    def test_event_based_curves(self):
+        old, new = self.compare(
+            'event_based_curves', self.per_asset_loop, functools.partial(
+                scientific.event_based_curves, self.ordinals, self.losses,
+                self.N, self.tses, self.time_span, self.C))
+        numpy.testing.assert_equal(new['losses'], old['losses'])
+        numpy.testing.assert_equal(new['poes'], old['poes'])
+        numpy.testing.assert_allclose(new['avg'], old['avg'])
+
+
+@attr('slow', 'benchmark')
+class ExceedanceCountsBenchmarkTestCase(BenchmarkTestCase):
+    # N assets, R events, C points per curve; the full loss matrix
+    # would take 8 GB, so it is generated and processed in blocks
+    N, R, C = 100000, 10000, 50
+    block_size = 1000
+    tses, time_span = 10000, 50
+
+    def gen_loss_matrices(self):
+        rng = numpy.random.RandomState(42)
+        for start in range(0, self.N, self.block_size):
+            size = min(self.block_size, self.N - start)
+            yield rng.uniform(size=(size, self.R))
+
+    def per_asset_counts(self, builder, loss_matrix):
+        # the approach used in CurveBuilder.build_counts before the
+        # vectorization
+        counts = numpy.zeros((len(loss_matrix), self.C), numpy.uint32)
+        for i, loss_ratios in enumerate(loss_matrix):
+            counts[i, :] = numpy.array([(loss_ratios > ratio).sum()
+                                        for ratio in builder.ratios])
+        return counts
+
+    def per_asset_curves(self, loss_matrix):
+        # the approach used in scientific.event_based before the
+        # vectorization, called on each asset
+        curves = []
+        for loss_values in loss_matrix:
+            reference_losses = numpy.linspace(
+                0, numpy.max(loss_values), self.C)
+            times = [(loss_values > loss).sum() for loss in reference_losses]
+            rates_of_exceedance = numpy.array(times) / float(self.tses)
+            poes = 1. - numpy.exp(-rates_of_exceedance * self.time_span)
+            curves.append([reference_losses, poes])
+        return numpy.array(curves)
+
+    def test_build_counts(self):
+        builder = scientific.CurveBuilder(self.C)
+        old_time = new_time = 0
+        for loss_matrix in self.gen_loss_matrices():
+            old, dt = timeit(self.per_asset_counts, builder, loss_matrix)
+            old_time += dt
+            new, dt = timeit(builder.build_counts, loss_matrix)
+            new_time += dt
+            numpy.testing.assert_equal(new, old)
+        log_speedup('build_counts', old_time, new_time)
+        self.assertLess(new_time, old_time)
+
+    def test_event_based(self):
+        old_time = new_time = 0
+        for loss_matrix in self.gen_loss_matrices():
+            old, dt = timeit(self.per_asset_curves, loss_matrix)
+            old_time += dt
+            new, dt = timeit(scientific.event_based, loss_matrix,
+                             self.tses, self.time_span, self.C)
+            new_time += dt
+            numpy.testing.assert_equal(new, old)
+        log_speedup('event_based', old_time, new_time)
+        self.assertLess(new_time, old_time)
+
+
+@attr('slow', 'benchmark')
+class ApplyToBenchmarkTestCase(BenchmarkTestCase):
+    # N assets, R events
+    N, R = 20000, 100
+
+    def setUp(self):
+        rng = numpy.random.RandomState(42)
+        self.vf = scientific.VulnerabilityFunction(
+            'VF', 'PGA', [0.1, 0.2, 0.3, 0.5, 0.7],
+            [0.05, 0.1, 0.2, 0.4, 0.6], [0.1, 0.2, 0.3, 0.1, 0.2])
+        self.gmvs = rng.uniform(0, 0.9, (self.N, self.R))
+        self.epsilons = rng.normal(size=(self.N, self.R))
+
+    def per_asset_loop(self):
+        # the approach used in VulnerabilityFunction.apply_to before
+        # the vectorization
+        self.vf.set_distribution(self.epsilons)
+        return numpy.array([self.vf._apply(row) for row in self.gmvs])
+
+    def test_apply_to(self):
+        old, new = self.compare(
+            'apply_to', self.per_asset_loop,
+            functools.partial(self.vf.apply_to, self.gmvs, self.epsilons))
+        numpy.testing.assert_equal(new, old)
+
+
+@attr('slow', 'benchmark')
+class LookupTableBenchmarkTestCase(ApplyToBenchmarkTestCase):
+    N, R = 20000, 1000
+    resolution = 1001
+
+    def test_apply_to(self):
+        exact, old_time = timeit(self.vf.apply_to, self.gmvs, self.epsilons)
+        self.vf.set_table_resolution(self.resolution)
+        approx, new_time = timeit(
+            self.vf.apply_to, self.gmvs, self.epsilons)
+        log_speedup('lookup table', old_time, new_time)
+        logging.info('max error: %s', numpy.abs(approx - exact).max())
+        numpy.testing.assert_allclose(approx, exact, atol=1E-2)
+        self.assertLess(new_time, old_time)
+
+
+@attr('slow', 'benchmark')
+class ClassicalBenchmarkTestCase(BenchmarkTestCase):
+    # N hazard curves with L levels
+    N, L = 20000, 20
+    steps = 5
+    poes = [0.1, 0.02]
+
+    def setUp(self):
+        rng = numpy.random.RandomState(42)
+        imls = numpy.linspace(0.01, 1.5, self.L)
+        self.vf = scientific.VulnerabilityFunction(
+            'VF', 'PGA', [0.1, 0.2, 0.3, 0.5, 0.7],
+            [0.05, 0.1, 0.2, 0.4, 0.6], [0.1, 0.2, 0.3, 0.1, 0.2])
+        self.workflow = workflows.Classical(
+            'PGA', 'tax', dict(structural=self.vf), dict(PGA=imls),
+            self.steps, self.poes, [])
+        self.hazard_curves = numpy.sort(
+            rng.uniform(size=(self.N, self.L)), axis=1)[:, ::-1]
+
+    def per_asset_loop(self):
+        # the approach used in workflows.Classical before the batching
+        imls = self.workflow.hazard_imls
+        curves = utils.numpy_map(
+            lambda hc: scientific.classical(self.vf, imls, hc, self.steps),
+            self.hazard_curves)
+        average_losses = utils.numpy_map(scientific.average_loss, curves)
+        maps = scientific.loss_map_matrix(self.poes, curves)
+        return curves, average_losses, maps
+
+    def test_classical(self):
+        (curves, average_losses, maps), out = self.compare(
+            'classical', self.per_asset_loop, functools.partial(
+                self.workflow, 'structural', [None] * self.N,
+                self.hazard_curves))
+        numpy.testing.assert_allclose(out.loss_curves, curves, atol=1E-12)
+        numpy.testing.assert_allclose(
+            out.average_losses, average_losses, atol=1E-12)
+        numpy.testing.assert_allclose(out.loss_maps, maps, atol=1E-12)
+
+
+@attr('slow', 'benchmark')
+class LossMapBenchmarkTestCase(BenchmarkTestCase):
+    # N curves with C points
+    N, C = 100000, 50
+    poes = [0.1, 0.02, 0.01]
+
+    def setUp(self):
+        rng = numpy.random.RandomState(42)
+        losses = numpy.sort(rng.uniform(size=(self.N, self.C)), axis=1)
+        poes = numpy.sort(rng.uniform(size=(self.N, self.C)), axis=1)
+        self.curves = numpy.array([losses, poes[:, ::-1]]).transpose(1, 0, 2)
+
+    def per_curve_loop(self):
+        # the approach used in loss_map_matrix before the vectorization
+        return numpy.array(
+            [[scientific.conditional_loss_ratio(curve[0], curve[1], poe)
+              for curve in self.curves] for poe in self.poes])
+
+    def test_loss_map_matrix(self):
+        old, new = self.compare(
+            'loss_map_matrix', self.per_curve_loop, functools.partial(
+                scientific.loss_map_matrix, self.poes, self.curves))
+        numpy.testing.assert_equal(new, old)
+
+
+@attr('slow', 'benchmark')
+class QuantileBenchmarkTestCase(BenchmarkTestCase):
+    # R realizations, M curve points
+    R, M = 20, 500000
+
+    def setUp(self):
+        rng = numpy.random.RandomState(42)
+        self.curves = rng.uniform(size=(self.R, self.M))
+        self.weights = rng.uniform(size=self.R)
+        self.weights /= self.weights.sum()
+
+    def per_point_loop(self, quantile):
+        # the approach used in quantile_curve before the vectorization
+        result = []
+        for poes in self.curves.T:
+            idxs = numpy.argsort(poes)
+            result.append(numpy.interp(
+                quantile, numpy.cumsum(self.weights[idxs]), poes[idxs]))
+        return numpy.array(result)
+
+    def test_quantile_curve(self):
+        old, new = self.compare(
+            'quantile_curve', functools.partial(self.per_point_loop, 0.15),
+            functools.partial(
+                scientific.quantile_curve, self.curves, 0.15, self.weights))
+        numpy.testing.assert_equal(new, old)
+
+
+@attr('slow', 'benchmark')
+class EquicorrelatedBenchmarkTestCase(BenchmarkTestCase):
+    # N assets, S samples
+    N, S = 2000, 100
+    correlation = 0.5
+
+    def multivariate_normal(self):
+        # the approach used in make_epsilons before the low-rank sampler
+        covariance_matrix = (
+            numpy.ones((self.N, self.N)) * self.correlation +
+            numpy.diag(numpy.ones(self.N)) * (1 - self.correlation))
+        return numpy.random.multivariate_normal(
+            numpy.zeros(self.N), covariance_matrix, self.S).transpose()
+
+    def test_make_epsilons(self):
+        zeros = numpy.zeros((self.N, self.S))
+        old, new = self.compare(
+            'make_epsilons', self.multivariate_normal, functools.partial(
+                scientific.make_epsilons, zeros, 42, self.correlation))
+        self.assertEqual(new.shape, old.shape)
+
+    def test_linear_scaling(self):
+        # the time per asset must not grow with the number of assets
+        times = []
+        for num_assets in (10000, 100000, 1000000):
+            groups = numpy.arange(num_assets) % 100  # 100 blocks
+            sampler = scientific.EquicorrelatedSampler(
+                groups, self.correlation)
+            _, time = timeit(sampler.sample, 10, 42)
+            times.append(time)
+            logging.info('%d assets: %.3fs', num_assets, time)
+        self.assertLess(times[2] / times[1], 20)
+
+
+class FakeWorkflow(object):
+    # a workflow returning the number of assets it receives
+    def gen_out_by_rlz(self, assets, hazards, epsilons, eids):
+        yield len(assets)
+
+
+class FakeRiskInput(object):
+    def __init__(self, imt_taxonomies, assets, hazards, epsilons):
+        self.imt_taxonomies = imt_taxonomies
+        self.assets_by_site = [assets]
+        self.hazards = hazards
+        self.epsilons = epsilons
+        self.eids = None
+
+    def get_all(self, rlzs_assoc, assets_by_site):
+        return self.assets_by_site[0], self.hazards, self.epsilons
+
+
+@attr('slow', 'benchmark')
+class GenOutputsBenchmarkTestCase(BenchmarkTestCase):
+    # N assets, T taxonomies
+    N, T = 10000, 1000
+
+    def setUp(self):
+        rng = numpy.random.RandomState(42)
+        taxonomies = ['taxo-%d' % i for i in range(self.T)]
+        self.assets = [
+            workflows.Asset('a%d' % i, taxonomies[t], 1, (0, 0),
+                            dict(structural=1))
+            for i, t in enumerate(rng.randint(0, self.T, self.N))]
+        self.hazards = [dict(PGA=i) for i in range(self.N)]
+        self.epsilons = [None] * self.N
+        self.riskmodel = riskinput.RiskModel(
+            {('PGA', taxo): FakeWorkflow() for taxo in taxonomies})
+        self.riskinput = FakeRiskInput(
+            [('PGA', sorted(taxonomies))], self.assets, self.hazards,
+            self.epsilons)
+
+    def per_taxonomy_filter(self):
+        # the approach used in RiskModel.gen_outputs before the grouping
+        counts = []
+        for imt, taxonomies in self.riskinput.imt_taxonomies:
+            for taxonomy in taxonomies:
+                assets, hazards, epsilons = [], [], []
+                for asset, hazard, epsilon in zip(
+                        self.assets, self.hazards, self.epsilons):
+                    if asset.taxonomy == taxonomy:
+                        assets.append(asset)
+                        hazards.append(hazard[imt])
+                        epsilons.append(epsilon)
+                if assets:
+                    counts.extend(self.riskmodel[imt, taxonomy].gen_out_by_rlz(
+                        assets, hazards, epsilons, None))
+        return counts
+
+    def test_gen_outputs(self):
+        old, new = self.compare(
+            'gen_outputs', self.per_taxonomy_filter,
+            lambda: list(self.riskmodel.gen_outputs(
+                [self.riskinput], None, DummyMonitor())))
+        self.assertEqual(new, old)
+        self.assertEqual(sum(new), self.N)
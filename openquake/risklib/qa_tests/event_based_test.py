@@ -100,7 +100,7 @@ class EventBasedTestCase(unittest.TestCase):
         losses_poes = scientific.event_based(loss_matrix[0], 120, 30, 4)
         first_curve_integral = scientific.average_loss(losses_poes)
 
-        self.assertAlmostEqual(0.48983614471, first_curve_integral)
+        self.assertAlmostEqual(0.507613151941, first_curve_integral)
 
         wf = workflows.ProbabilisticEventBased(
             'PGA', 'SOME-TAXONOMY',
@@ -116,11 +116,11 @@ class EventBasedTestCase(unittest.TestCase):
         out = wf(self.loss_type, assets, gmvs, epsilons, [1, 2, 3, 4, 5])
         self.assert_similar(
             out.event_loss_table,
-            {1: 15.332714802464356,
-             2: 16.21582466071975,
-             3: 15.646630129345354,
-             4: 15.285164778325353,
-             5: 15.860930792931873,
+            {1: 16.679272161045272,
+             2: 15.051601800167642,
+             3: 15.652579361723621,
+             4: 16.035053175154047,
+             5: 16.39442511972413,
              })
 
     def test_mean_based_with_perfect_correlation(self):
@@ -141,7 +141,7 @@ class EventBasedTestCase(unittest.TestCase):
 
         first_curve_integral = scientific.average_loss(losses_poes)
 
-        self.assertAlmostEqual(0.483041416, first_curve_integral)
+        self.assertAlmostEqual(0.496763562, first_curve_integral)
 
         wf = workflows.ProbabilisticEventBased(
             'PGA', 'SOME-TAXONOMY',
@@ -157,11 +157,11 @@ class EventBasedTestCase(unittest.TestCase):
         out = wf(self.loss_type, assets, gmvs, epsilons, [1, 2, 3, 4, 5])
         self.assert_similar(
             out.event_loss_table,
-            {1: 15.232320555463319,
-             2: 16.248173683693864,
-             3: 15.583030510462981,
-             4: 15.177382760499968,
-             5: 15.840499250058254,
+            {1: 16.70974861167423,
+             2: 15.034515671328784,
+             3: 15.838894364889676,
+             4: 15.80964007143653,
+             5: 16.545999634420255,
              })
 
     def test_mean_based(self):
@@ -23,10 +23,9 @@ import collections
 
 import numpy
 
-from openquake.baselib.general import groupby, split_in_blocks_2
+from openquake.baselib.general import groupby, split_in_blocks
 from openquake.baselib.performance import DummyMonitor
-from openquake.hazardlib.gsim.base import gsim_imt_dt
-from openquake.risklib import scientific
+from openquake.risklib import utils, scientific, workflows
 
 
 def sorted_assets(assets_by_site):
@@ -59,8 +58,10 @@ def build_asset_collection(assets_by_site):
 
     limits = ['insurance_limit~%s' % name for name in limit_d]
     retrofittings = ['retrofitted~%s' % n for n in retrofitting_d]
+    id_len = max(len(asset.id) for assets in assets_by_site
+                 for asset in assets)
     asset_dt = numpy.dtype(
-        [('asset_ref', '|S20'), ('site_id', numpy.uint32)] +
+        [('asset_ref', (str, id_len)), ('site_id', numpy.uint32)] +
         [(name, float) for name in
          loss_types + deductibles + limits + retrofittings])
     num_assets = sum(len(assets) for assets in assets_by_site)
@@ -153,28 +154,30 @@ class RiskModel(collections.Mapping):
 
     def build_inputs_from_ruptures(self, sitecol, all_ruptures,
                                    gsims_by_col, trunc_level, correl_model,
-                                   eps_dict, hint):
+                                   epsilon_provider, hint):
         """
         :param sitecol: a SiteCollection instance
-        :param all_ruptures: the complete list of SESRupture instances
+        :param all_ruptures: the complete list of SESRupture instances,
+                             ordered by tag
         :param gsims_by_col: a dictionary of GSIM instances
         :param trunc_level: the truncation level (or None)
         :param correl_model: the correlation model (or None)
-        :param eps_dict: a dictionary asset_ref -> epsilon array
+        :param epsilon_provider:
+            a CounterEpsilonProvider or an EpsilonStore instance
         :param hint: hint for how many blocks to generate
 
         Yield :class:`RiskInputFromRuptures` instances.
         """
         imt_taxonomies = list(self.get_imt_taxonomies())
-        num_epsilons = len(eps_dict.itervalues().next())
+        for ordinal, ses_rupture in enumerate(all_ruptures):
+            ses_rupture.ordinal = ordinal
         by_col = operator.attrgetter('col_id')
-        for ses_ruptures, indices in split_in_blocks_2(
-                all_ruptures, range(num_epsilons), hint or 1, key=by_col):
+        for ses_ruptures in split_in_blocks(
+                all_ruptures, hint or 1, key=by_col):
             gsims = gsims_by_col[ses_ruptures[0].col_id]
-            edic = {asset: eps[indices] for asset, eps in eps_dict.iteritems()}
             yield RiskInputFromRuptures(
                 imt_taxonomies, sitecol, ses_ruptures,
-                gsims, trunc_level, correl_model, edic)
+                gsims, trunc_level, correl_model, epsilon_provider)
 
     def gen_outputs(self, riskinputs, rlzs_assoc, monitor):
         """
@@ -190,27 +193,44 @@ class RiskModel(collections.Mapping):
         mon_risk = monitor('computing individual risk', autoflush=False)
         for riskinput in riskinputs:
             try:
-                assets_by_site = riskinput.assets_by_site
+                args = (riskinput.assets_by_site,)
             except AttributeError:  # for event_based_risk
-                assets_by_site = monitor.assets_by_site
+                args = (monitor.assetcol,
+                        getattr(monitor, 'epsilon_store', None))
             with mon_hazard:
                 # get assets, hazards, epsilons
-                a, h, e = riskinput.get_all(rlzs_assoc, assets_by_site)
+                a, h, e = riskinput.get_all(rlzs_assoc, *args)
             with mon_risk:
+                # sort the assets by taxonomy, so that each workflow
+                # gets contiguous slices of assets, hazards and epsilons
+                if isinstance(a, workflows.AssetCollection):
+                    order, slices = utils.sorted_slices(a.taxonomy_indices)
+                    slices = {a.taxonomies[t]: slc
+                              for t, slc in slices.iteritems()}
+                    a = a[order]
+                else:
+                    order, slices = utils.sorted_slices(
+                        [asset.taxonomy for asset in a])
+                    a = [a[i] for i in order]
+                if isinstance(h, HazardMatrices):
+                    h = h[order]
+                else:
+                    h = [h[i] for i in order]
+                e = (e[order] if isinstance(e, numpy.ndarray)
+                     else [e[i] for i in order])
                 # compute the outputs by using the worklow
                 for imt, taxonomies in riskinput.imt_taxonomies:
                     for taxonomy in taxonomies:
-                        assets, hazards, epsilons = [], [], []
-                        for asset, hazard, epsilon in zip(a, h, e):
-                            if asset.taxonomy == taxonomy:
-                                assets.append(asset)
-                                hazards.append(hazard[imt])
-                                epsilons.append(epsilon)
-                        if not assets:
+                        slc = slices.get(taxonomy)
+                        if slc is None:
                             continue
+                        if isinstance(h, HazardMatrices):
+                            hazards = h[slc].get(imt)
+                        else:
+                            hazards = [haz[imt] for haz in h[slc]]
                         workflow = self[imt, taxonomy]
                         for out_by_rlz in workflow.gen_out_by_rlz(
-                                assets, hazards, epsilons, riskinput.tags):
+                                a[slc], hazards, e[slc], riskinput.eids):
                             yield out_by_rlz
         mon_hazard.flush()
         mon_risk.flush()
@@ -242,7 +262,7 @@ class RiskInput(object):
                 taxonomies.add(asset.taxonomy)
             self.weight += len(assets)
         self.taxonomies = sorted(taxonomies)
-        self.tags = None  # for API compatibility with RiskInputFromRuptures
+        self.eids = None  # for API compatibility with RiskInputFromRuptures
         self.eps_dict = eps_dict or {}
 
     @property
@@ -250,6 +270,34 @@ class RiskInput(object):
         """Return a list of pairs (imt, taxonomies) with a single element"""
         return [(self.imt, self.taxonomies)]
 
+    def split(self, num_blocks=2):
+        """
+        Split the riskinput in blocks of sites with (approximately)
+        the same number of assets.
+
+        :param num_blocks: the number of blocks to generate
+        :returns: a list of RiskInput instances
+        """
+        weights = numpy.array([len(assets) for assets in self.assets_by_site])
+        if len(weights) < 2:
+            return [self]
+        cumweights = numpy.cumsum(weights)
+        targets = cumweights[-1] * numpy.arange(1, num_blocks) / float(
+            num_blocks)
+        # cut each block at the site closer to the target weight
+        idx = numpy.searchsorted(cumweights, targets)
+        prev = numpy.where(idx > 0, cumweights[idx - 1], 0)
+        cuts = numpy.where(targets - prev < cumweights[idx] - targets,
+                           idx, idx + 1)
+        out = []
+        for sl in numpy.split(numpy.arange(len(weights)), cuts):
+            if len(sl) and weights[sl].sum():
+                out.append(RiskInput(
+                    self.imt_taxonomies,
+                    [self.hazard_by_site[i] for i in sl],
+                    [self.assets_by_site[i] for i in sl], self.eps_dict))
+        return out
+
     def get_all(self, rlzs_assoc, assets_by_site=None):
         """
         :returns:
@@ -314,6 +362,42 @@ def expand(array, N):
     return numpy.array([array[i % n] for i in xrange(N)])
 
 
+class HazardMatrices(object):
+    """
+    The ground motion values of a block of ruptures for a set of assets.
+    The values are stored only once per site, in matrices sites x ruptures
+    (one for each GSIM and IMT), together with the row of the site of each
+    asset. Indexing returns the HazardMatrices of a subset of the assets.
+
+    :param gmvs: a dictionary (gsim, imt) -> array S x R
+    :param rlzs_by_gsim: a dictionary gsim -> realizations
+    :param rows: an array with the row of the site of each asset
+    """
+    def __init__(self, gmvs, rlzs_by_gsim, rows):
+        self.gmvs = gmvs
+        self.rlzs_by_gsim = rlzs_by_gsim
+        self.rows = rows
+
+    def get(self, imt):
+        """
+        :param imt: an intensity measure type
+        :returns: a dictionary rlz -> array assets x ruptures
+        """
+        dic = {}
+        for gsim, rlzs in self.rlzs_by_gsim.iteritems():
+            matrix = self.gmvs[gsim, imt][self.rows]
+            for rlz in rlzs:
+                dic[rlz] = matrix  # shared by the realizations of the gsim
+        return dic
+
+    def __getitem__(self, indices):
+        return self.__class__(
+            self.gmvs, self.rlzs_by_gsim, self.rows[indices])
+
+    def __len__(self):
+        return len(self.rows)
+
+
 class RiskInputFromRuptures(object):
     """
     Contains all the assets associated to the given IMT and a subsets of
@@ -326,10 +410,11 @@ class RiskInputFromRuptures(object):
     :param gsims: list of GSIM instances
     :param trunc_level: truncation level for the GSIMs
     :param correl_model: correlation model for the GSIMs
-    :params eps_dict: a dictionary asset_id -> epsilons
+    :param epsilon_provider:
+        a CounterEpsilonProvider giving the epsilons of the assets
     """
     def __init__(self, imt_taxonomies, sitecol, ses_ruptures,
-                 gsims, trunc_level, correl_model, eps_dict):
+                 gsims, trunc_level, correl_model, epsilon_provider):
         self.imt_taxonomies = imt_taxonomies
         self.sitecol = sitecol
         self.ses_ruptures = numpy.array(ses_ruptures)
@@ -338,7 +423,7 @@ class RiskInputFromRuptures(object):
         self.trunc_level = trunc_level
         self.correl_model = correl_model
         self.weight = len(ses_ruptures)
-        self.eps_dict = eps_dict
+        self.epsilon_provider = epsilon_provider
         self.imts = sorted(set(imt for imt, _ in imt_taxonomies))
 
     @property
@@ -350,47 +435,84 @@ class RiskInputFromRuptures(object):
         """
         return [sr.tag for sr in self.ses_ruptures]
 
-    def compute_expand_gmfs(self):
+    @property
+    def eids(self):
         """
         :returns:
-            an array R x N where N is the number of sites and
-            R is the number of ruptures.
+            an array with the ordinals of the underlying ruptures, i.e.
+            their positions in the complete list of ruptures sorted by tag
+        """
+        return numpy.array([sr.ordinal for sr in self.ses_ruptures])
+
+    def split(self, num_blocks=2):
+        """
+        Split the riskinput in blocks of ruptures; the epsilons
+        do not need to be split, since they are indexed by event ordinal.
+
+        :param num_blocks: the number of blocks to generate
+        :returns: a list of RiskInputFromRuptures instances
+        """
+        num_ruptures = len(self.ses_ruptures)
+        if num_ruptures < 2:
+            return [self]
+        out = []
+        for sl in numpy.array_split(numpy.arange(num_ruptures), num_blocks):
+            if len(sl):
+                out.append(self.__class__(
+                    self.imt_taxonomies, self.sitecol, self.ses_ruptures[sl],
+                    self.gsims, self.trunc_level, self.correl_model,
+                    self.epsilon_provider))
+        return out
+
+    def compute_gmfs(self, site_ids):
+        """
+        Compute the ground motion fields of the underlying ruptures on
+        the given sites only.
+
+        :param site_ids: an ordered array of S site indices
+        :returns:
+            a dictionary (gsim, imt) -> array S x R, where R is the number
+            of ruptures; the sites not affected by a rupture get zeros
         """
         from openquake.commonlib.calculators.event_based import make_gmf_by_tag
         gmf_by_tag = make_gmf_by_tag(
             self.ses_ruptures, self.sitecol, self.imts,
             self.gsims, self.trunc_level, self.correl_model, DummyMonitor())
-        gmf_dt = gsim_imt_dt(self.gsims, self.imts)
-        n = len(self.sitecol.complete)
-        gmfs = numpy.zeros((len(gmf_by_tag), n), gmf_dt)
+        gsims = map(str, self.gsims)
+        gmvs = {(gsim, imt): numpy.zeros((len(site_ids), len(gmf_by_tag)))
+                for gsim in gsims for imt in self.imts}
         for r, tag in enumerate(sorted(gmf_by_tag)):
             gmfa = gmf_by_tag[tag]
-            expanded_gmf = numpy.zeros(n, gmf_dt)
-            expanded_gmf[gmfa['idx']] = gmfa
-            gmfs[r] = expanded_gmf
-        return gmfs  # array R x N
+            # keep only the sites with assets
+            rows = numpy.searchsorted(site_ids, gmfa['idx'])
+            ok = rows < len(site_ids)
+            ok[ok] = site_ids[rows[ok]] == gmfa['idx'][ok]
+            for gsim in gsims:
+                for imt in self.imts:
+                    gmvs[gsim, imt][rows[ok], r] = gmfa[gsim][imt][ok]
+        return gmvs
 
-    def get_all(self, rlzs_assoc, assets_by_site):
+    def get_all(self, rlzs_assoc, assetcol, epsilon_store=None):
         """
+        :param rlzs_assoc: a RlzsAssoc instance
+        :param assetcol: an AssetCollection instance
+        :param epsilon_store:
+            an EpsilonStore built from the epsilon provider, or None
+            to generate the epsilons on demand
         :returns:
-            lists of assets, hazards and epsilons
+            the AssetCollection, a :class:`HazardMatrices` instance
+            and an array of epsilons with a row per asset
         """
-        assets, hazards, epsilons = [], [], []
-        gmfs = self.compute_expand_gmfs()
-        gsims = map(str, self.gsims)
+        site_ids, rows = numpy.unique(assetcol.site_ids, return_inverse=True)
         trt_id = rlzs_assoc.csm_info.get_trt_id(self.col_id)
-        for assets_, hazard in zip(assets_by_site, gmfs.T):
-            haz_by_imt_rlz = {imt: {} for imt in self.imts}
-            for gsim in gsims:
-                for imt in self.imts:
-                    for rlz in rlzs_assoc[trt_id, gsim]:
-                        haz_by_imt_rlz[imt][rlz] = hazard[gsim][imt]
-            for asset in assets_:
-                assets.append(asset)
-                hazards.append(haz_by_imt_rlz)
-                eps = expand(self.eps_dict[asset.id], len(self.ses_ruptures))
-                epsilons.append(eps)
-        return assets, hazards, epsilons
+        rlzs_by_gsim = {str(gsim): rlzs_assoc[trt_id, str(gsim)]
+                        for gsim in self.gsims}
+        hazards = HazardMatrices(
+            self.compute_gmfs(site_ids), rlzs_by_gsim, rows)
+        # the assets of the same taxonomy are correlated
+        epsilons = (epsilon_store or self.epsilon_provider).get(
+            assetcol.ordinals, self.eids, assetcol.taxonomy_indices)
+        return assetcol, hazards, epsilons
 
     def __repr__(self):
         return '<%s IMT_taxonomies=%s, weight=%d>' % (
@@ -22,9 +22,9 @@ This module includes the scientific API of the oq-risklib
 """
 
 import abc
-import copy
 import itertools
 import bisect
+import tempfile
 
 import numpy
 from scipy import interpolate, stats
@@ -89,6 +89,8 @@ def fine_graining(points, steps):
 
 
 class VulnerabilityFunction(object):
+    table_resolution = 0  # no lookup table by default
+
     def __init__(self, vf_id, imt, imls, mean_loss_ratios, covs=None,
                  distribution="LN"):
         """
@@ -146,6 +148,50 @@ class VulnerabilityFunction(object):
         self._mlr_i1d = interpolate.interp1d(self.imls, self.mean_loss_ratios)
         self._covs_i1d = interpolate.interp1d(self.imls, self.covs)
         self.set_distribution(None)
+        if self.table_resolution:
+            self._init_table()
+
+    def set_table_resolution(self, resolution):
+        """
+        Enable the lookup-table mode: `apply_to` will read the mean loss
+        ratios and the coefficients of variation from dense tables with
+        `resolution` uniformly spaced points over the IML range, instead
+        of interpolating them, by taking the point nearest to each IML.
+        The error on the mean loss ratios is bounded by
+        :meth:`table_error_bound`. A resolution of 0 disables the tables.
+
+        :param int resolution: the number of points in the tables
+        """
+        if resolution == 1:
+            raise ValueError('The vulnerability table resolution must be '
+                             'at least 2, got 1')
+        self.table_resolution = resolution
+        self.init()
+
+    def _init_table(self):
+        imls = numpy.linspace(
+            self.imls[0], self.imls[-1], self.table_resolution)
+        self._table_step = (imls[1] - imls[0]) or 1.  # 1 for a single iml
+        self._table_mlrs = numpy.interp(
+            imls, self.imls, self.mean_loss_ratios)
+        self._table_covs = numpy.interp(imls, self.imls, self.covs)
+        # the parameters of the lognormal distribution
+        self._table_sigmas = numpy.sqrt(numpy.log(self._table_covs ** 2 + 1))
+        self._table_scales = self._table_mlrs / numpy.sqrt(
+            1 + self._table_covs ** 2)
+
+    def table_error_bound(self):
+        """
+        :returns:
+            the maximum error on the mean loss ratios due to the lookup
+            table, i.e. half the table step times the maximum slope
+            of the vulnerability function. The same bound holds for
+            the coefficients of variation, with their maximum slope.
+        """
+        if not self.table_resolution or len(self.imls) == 1:
+            return 0.
+        slopes = numpy.diff(self.mean_loss_ratios) / numpy.diff(self.imls)
+        return numpy.abs(slopes).max() * self._table_step / 2
 
     def set_distribution(self, epsilons=None):
         if (self.covs > 0).any():
@@ -156,9 +202,11 @@ class VulnerabilityFunction(object):
 
     def apply_to(self, ground_motion_values, epsilons):
         """
-        Apply a copy of the vulnerability function to a set of N
-        ground motion vectors, by using N epsilon vectors of length R,
-        where N is the number of assets and R the number of realizations.
+        Apply the vulnerability function to a set of N ground motion
+        vectors, by using N epsilon vectors of length R, where N is the
+        number of assets and R the number of realizations. The whole
+        matrix is processed at once; the result is the same as calling
+        `._apply` on each row.
 
         :param ground_motion_values:
            matrix of floats N x R
@@ -170,10 +218,47 @@ class VulnerabilityFunction(object):
         # values gives inconsistent results, see the MeanLossTestCase
         assert len(epsilons) == len(ground_motion_values), (
             len(epsilons), len(ground_motion_values))
-        vulnerability_function = copy.copy(self)
-        vulnerability_function.set_distribution(epsilons)
-        return utils.numpy_map(
-            vulnerability_function._apply, ground_motion_values)
+        gmvs = numpy.array(ground_motion_values, float)
+        ratios = numpy.zeros_like(gmvs)
+        if gmvs.size == 0:
+            return ratios
+
+        # imls are clipped to max(iml); for imls < min(iml) the loss is 0
+        imls = numpy.minimum(gmvs, self.imls[-1])
+        ok = imls >= self.imls[0]
+        imls = imls[ok]  # the selected values, row by row
+        if self.table_resolution:
+            idx = numpy.rint(
+                (imls - self.imls[0]) / self._table_step).astype(int)
+            if isinstance(self.distribution, LogNormalDistribution):
+                epsilons = self._select_epsilons(epsilons, ok)
+                ratios[ok] = self._table_scales[idx] * numpy.exp(
+                    epsilons * self._table_sigmas[idx])
+                return ratios
+            means = self._table_mlrs[idx]
+            covs = self._table_covs[idx]
+        else:
+            means = numpy.interp(imls, self.imls, self.mean_loss_ratios)
+            covs = numpy.interp(imls, self.imls, self.covs)
+
+        # sample all the selected values in a single call, as if
+        # they were the values of a single asset
+        distribution = self.distribution.__class__()
+        if isinstance(distribution, LogNormalDistribution):
+            distribution.epsilons = [self._select_epsilons(epsilons, ok)]
+        ratios[ok] = distribution.sample(means, covs, covs * imls)
+        return ratios
+
+    @staticmethod
+    def _select_epsilons(epsilons, ok):
+        # the k-th selected value of an asset gets the k-th epsilon
+        # of the asset, as in LogNormalDistribution.sample
+        epsilons = numpy.array(epsilons, float)
+        rows, _ = numpy.nonzero(ok)
+        if epsilons.ndim == 1:  # one epsilon per asset
+            return epsilons[rows]
+        ranks = numpy.cumsum(ok, axis=1) - 1
+        return epsilons[rows, ranks[ok]]
 
     @utils.memoized
     def strictly_increasing(self):
@@ -241,7 +326,7 @@ class VulnerabilityFunction(object):
 
     def __getstate__(self):
         return (self.id, self.imt, self.imls, self.mean_loss_ratios,
-                self.covs, self.distribution_name)
+                self.covs, self.distribution_name, self.table_resolution)
 
     def __setstate__(self, state):
         self.id = state[0]
@@ -250,6 +335,7 @@ class VulnerabilityFunction(object):
         self.mean_loss_ratios = state[3]
         self.covs = state[4]
         self.distribution_name = state[5]
+        self.table_resolution = state[6]
         self.init()
 
     def _check_vulnerability_data(self, imls, loss_ratios, covs, distribution):
@@ -307,14 +393,10 @@ class VulnerabilityFunction(object):
         loss_ratios = self.mean_loss_ratios_with_steps(steps)
 
         # LREM has number of rows equal to the number of loss ratios
-        # and number of columns equal to the number of imls
-        lrem = numpy.empty((loss_ratios.size, self.imls.size), float)
-
-        for row, loss_ratio in enumerate(loss_ratios):
-            for col, (mean_loss_ratio, stddev) in enumerate(
-                    itertools.izip(self.mean_loss_ratios, self.stddevs)):
-                lrem[row][col] = self.distribution.survival(
-                    loss_ratio, mean_loss_ratio, stddev)
+        # and number of columns equal to the number of imls; it is
+        # computed in a single call by broadcasting
+        lrem = self.distribution.survival(
+            loss_ratios.reshape(-1, 1), self.mean_loss_ratios, self.stddevs)
         return loss_ratios, lrem
 
     @utils.memoized
@@ -471,8 +553,7 @@ class DegenerateDistribution(Distribution):
         return means
 
     def survival(self, loss_ratio, mean, _stddev):
-        return numpy.piecewise(
-            loss_ratio, [loss_ratio > mean or not mean], [0, 1])
+        return numpy.where((loss_ratio > mean) | (mean == 0), 0., 1.)
 
 
 class EpsilonProvider(object):
@@ -533,6 +614,64 @@ class EpsilonProvider(object):
         return numpy.array([self.sample_one(seed) for seed in seeds]).T
 
 
+class EquicorrelatedSampler(object):
+    """
+    A sampler of standard normal epsilons for N assets split in groups,
+    such that the epsilons of two assets in the same group have
+    correlation rho, while the groups are independent. Since the
+    covariance matrix of a group is equicorrelated, it can be sampled
+    exactly without building it, as
+
+      epsilon = sqrt(rho) * Z_group + sqrt(1 - rho) * Z_asset
+
+    with independent standard normals Z_group and Z_asset; the cost is
+    linear in the number of assets, instead of quadratic in memory and
+    cubic in time as for :func:`numpy.random.multivariate_normal`.
+    The groups can be any block structure, for instance taxonomies, or
+    labels combining taxonomy and region, and each group can have its
+    own rho.
+
+    >>> sampler = EquicorrelatedSampler(['RC', 'RC', 'W'], correlation=1)
+    >>> eps = sampler.sample(4, seed=42)
+    >>> (eps[0] == eps[1]).all(), (eps[0] == eps[2]).all()
+    (True, False)
+
+    :param groups: a sequence of N scalar group labels, one for each asset
+    :param correlation:
+        a coefficient in the range [0, 1], or a sequence with a
+        coefficient for each group, in the order of the sorted labels
+    """
+    def __init__(self, groups, correlation):
+        self.labels, self.idx = numpy.unique(groups, return_inverse=True)
+        rho = numpy.zeros(len(self.labels)) + correlation
+        assert ((0 <= rho) & (rho <= 1)).all(), correlation
+        self.common_coeffs = numpy.sqrt(rho)[self.idx, None]
+        self.individual_coeffs = numpy.sqrt(1. - rho)[self.idx, None]
+
+    def combine(self, common, individual):
+        """
+        :param common: an array of shape (G, S) with a row for each group
+        :param individual: an array of shape (N, S) with a row for each asset
+        :returns: an array of shape (N, S) of correlated epsilons
+        """
+        return (self.common_coeffs * common[self.idx] +
+                self.individual_coeffs * individual)
+
+    def sample(self, num_samples, seed=None):
+        """
+        :param num_samples: the number of samples S
+        :param seed: if not None, used to seed numpy.random
+        :returns: an array of shape (N, S)
+        """
+        if seed is not None:
+            numpy.random.seed(seed)
+        individual = numpy.random.normal(
+            size=(num_samples, len(self.idx))).transpose()
+        common = numpy.random.normal(
+            size=(num_samples, len(self.labels))).transpose()
+        return self.combine(common, individual)
+
+
 def make_epsilons(matrix, seed, correlation):
     """
     Given a matrix N * R returns a matrix of the same shape N * R
@@ -546,12 +685,155 @@ def make_epsilons(matrix, seed, correlation):
     samples = len(matrix[0])
     if not correlation:  # avoid building the covariance matrix
         return numpy.random.normal(size=(samples, asset_count)).transpose()
-    means_vector = numpy.zeros(asset_count)
-    covariance_matrix = (
-        numpy.ones((asset_count, asset_count)) * correlation +
-        numpy.diag(numpy.ones(asset_count)) * (1 - correlation))
-    return numpy.random.multivariate_normal(
-        means_vector, covariance_matrix, samples).transpose()
+    # all the assets are in the same group
+    return EquicorrelatedSampler(
+        numpy.zeros(asset_count), correlation).sample(samples)
+
+
+def _mix64(x):
+    """
+    The SplitMix64 finalizer, a bijection on 64 bit integers with good
+    avalanche properties. Overflows wrap around, as intended.
+
+    :param x: an array of uint64
+    :returns: an array of uint64 of the same shape
+    """
+    x = x + numpy.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+    return x ^ (x >> numpy.uint64(31))
+
+
+def counter_normals(seed, rows, cols, stream=0):
+    """
+    Generate standard normal deviates with a counter-based generator:
+    the deviate in position (i, j) is a pure function of the key
+    (seed, stream, rows[i], cols[j]), so it does not depend on the other
+    keys requested, nor on the global state of numpy.random.
+
+    >>> eps = counter_normals(42, [0, 1, 2], [0, 1])
+    >>> eps.shape
+    (3, 2)
+    >>> (counter_normals(42, [2], [1]) == eps[2, 1]).all()
+    True
+
+    :param seed: a non-negative integer
+    :param rows: a sequence of R non-negative integers
+    :param cols: a sequence of C non-negative integers
+    :param stream: an integer identifying an independent stream
+    :returns: an array of shape (R, C)
+    """
+    with numpy.errstate(over='ignore'):
+        key = _mix64(numpy.array([seed], numpy.uint64) ^ _mix64(
+            numpy.array([stream], numpy.uint64)))
+        hrows = _mix64(key ^ numpy.array(rows, numpy.uint64))
+        hash1 = _mix64(hrows[:, None] ^ numpy.array(cols, numpy.uint64))
+        hash2 = _mix64(hash1)
+    # Box-Muller transform of two uniforms with 53 bits of precision
+    u1 = ((hash1 >> numpy.uint64(11)) + 1) * 2. ** -53  # in (0, 1]
+    u2 = (hash2 >> numpy.uint64(11)) * 2. ** -53  # in [0, 1)
+    return numpy.sqrt(-2. * numpy.log(u1)) * numpy.cos(2. * numpy.pi * u2)
+
+
+class CounterEpsilonProvider(object):
+    """
+    A provider of epsilons based on :func:`counter_normals`: the epsilon
+    of an asset for an event is determined by the master seed, the asset
+    ordinal and the event ordinal, so that each task can generate the
+    epsilons it needs without receiving them from the master, and the
+    results do not depend on how the assets and the events are split
+    in tasks.
+
+    If the correlation coefficient is nonzero, the assets in the
+    same group (for instance with the same taxonomy) are correlated,
+    as in :class:`EquicorrelatedSampler`.
+
+    >>> ep = CounterEpsilonProvider(42, correlation=1)
+    >>> eps = ep.get([0, 1, 2], [5, 6], groups=[0, 0, 1])
+    >>> (eps[0] == eps[1]).all(), (eps[0] == eps[2]).all()
+    (True, False)
+
+    :param master_seed: the seed of the calculation
+    :param correlation: coefficient in the range [0, 1]
+    :param num_samples:
+        if given, the events with the same ordinal modulo `num_samples`
+        get the same epsilons
+    """
+    def __init__(self, master_seed, correlation=0, num_samples=None):
+        assert 0 <= correlation <= 1, correlation
+        self.master_seed = master_seed
+        self.correlation = correlation
+        self.num_samples = num_samples
+
+    def get(self, ordinals, eids, groups=None):
+        """
+        :param ordinals: the ordinals of N assets
+        :param eids: the ordinals of E events
+        :param groups: the group indices of the N assets, or None
+        :returns: an array of epsilons of shape (N, E)
+        """
+        eids = numpy.array(eids, numpy.uint64)
+        if self.num_samples:
+            eids %= numpy.uint64(self.num_samples)
+        eps = counter_normals(self.master_seed, ordinals, eids)
+        if self.correlation:
+            sampler = EquicorrelatedSampler(groups, self.correlation)
+            common = counter_normals(
+                self.master_seed, sampler.labels, eids, stream=1)
+            eps = sampler.combine(common, eps)
+        return eps
+
+
+class EpsilonStore(object):
+    """
+    A compact store of epsilons, i.e. a matrix with a row per asset and
+    a column per sample, to be built once and shared read-only by the
+    tasks. The epsilon of an asset for an event is found by fancy indexing
+    with the asset ordinal and the event ordinal modulo the number
+    of samples, so the tasks do not need to generate or expand anything.
+    The store has the same interface as :class:`CounterEpsilonProvider`
+    and contains exactly the epsilons it would generate; it is convenient
+    only when there are more events than samples, otherwise generating
+    the epsilons on demand costs the same and requires no memory.
+
+    >>> ep = CounterEpsilonProvider(42, num_samples=2)
+    >>> store = EpsilonStore.build(ep, [0, 1, 2], 2)
+    >>> store.array.shape
+    (3, 2)
+    >>> (store.get([2, 0], [5, 6]) == store.array[[[2], [0]], [1, 0]]).all()
+    True
+
+    :param array: an array of epsilons of shape (num_assets, num_samples)
+    """
+    def __init__(self, array):
+        self.array = array
+        self.num_samples = array.shape[1]
+
+    @classmethod
+    def build(cls, provider, ordinals, num_samples, groups=None):
+        """
+        Build the store by calling the given provider once for all
+        the assets and samples.
+
+        :param provider: a :class:`CounterEpsilonProvider` instance
+        :param ordinals: the ordinals of all the assets, i.e. 0, 1, ...
+        :param num_samples: the number of samples (epsilon_sampling)
+        :param groups: the group indices of the assets, or None
+        """
+        ordinals = numpy.array(ordinals)
+        assert (ordinals == numpy.arange(len(ordinals))).all(), ordinals
+        return cls(provider.get(ordinals, numpy.arange(num_samples), groups))
+
+    def get(self, ordinals, eids, groups=None):
+        """
+        :param ordinals: the ordinals of N assets
+        :param eids: the ordinals of E events
+        :param groups: ignored, the correlation is already in the store
+        :returns: an array of epsilons of shape (N, E)
+        """
+        rows = numpy.array(ordinals, int).reshape(-1, 1)
+        cols = numpy.array(eids, int) % self.num_samples
+        return self.array[rows, cols]
 
 
 @DISTRIBUTIONS.add('LN')
@@ -586,16 +868,21 @@ class LogNormalDistribution(Distribution):
         # scipy does not handle correctly the limit case stddev = 0.
         # In that case, when `mean` > 0 the survival function
         # approaches to a step function, otherwise (`mean` == 0) we
-        # returns 0
-        if stddev == 0:
-            return numpy.piecewise(
-                loss_ratio, [loss_ratio > mean or not mean], [0, 1])
+        # returns 0; the arguments can be arrays, broadcast together
+        loss_ratio, mean, stddev = numpy.broadcast_arrays(
+            loss_ratio, mean, stddev)
+        step = numpy.where((loss_ratio > mean) | (mean == 0), 0., 1.)
+        if (stddev == 0).all():
+            return step
 
         variance = stddev ** 2.0
-
-        sigma = numpy.sqrt(numpy.log((variance / mean ** 2.0) + 1.0))
-        mu = mean ** 2.0 / numpy.sqrt(variance + mean ** 2.0)
-        return stats.lognorm.sf(loss_ratio, sigma, scale=mu)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            sigma = numpy.sqrt(numpy.log((variance / mean ** 2.0) + 1.0))
+            mu = mean ** 2.0 / numpy.sqrt(variance + mean ** 2.0)
+            # the points with stddev = 0 are replaced by the step function
+            return numpy.where(
+                stddev == 0, step,
+                stats.lognorm.sf(loss_ratio, sigma, scale=mu))
 
 
 @DISTRIBUTIONS.add('BT')
@@ -643,13 +930,10 @@ class CurveBuilder(object):
         :param loss_matrix:
             a matrix of loss ratios of size N x R, N = #assets, R = #ruptures
         """
-        N = len(loss_matrix)
-        counts = numpy.zeros((N, self.curve_resolution), numpy.uint32)
-        for i, loss_ratios in enumerate(loss_matrix):
-            # build the counts for each asset
-            counts[i, :] = numpy.array([(loss_ratios > ratio).sum()
-                                        for ratio in self.ratios])
-        return counts
+        loss_matrix = numpy.asarray(loss_matrix, float)
+        # self.ratios is numpy.linspace(0, 1, curve_resolution)
+        return _linspace_counts(
+            loss_matrix, numpy.ones(len(loss_matrix)), self.curve_resolution)
 
     def build_poes(self, counts, tses, time_span):
         """
@@ -690,19 +974,187 @@ def event_based(loss_values, tses, time_span, curve_resolution):
 
     :param curve_resolution: The number of points the output curve is
                              defined by
+
+    If `loss_values` is a matrix N x R, N curves are computed at once and
+    an array of shape (N, 2, curve_resolution) is returned.
     """
-    reference_losses = numpy.linspace(
-        0, numpy.max(loss_values), curve_resolution)
-    # counts how many loss_values are bigger than the reference loss
-    times = [(loss_values > loss).sum() for loss in reference_losses]
-    # NB: (loss_values > loss).sum() is MUCH more efficient than
-    # sum(loss_values > loss). Incredibly more efficient in memory.
+    loss_values = numpy.asarray(loss_values, float)
+    if loss_values.ndim == 2:  # N curves in one go
+        N, R = loss_values.shape
+        max_losses = loss_values.max(axis=1) if R else numpy.zeros(N)
+        reference_losses_ = reference_losses(max_losses, curve_resolution)
+        times = _linspace_counts(loss_values, max_losses, curve_resolution)
+    else:
+        reference_losses_ = numpy.linspace(
+            0, numpy.max(loss_values), curve_resolution)
+        # counts how many loss_values are bigger than the reference loss
+        sorted_values = numpy.sort(loss_values)
+        times = len(sorted_values) - numpy.searchsorted(
+            sorted_values, reference_losses_, side='right')
 
     rates_of_exceedance = numpy.array(times) / float(tses)
 
     poes = 1. - numpy.exp(-rates_of_exceedance * time_span)
 
-    return numpy.array([reference_losses, poes])
+    if loss_values.ndim == 2:
+        return numpy.array([reference_losses_, poes]).transpose(1, 0, 2)
+    return numpy.array([reference_losses_, poes])
+
+
+def reference_losses(max_losses, curve_resolution):
+    """
+    Build the reference losses of several loss curves in one go.
+
+    :param max_losses: an array of N maximum losses
+    :param curve_resolution: the number of points C of the curves
+    :returns: a matrix N x C, the n-th row being
+              numpy.linspace(0, max_losses[n], curve_resolution)
+
+    >>> reference_losses(numpy.array([1., 2.]), 3).tolist()
+    [[0.0, 0.5, 1.0], [0.0, 1.0, 2.0]]
+    """
+    max_losses = numpy.asarray(max_losses, float)
+    C = curve_resolution
+    if C == 1:
+        return numpy.zeros((len(max_losses), 1))
+    # replicate exactly the numbers generated by numpy.linspace
+    steps = max_losses / float(C - 1)
+    losses = numpy.arange(C) * steps[:, None]
+    losses[:, -1] = max_losses
+    return losses
+
+
+def exceedance_counts(ordinals, losses, max_losses, curve_resolution):
+    """
+    Count how many losses of each asset exceed the reference losses
+    of the asset, i.e. numpy.linspace(0, max_loss, curve_resolution).
+    This is a histogram kernel performing the same counting as
+    :func:`event_based`, for all the assets at once. Since the table
+    does not need to be sorted, the counts of different chunks of the
+    same table can simply be summed.
+
+    :param ordinals: an array of E asset ordinals in the range 0..N-1
+    :param losses: an array of E losses
+    :param max_losses: an array of N maximum losses, one per asset
+    :param curve_resolution: the number of points C of the curves
+    :returns: a matrix N x C of counts
+
+    >>> exceedance_counts([0, 0, 1, 0], [1., .5, 2., .2], [1., 2.], 3)
+    array([[3, 1, 0],
+           [1, 1, 0]], dtype=uint32)
+    """
+    ordinals = numpy.asarray(ordinals, numpy.int64)
+    losses = numpy.asarray(losses, float)
+    N, C = len(max_losses), curve_resolution
+    refs = reference_losses(max_losses, C)  # shape (N, C)
+    # number of reference losses exceeded by each loss; first compute it
+    # by a division and then correct the rounding errors, if any
+    if C > 1:
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            idx = numpy.ceil(losses / refs[ordinals, 1])
+        idx[~numpy.isfinite(idx)] = 0
+        idx = idx.clip(0, C).astype(numpy.int64)
+    else:
+        idx = numpy.zeros(len(losses), numpy.int64)
+    down = idx > 0
+    down[down] = refs[ordinals[down], idx[down] - 1] >= losses[down]
+    idx[down] -= 1
+    up = idx < C
+    up[up] = refs[ordinals[up], idx[up]] < losses[up]
+    idx[up] += 1
+    return _cumulative_counts(ordinals * (C + 1) + idx, N, C)
+
+
+def _linspace_counts(matrix, max_values, C):
+    """
+    Count how many values in each row of the matrix exceed the reference
+    values of the row, i.e. numpy.linspace(0, max_values[n], C). The
+    index of the reference values is computed with a division and then
+    corrected for the rounding errors, so that the counts are exactly
+    the same as comparing each value with each reference value.
+
+    :param matrix: a matrix of values N x R
+    :param max_values: an array of N maximum values, one per row
+    :param C: the number of reference values per row
+    :returns: a matrix N x C of counts
+    """
+    N = len(matrix)
+    max_values = numpy.asarray(max_values, float)[:, None]
+    if C == 1:  # the only reference value is zero
+        return numpy.array((matrix > 0).sum(axis=1)[:, None], numpy.uint32)
+    # same numbers as reference_losses
+    steps = max_values / float(C - 1)
+
+    def ref(idx):
+        return numpy.where(idx == C - 1, max_values, idx * steps)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        idx = numpy.ceil(matrix / steps)
+    idx[~numpy.isfinite(idx)] = 0
+    idx = idx.clip(0, C).astype(numpy.int64)
+    idx -= (idx > 0) & (ref(idx - 1) >= matrix)
+    idx += (idx < C) & (ref(idx) < matrix)
+    bins = idx + (numpy.arange(N) * (C + 1))[:, None]
+    return _cumulative_counts(bins.ravel(), N, C)
+
+
+def _cumulative_counts(bins, N, C):
+    # bins[i] = ordinal * (C + 1) + number of reference losses exceeded
+    # by the i-th loss; returns a matrix N x C of exceedance counts
+    hist = numpy.bincount(bins, minlength=N * (C + 1))
+    # counts[:, c] = number of losses exceeding more than c reference losses
+    cumhist = hist.reshape(N, C + 1)[:, ::-1].cumsum(axis=1)[:, ::-1]
+    return numpy.array(cumhist[:, 1:], numpy.uint32)
+
+
+def loss_curves_from_counts(losses, counts, tses, time_span):
+    """
+    Convert exceedance counts into loss curves.
+
+    :param losses: a matrix N x C of reference losses
+    :param counts: a matrix N x C of exceedance counts
+    :param tses: time representative of the stochastic event set
+    :param time_span: investigation time spanned by the risk input
+    :returns: an array of N records with fields losses, poes, avg
+    """
+    N, C = losses.shape
+    rates_of_exceedance = numpy.array(counts, float) / float(tses)
+    poes = 1. - numpy.exp(-rates_of_exceedance * time_span)
+    curves = numpy.zeros(N, numpy.dtype(
+        [('losses', (float, C)), ('poes', (float, C)), ('avg', float)]))
+    curves['losses'] = losses
+    curves['poes'] = poes
+    # trapezoidal rule, as in average_loss
+    curves['avg'] = numpy.einsum(
+        'ij,ij->i', losses[:, 1:] - losses[:, :-1],
+        (poes[:, :-1] + poes[:, 1:]) / 2.)
+    return curves
+
+
+def event_based_curves(ordinals, losses, num_assets, tses, time_span,
+                       curve_resolution):
+    """
+    Compute the loss curves of several assets from a table of losses.
+    This is the vectorized equivalent of calling :func:`event_based`
+    and :func:`average_loss` for each asset; assets without losses
+    get a curve of zeros.
+
+    :param ordinals: an array of E asset ordinals in the range 0..N-1
+    :param losses: an array of E losses
+    :param num_assets: the number N of assets
+    :param tses: time representative of the stochastic event set
+    :param time_span: investigation time spanned by the risk input
+    :param curve_resolution: the number of points C of the curves
+    :returns: an array of N records with fields losses, poes, avg
+    """
+    ordinals = numpy.asarray(ordinals, numpy.int64)
+    losses = numpy.asarray(losses, float)
+    max_losses = numpy.zeros(num_assets)
+    numpy.maximum.at(max_losses, ordinals, losses)
+    counts = exceedance_counts(
+        ordinals, losses, max_losses, curve_resolution)
+    return loss_curves_from_counts(
+        reference_losses(max_losses, curve_resolution), counts,
+        tses, time_span)
 
 
 #
@@ -788,25 +1240,43 @@ def classical(vulnerability_function, hazard_imls, hazard_poes, steps=10):
     :param int steps:
         Number of steps between loss ratios.
     """
+    loss_ratios, poes = classical_curves(
+        vulnerability_function, hazard_imls, [hazard_poes], steps)
+    return numpy.array([loss_ratios, poes[0]])
+
+
+def classical_curves(vulnerability_function, hazard_imls, hazard_curves,
+                     steps=10):
+    """
+    Compute the loss ratio curves for N hazard curves at once, as
+    the product of the (N, I) matrix of the probabilities of occurrence
+    of the mean imls of the vulnerability function and the transposed
+    (R, I) loss ratio exceedance matrix.
+
+    :param vulnerability_function:
+        an instance of
+        :py:class:`openquake.risklib.scientific.VulnerabilityFunction`
+    :param hazard_imls:
+        the hazard intensity measure levels, common to all curves
+    :param hazard_curves:
+        an array of shape (N, L) with the hazard curves
+    :param int steps:
+        Number of steps between loss ratios.
+    :returns:
+        the R loss ratios and an array of shape (N, R) with the PoEs
+    """
     vf = vulnerability_function.strictly_increasing()
-    imls = vf.mean_imls()
     loss_ratios, lrem = vf.loss_ratio_exceedance_matrix(steps)
 
     # saturate imls to hazard imls
-    min_val, max_val = hazard_imls[0], hazard_imls[-1]
-    numpy.putmask(imls, imls < min_val, min_val)
-    numpy.putmask(imls, imls > max_val, max_val)
-
-    # interpolate the hazard curve
-    poes = interpolate.interp1d(hazard_imls, hazard_poes)(imls)
+    imls = numpy.clip(vf.mean_imls(), hazard_imls[0], hazard_imls[-1])
 
-    # compute the poos
-    pos = pairwise_diff(poes)
-    lrem_po = numpy.empty(lrem.shape)
-    for idx, po in enumerate(pos):
-        lrem_po[:, idx] = lrem[:, idx] * po  # column * po
+    # interpolate the hazard curves
+    poes = interpolate.interp1d(hazard_imls, hazard_curves, axis=1)(imls)
 
-    return numpy.array([loss_ratios, lrem_po.sum(axis=1)])
+    # compute the poos, with shape (N, I)
+    pos = poes[:, :-1] - poes[:, 1:]
+    return loss_ratios, pos.dot(lrem.T)
 
 
 def conditional_loss_ratio(loss_ratios, poes, probability):
@@ -894,6 +1364,55 @@ def insured_loss_curve(curve, deductible, insured_limit):
         numpy.piecewise(poes, [poes > limit_poe], [limit_poe, lambda x: x])])
 
 
+def insured_loss_curves(loss_ratios, poes, deductibles, insured_limits):
+    """
+    Vectorized version of :func:`insured_loss_curve` for N curves with
+    the same loss ratios, as the ones returned by :func:`classical_curves`.
+
+    :param loss_ratios: an array of R non-decreasing loss ratios
+    :param poes: an array of shape (N, R)
+    :param deductibles: N deductible limits in fraction form
+    :param insured_limits: N insured limits in fraction form
+    :returns:
+        a pair (insured curves, average insured losses); the curves are
+        an array of shape (N, 2, R') if all the insured limits keep the
+        same number R' of loss ratios, otherwise an object array of N
+        arrays of shape (2, R_i)
+    """
+    loss_ratios = numpy.asarray(loss_ratios)
+    poes = numpy.asarray(poes)
+    deductibles = numpy.asarray(deductibles, float)
+    insured_limits = numpy.asarray(insured_limits, float)
+    # the PoE at the deductible, with the same linear interpolation
+    # of scipy.interpolate.interp1d
+    rows = numpy.arange(len(poes))
+    hi = numpy.clip(numpy.searchsorted(loss_ratios, deductibles),
+                    1, len(loss_ratios) - 1)
+    lo = hi - 1
+    slope = ((poes[rows, hi] - poes[rows, lo]) /
+             (loss_ratios[hi] - loss_ratios[lo]))
+    limit_poes = slope * (deductibles - loss_ratios[lo]) + poes[rows, lo]
+    limit_poes[(deductibles < loss_ratios[0]) |
+               (deductibles > loss_ratios[-1])] = 1
+    ipoes = numpy.minimum(poes, limit_poes[:, None])
+    # the loss ratios above the insured limit are discarded
+    keep = loss_ratios <= insured_limits[:, None]
+    segments = (ipoes[:, :-1] + ipoes[:, 1:]) / 2. * (
+        loss_ratios[1:] - loss_ratios[:-1])
+    averages = (segments * keep[:, 1:]).sum(axis=1)
+    sizes = keep.sum(axis=1)
+    if len(numpy.unique(sizes)) <= 1:  # curves of the same length
+        size = sizes[0] if len(sizes) else len(loss_ratios)
+        curves = numpy.empty((len(poes), 2, size))
+        curves[:, 0] = loss_ratios[:size]
+        curves[:, 1] = ipoes[:, :size]
+    else:  # curves of different lengths
+        curves = numpy.empty(len(poes), object)
+        for i, k in enumerate(keep):
+            curves[i] = numpy.array([loss_ratios[k], ipoes[i, k]])
+    return curves, averages
+
+
 #
 # Benefit Cost Ratio Analysis
 #
@@ -931,9 +1450,16 @@ def average_loss(losses_poes):
            is a result of a linear interpolation, we compute an exact
            integral by using the trapeizodal rule with the width given by the
            loss bin width.
+
+    :param losses_poes:
+        a pair (losses, poes); the poes can also be an array of shape
+        (N, R), i.e. N curves with the same R losses: in that case an
+        array with N average losses is returned
     """
     losses, poes = losses_poes
-    return numpy.dot(-pairwise_diff(losses), pairwise_mean(poes))
+    losses, poes = numpy.asarray(losses), numpy.asarray(poes)
+    return numpy.dot((poes[..., :-1] + poes[..., 1:]) / 2.,
+                     losses[1:] - losses[:-1])
 
 
 def pairwise_mean(values):
@@ -956,14 +1482,72 @@ def mean_std(fractions):
 
 def loss_map_matrix(poes, curves):
     """
-    Wrapper around :func:`openquake.risklib.scientific.conditional_loss_ratio`.
-    Return a matrix of shape (num-poes, num-curves). The curves are lists of
-    pairs (loss_ratios, poes).
+    Vectorized version of :func:`openquake.risklib.scientific.\
+conditional_loss_ratio`. Return a matrix of shape (num-poes, num-curves).
+    The curves are lists of pairs (loss_ratios, poes); if they have
+    different lengths they are processed one at the time.
     """
-    return numpy.array(
-        [[conditional_loss_ratio(curve[0], curve[1], poe)
-          for curve in curves] for poe in poes]
-    ).reshape((len(poes), len(curves)))
+    try:
+        curves = numpy.array(curves, float)
+    except ValueError:  # curves of different lengths
+        return numpy.array(
+            [[conditional_loss_ratio(curve[0], curve[1], poe)
+              for curve in curves] for poe in poes]
+        ).reshape((len(poes), len(curves)))
+    if len(poes) == 0 or len(curves) == 0:
+        return numpy.zeros((len(poes), len(curves)))
+    return numpy.array([conditional_loss_ratios(
+        curves[:, 0], curves[:, 1], poe) for poe in poes])
+
+
+def conditional_loss_ratios(loss_ratios, poes, probability):
+    """
+    Compute :func:`openquake.risklib.scientific.conditional_loss_ratio`
+    for N curves at once, with the same results, including the curves
+    containing NaNs.
+
+    :param loss_ratios: an array of shape (N, R)
+    :param poes: an array of shape (N, R)
+    :param float probability: the probability value used to
+                              interpolate the loss curves
+    :returns: an array of N loss ratios
+    """
+    num_curves, num_poes = poes.shape
+    rows = numpy.arange(num_curves)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        # emulate bisect.bisect_right on the reversed poes, to get the
+        # same indices also when there are NaNs (the comparisons are False)
+        rpoes = poes[:, ::-1]
+        lo = numpy.zeros(num_curves, int)
+        hi = numpy.empty(num_curves, int)
+        hi.fill(num_poes)
+        active = lo < hi
+        while active.any():
+            mid = (lo + hi) // 2
+            left = probability < rpoes[rows, numpy.minimum(mid, num_poes - 1)]
+            hi = numpy.where(active & left, mid, hi)
+            lo = numpy.where(active & ~left, mid + 1, lo)
+            active = lo < hi
+
+        # interpolate between the poes with indices R - k - 1 and R - k
+        k = numpy.clip(lo, 1, num_poes - 1)
+        i1, i2 = num_poes - k - 1, num_poes - k
+        x1, x2 = poes[rows, i1], poes[rows, i2]
+        y1, y2 = loss_ratios[rows, i1], loss_ratios[rows, i2]
+        result = (y2 - y1) / (x2 - x1) * (probability - x1) + y1
+        result[(lo == num_poes) | (lo == 0)] = numpy.nan  # poes are all nan
+
+        # the exact matches take the biggest corresponding loss ratio
+        exact = poes == probability
+        matched = exact.any(axis=1)
+        result[matched] = numpy.where(
+            exact, loss_ratios, -numpy.inf)[matched].max(axis=1)
+
+        # the probabilities outside the curves
+        below = probability < poes[:, -1]  # smaller than the min PoE
+        result[below] = loss_ratios[below, -1]
+        result[probability > poes[:, 0]] = 0.  # bigger than the max PoE
+    return result
 
 
 def mean_curve(values, weights=None):
@@ -1015,16 +1599,161 @@ def quantile_curve(curves, quantile, weights=None):
     assert len(weights) == len(curves)
     weights = numpy.array(weights, dtype=numpy.float64)
 
-    result_curve = []
-    np_curves = numpy.array(curves).reshape(len(curves), -1)
-    np_weights = numpy.array(weights)
-    for poes in np_curves.transpose():
-        sorted_poe_idxs = numpy.argsort(poes)
-        sorted_weights = np_weights[sorted_poe_idxs]
-        sorted_poes = poes[sorted_poe_idxs]
-        cum_weights = numpy.cumsum(sorted_weights)
-        result_curve.append(numpy.interp(quantile, cum_weights, sorted_poes))
-    return numpy.array(result_curve)
+    # sort all the points at once (with the curves along the last axis,
+    # which is contiguous) and interpolate the quantile on the cumulative
+    # weights of each point
+    np_curves = numpy.array(curves, dtype=numpy.float64).reshape(
+        len(curves), -1).T.copy()
+    sorted_poe_idxs = numpy.argsort(np_curves, axis=1)
+    sorted_poes = np_curves[
+        numpy.arange(len(np_curves))[:, numpy.newaxis], sorted_poe_idxs]
+    cum_weights = numpy.cumsum(weights[sorted_poe_idxs], axis=1)
+    return interp_rows(quantile, cum_weights, sorted_poes)
+
+
+def interp_rows(x, xp, fp):
+    """
+    Equivalent to `numpy.interp(x, xp[i], fp[i])` for each row i,
+    with the same floating point results.
+
+    :param float x: the point where to interpolate
+    :param xp: an array of shape (N, M), non-decreasing along the rows
+    :param fp: an array of shape (N, M)
+    :returns: an array of N values
+    """
+    num_rows, num_cols = xp.shape
+    rows = numpy.arange(num_rows)
+    # index of the last point <= x, i.e. xp[j] <= x < xp[j + 1]
+    j = numpy.clip((xp <= x).sum(axis=1) - 1, 0, num_cols - 1)
+    j1 = numpy.minimum(j + 1, num_cols - 1)
+    x0, x1 = xp[rows, j], xp[rows, j1]
+    y0, y1 = fp[rows, j], fp[rows, j1]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        slope = (y1 - y0) / (x1 - x0)
+        result = slope * (x - x0) + y0
+        # numpy.interp tries from the other side if the result is NaN
+        nan = numpy.isnan(result)
+        result[nan] = (slope * (x - x1) + y1)[nan]
+        result[nan & (y0 == y1)] = y0[nan & (y0 == y1)]
+    exact = (j == num_cols - 1) | (x0 == x)
+    result[exact] = y0[exact]
+    result[x < xp[:, 0]] = fp[x < xp[:, 0], 0]
+    result[x > xp[:, -1]] = fp[x > xp[:, -1], -1]
+    return result
+
+
+class StreamingStats(object):
+    """
+    Compute the mean and the quantiles of the curves of R realizations,
+    which are fed one at the time with the method `.add`, so that the
+    realizations do not need to be kept in memory all together. The mean
+    is updated incrementally. For the quantiles there are two options:
+
+    1. by default the values are stored in a preallocated buffer of shape
+       (R,) + shape and the quantiles are the same as the ones computed
+       by :func:`quantile_curve`; if the buffer is bigger than
+       `max_buffer_size` bytes it is a memory-mapped temporary file and
+       the quantiles are computed in blocks of points, so that the
+       memory occupation is bounded;
+    2. if `sketch_bins` is nonzero, only a weighted histogram with
+       `sketch_bins` bins over the range `sketch_range` is kept for each
+       point of the curves, so that the memory does not depend on R; the
+       quantile is the center of the bin where the cumulative weight
+       reaches the quantile level, i.e. the quantile of the empirical
+       distribution with an error of at most half a bin. Notice that
+       :func:`quantile_curve` interpolates between the realizations,
+       so the difference with it is bigger when R is small. The default
+       range [0, 1] is suitable for PoEs; values outside the range
+       raise a ValueError.
+
+    The points are independent, so the curves can be split in blocks (for
+    instance blocks of sites) with a StreamingStats instance for each block,
+    possibly in different processes.
+
+    :param num_rlzs: the number of realizations R
+    :param shape: the shape of the curves of a realization
+    :param quantiles: a sequence of quantile levels
+    :param weights: R weights, or None for equal weights (sampling)
+    :param sketch_bins: the number of bins of the sketch, or 0
+    :param sketch_range: the pair (min, max) of the values in the sketch
+    :param max_buffer_size: the maximum size in bytes of a buffer in memory
+    """
+    def __init__(self, num_rlzs, shape, quantiles=(), weights=None,
+                 sketch_bins=0, sketch_range=(0., 1.),
+                 max_buffer_size=100 * 1024 ** 2):
+        self.num_rlzs = num_rlzs
+        self.shape = shape
+        self.quantiles = quantiles
+        self.weights = weights
+        self.sketch_bins = sketch_bins
+        self.sketch_range = sketch_range
+        self.max_buffer_size = max_buffer_size
+        self.mean = numpy.zeros(shape)
+        self.buffer = None
+        self.sketch = None
+        if quantiles and sketch_bins:
+            self.sketch = numpy.zeros((numpy.prod(shape), sketch_bins))
+        elif quantiles:
+            shape = (num_rlzs,) + tuple(shape)
+            if numpy.prod(shape) * 8 > max_buffer_size:
+                self.buffer = numpy.memmap(
+                    tempfile.TemporaryFile(), float, 'w+', shape=shape)
+            else:
+                self.buffer = numpy.zeros(shape)
+
+    def get_weight(self, rlzi):
+        """
+        :param rlzi: the index of a realization
+        :returns: its weight
+        """
+        if self.weights is None:
+            return 1. / self.num_rlzs
+        return self.weights[rlzi]
+
+    def add(self, rlzi, curves):
+        """
+        Update the statistics with the curves of a realization.
+
+        :param rlzi: the index of the realization, in the range 0 .. R-1
+        :param curves: an array of the shape given at instantiation time
+        """
+        weight = self.get_weight(rlzi)
+        self.mean += weight * curves
+        if self.buffer is not None:
+            self.buffer[rlzi] = curves
+        elif self.sketch is not None:
+            values = numpy.asarray(curves, float).reshape(-1)
+            lo, hi = self.sketch_range
+            if values.min() < lo or values.max() > hi:
+                raise ValueError(
+                    'The values in [%s, %s] are outside the sketch range '
+                    '[%s, %s]' % (values.min(), values.max(), lo, hi))
+            bins = ((values - lo) / (hi - lo) * self.sketch_bins).astype(int)
+            bins = numpy.clip(bins, 0, self.sketch_bins - 1)
+            self.sketch[numpy.arange(len(values)), bins] += weight
+
+    def get_quantile(self, quantile):
+        """
+        :param quantile: one of the quantile levels
+        :returns: the quantile curves, an array of the given shape
+        """
+        if self.buffer is not None:
+            values = self.buffer.reshape(self.num_rlzs, -1)
+            # number of points such that a block fits in max_buffer_size
+            size = max(self.max_buffer_size // (8 * self.num_rlzs), 1)
+            curve = numpy.zeros(values.shape[1])
+            for start in range(0, len(curve), size):
+                curve[start:start + size] = quantile_curve(
+                    values[:, start:start + size], quantile, self.weights)
+            return curve.reshape(self.shape)
+        # find the bin where the cumulative weights reach the quantile
+        cum = numpy.cumsum(self.sketch, axis=1)
+        cum /= cum[:, -1:]
+        idx = numpy.minimum(
+            (cum < quantile).sum(axis=1), self.sketch_bins - 1)
+        lo, hi = self.sketch_range
+        return (lo + (idx + .5) / self.sketch_bins * (hi - lo)).reshape(
+            self.shape)
 
 
 def exposure_statistics(
@@ -1052,39 +1781,32 @@ def exposure_statistics(
             5. a numpy array with Q x N quantile average loss values
             6. a numpy array with Q x P quantile map values
     """
+    num_assets = len(loss_curves)
     curve_resolution = len(loss_curves[0][0])
     map_nr = len(map_poes)
-
-    # Collect per-asset statistic along the last dimension of the
-    # following arrays
-    mean_curves = numpy.zeros((0, 2, curve_resolution))
-    mean_average_losses = numpy.array([])
-    mean_maps = numpy.zeros((map_nr, 0))
-    quantile_curves = numpy.zeros((len(quantiles), 0, 2, curve_resolution))
-    quantile_average_losses = numpy.zeros((len(quantiles), 0,))
-    quantile_maps = numpy.zeros((len(quantiles), map_nr, 0))
-
-    for loss_ratios, curves_poes in loss_curves:
+    num_quantiles = len(quantiles)
+
+    # the per-asset statistics are stored along the asset dimension
+    # of the following arrays
+    mean_curves = numpy.zeros((num_assets, 2, curve_resolution))
+    mean_average_losses = numpy.zeros(num_assets)
+    mean_maps = numpy.zeros((map_nr, num_assets))
+    quantile_curves = numpy.zeros(
+        (num_quantiles, num_assets, 2, curve_resolution))
+    quantile_average_losses = numpy.zeros((num_quantiles, num_assets))
+    quantile_maps = numpy.zeros((num_quantiles, map_nr, num_assets))
+
+    for i, (loss_ratios, curves_poes) in enumerate(loss_curves):
         _mean_curve, _mean_maps, _quantile_curves, _quantile_maps = (
             asset_statistics(
                 loss_ratios, curves_poes, quantiles, weights, map_poes))
-
-        mean_curves = numpy.vstack(
-            (mean_curves, _mean_curve[numpy.newaxis, :]))
-        mean_average_losses = numpy.append(
-            mean_average_losses, average_loss(_mean_curve))
-
-        mean_maps = numpy.hstack((mean_maps, _mean_maps[:, numpy.newaxis]))
-        quantile_curves = numpy.hstack(
-            (quantile_curves, _quantile_curves[:, numpy.newaxis]))
-
-        _quantile_average_losses = utils.numpy_map(
+        mean_curves[i] = _mean_curve
+        mean_average_losses[i] = average_loss(_mean_curve)
+        mean_maps[:, i] = _mean_maps
+        quantile_curves[:, i] = _quantile_curves
+        quantile_average_losses[:, i] = utils.numpy_map(
             average_loss, _quantile_curves)
-        quantile_average_losses = numpy.hstack(
-            (quantile_average_losses,
-             _quantile_average_losses[:, numpy.newaxis]))
-        quantile_maps = numpy.dstack(
-            (quantile_maps, _quantile_maps[:, :, numpy.newaxis]))
+        quantile_maps[:, :, i] = _quantile_maps
 
     return (mean_curves, mean_average_losses, mean_maps,
             quantile_curves, quantile_average_losses, quantile_maps)
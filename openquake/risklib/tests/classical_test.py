@@ -190,3 +190,37 @@ class ClassicalTestCase(unittest.TestCase):
         for loss, poe in expected_curve:
             numpy.testing.assert_allclose(
                 poe, actual_poes_interp(loss), atol=0.005)
+
+    def test_lrem_is_computed_elementwise(self):
+        # the broadcast LREM is the same as the one computed element by
+        # element, also when some coefficients of variation are zero
+        for covs, dist in [([0.5, 0., 0.2, 0.], 'LN'),
+                           ([0.5, 0.3, 0.2, 0.1], 'BT')]:
+            vf = scientific.VulnerabilityFunction(
+                'VF', 'PGA', [0.1, 0.2, 0.4, 0.6], [0.05, 0.08, 0.2, 0.4],
+                covs, dist)
+            loss_ratios, lrem = vf.loss_ratio_exceedance_matrix(3)
+            expected = [[vf.distribution.survival(lr, mean, stddev)
+                         for mean, stddev in zip(vf.mean_loss_ratios,
+                                                 vf.stddevs)]
+                        for lr in loss_ratios]
+            numpy.testing.assert_equal(lrem, expected)
+
+    def test_classical_curves(self):
+        hazard_imls = [0.01, 0.08, 0.17, 0.26, 0.36, 0.55, 0.7]
+        hazard_curves = [[0.99, 0.96, 0.89, 0.82, 0.7, 0.4, 0.01],
+                         [0.9, 0.8, 0.6, 0.5, 0.3, 0.1, 0.]]
+        vf = scientific.VulnerabilityFunction(
+            'VF', 'PGA', [0.1, 0.2, 0.4, 0.6], [0.05, 0.08, 0.2, 0.4],
+            [0.5, 0.3, 0.2, 0.1], "LN")
+        loss_ratios, poes = scientific.classical_curves(
+            vf, hazard_imls, hazard_curves, 2)
+        self.assertEqual(poes.shape, (2, len(loss_ratios)))
+        # compare with the curves computed one at the time
+        _, lrem = vf.loss_ratio_exceedance_matrix(2)
+        imls = numpy.clip(vf.mean_imls(), 0.01, 0.7)
+        for curve, hazard_curve in zip(poes, hazard_curves):
+            pos = scientific.pairwise_diff(
+                interp1d(hazard_imls, hazard_curve)(imls))
+            numpy.testing.assert_allclose(
+                curve, (lrem * pos).sum(axis=1), atol=1E-15)
@@ -334,3 +334,46 @@ class ProbabilisticEventBasedTestCase(unittest.TestCase):
 
         numpy.testing.assert_allclose([0.] * 11, losses)
         numpy.testing.assert_allclose([0.] * 11, poes, atol=1E-10)
+
+    def test_matrix(self):
+        # a matrix of losses gives the same curves as a loop on the rows
+        rng = numpy.random.RandomState(42)
+        loss_matrix = numpy.round(rng.lognormal(size=(10, 50)), 1)
+        curves = scientific.event_based(loss_matrix, 50, 50, 11)
+        self.assertEqual(curves.shape, (10, 2, 11))
+        for curve, loss_values in zip(curves, loss_matrix):
+            numpy.testing.assert_equal(
+                curve, scientific.event_based(loss_values, 50, 50, 11))
+
+
+class EventBasedCurvesTestCase(unittest.TestCase):
+    def test_same_as_event_based(self):
+        rng = numpy.random.RandomState(42)
+        ordinals = rng.randint(0, 10, 500)
+        losses = numpy.round(rng.lognormal(size=500), 1)
+        curves = scientific.event_based_curves(
+            ordinals, losses, 11, tses=50, time_span=50, curve_resolution=20)
+        for ordinal in range(10):
+            losses_poes = scientific.event_based(
+                losses[ordinals == ordinal], 50, 50, 20)
+            numpy.testing.assert_equal(
+                curves[ordinal]['losses'], losses_poes[0])
+            numpy.testing.assert_equal(
+                curves[ordinal]['poes'], losses_poes[1])
+            self.assertAlmostEqual(curves[ordinal]['avg'],
+                                   scientific.average_loss(losses_poes))
+        # the last asset has no losses
+        numpy.testing.assert_equal(curves[10]['losses'], numpy.zeros(20))
+        numpy.testing.assert_equal(curves[10]['poes'], numpy.zeros(20))
+        self.assertEqual(curves[10]['avg'], 0)
+
+    def test_counts_can_be_summed(self):
+        ordinals = numpy.array([0, 1, 0, 0, 1, 1])
+        losses = numpy.array([.1, .4, .3, .2, .2, .1])
+        max_losses = numpy.array([.3, .4])
+        counts = scientific.exceedance_counts(ordinals, losses, max_losses, 4)
+        counts1 = scientific.exceedance_counts(
+            ordinals[:3], losses[:3], max_losses, 4)
+        counts2 = scientific.exceedance_counts(
+            ordinals[3:], losses[3:], max_losses, 4)
+        numpy.testing.assert_equal(counts, counts1 + counts2)
@@ -3,7 +3,7 @@ import unittest
 import numpy
 from openquake.baselib.general import writetmp
 from openquake.commonlib import readinput, readers
-from openquake.risklib import riskinput
+from openquake.risklib import riskinput, scientific, workflows
 from openquake.commonlib.calculators import event_based
 from openquake.qa_tests_data.event_based_risk import case_2
 
@@ -85,17 +85,59 @@ a4,3,500000,1000,3000
 
         gsims_by_trt_id = rupcalc.rlzs_assoc.get_gsims_by_trt_id()
 
-        eps_dict = riskinput.make_eps_dict(
-            self.assets_by_site, len(ses_ruptures), oq.master_seed,
-            oq.asset_correlation)
+        assetcol = workflows.AssetCollection.from_assets(self.assets_by_site)
+        epsilon_provider = scientific.CounterEpsilonProvider(
+            oq.master_seed, oq.asset_correlation, len(ses_ruptures))
 
         [ri] = self.riskmodel.build_inputs_from_ruptures(
             self.sitecol, ses_ruptures, gsims_by_trt_id, oq.truncation_level,
-            correl_model, eps_dict, 1)
+            correl_model, epsilon_provider, 1)
 
-        assets, hazards, epsilons = ri.get_all(rlzs_assoc, self.assets_by_site)
-        self.assertEqual([a.id for a in assets],
-                         ['a0', 'a1', 'a2', 'a3', 'a4'])
-        self.assertEqual(set(a.taxonomy for a in assets),
-                         set(['RM', 'RC', 'W']))
+        assets, hazards, epsilons = ri.get_all(rlzs_assoc, assetcol)
+        self.assertEqual(list(assets.ids), ['a0', 'a1', 'a2', 'a3', 'a4'])
+        self.assertEqual(set(assets.taxonomies), set(['RM', 'RC', 'W']))
         self.assertEqual(map(len, epsilons), [20] * 5)
+        # the GMFs are stored once per site with assets (4 sites)
+        self.assertEqual(len(hazards), 5)
+        self.assertEqual(list(hazards.rows), [0, 1, 2, 2, 3])
+        for gmvs in hazards.gmvs.values():
+            self.assertEqual(gmvs.shape, (4, 20))
+
+        # the epsilons do not depend on the splitting of the ruptures
+        ri1, ri2 = ri.split(2)
+        _, _, eps1 = ri1.get_all(rlzs_assoc, assetcol)
+        _, _, eps2 = ri2.get_all(rlzs_assoc, assetcol)
+        numpy.testing.assert_equal(numpy.hstack([eps1, eps2]), epsilons)
+
+        # the epsilon store gives the same epsilons as the provider
+        store = scientific.EpsilonStore.build(
+            epsilon_provider, assetcol.ordinals, len(ses_ruptures),
+            assetcol.taxonomy_indices)
+        _, _, eps = ri.get_all(rlzs_assoc, assetcol, store)
+        numpy.testing.assert_equal(eps, epsilons)
+
+        # the epsilons of the numpy RNG, used by the QA tests
+        eps_dict = riskinput.make_eps_dict(
+            self.assets_by_site, len(ses_ruptures), oq.master_seed, 0)
+        store = scientific.EpsilonStore(
+            numpy.array([eps_dict[aid] for aid in assetcol.ids]))
+        _, _, eps = ri.get_all(rlzs_assoc, assetcol, store)
+        numpy.testing.assert_equal(
+            eps, [eps_dict[aid][ri.eids] for aid in assetcol.ids])
+
+
+class HazardMatricesTestCase(unittest.TestCase):
+    def test_get(self):
+        gmvs = {('gsim1', 'PGA'): numpy.array([[.1, .2], [.3, .4]]),
+                ('gsim2', 'PGA'): numpy.array([[.5, .6], [.7, .8]])}
+        hazards = riskinput.HazardMatrices(
+            gmvs, dict(gsim1=['rlz0', 'rlz1'], gsim2=['rlz2']),
+            numpy.array([1, 0, 1]))
+        dic = hazards.get('PGA')
+        self.assertEqual(sorted(dic), ['rlz0', 'rlz1', 'rlz2'])
+        numpy.testing.assert_equal(dic['rlz1'], [[.3, .4], [.1, .2], [.3, .4]])
+        numpy.testing.assert_equal(dic['rlz2'], [[.7, .8], [.5, .6], [.7, .8]])
+        sub = hazards[numpy.array([1, 2])]
+        self.assertEqual(len(sub), 2)
+        numpy.testing.assert_equal(
+            sub.get('PGA')['rlz0'], [[.1, .2], [.3, .4]])
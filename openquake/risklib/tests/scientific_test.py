@@ -305,6 +305,165 @@ class MeanLossTestCase(unittest.TestCase):
         aaae(mean3, mean)
 
 
+class ApplyToTestCase(unittest.TestCase):
+    # the vectorized apply_to must give the same results as _apply
+    # called on each asset, including the imls below the minimum iml
+    # (zero loss) and above the maximum iml (clipped)
+    imls = [0.1, 0.2, 0.3, 0.5, 0.7]
+    mlrs = [0.05, 0.1, 0.2, 0.4, 0.6]
+
+    def check(self, distribution, covs, epsilons_shape):
+        vf = scientific.VulnerabilityFunction(
+            'VF1', 'PGA', self.imls, self.mlrs, covs, distribution)
+        rng = numpy.random.RandomState(42)
+        gmvs = rng.uniform(0, 0.9, (30, 20))
+        gmvs[:, :5] = self.imls
+        epsilons = rng.normal(size=epsilons_shape)
+
+        vf.set_distribution(epsilons)
+        numpy.random.seed(1)
+        expected = utils.numpy_map(vf._apply, gmvs)
+        numpy.random.seed(1)
+        numpy.testing.assert_equal(vf.apply_to(gmvs, epsilons), expected)
+
+    def test_lognormal(self):
+        self.check('LN', [0.1, 0.2, 0.3, 0.1, 0.2], (30, 20))
+
+    def test_lognormal_one_epsilon_per_asset(self):
+        self.check('LN', [0.1, 0.2, 0.3, 0.1, 0.2], 30)
+
+    def test_beta(self):
+        self.check('BT', [0.1, 0.2, 0.3, 0.1, 0.2], (30, 20))
+
+    def test_degenerate(self):
+        self.check('LN', None, (30, 20))
+
+
+class LookupTableTestCase(unittest.TestCase):
+    imls = [0.1, 0.2, 0.3, 0.5, 0.7]
+    mlrs = [0.05, 0.1, 0.2, 0.4, 0.6]
+
+    def setUp(self):
+        self.vf = scientific.VulnerabilityFunction(
+            'VF1', 'PGA', self.imls, self.mlrs, [0.1, 0.2, 0.3, 0.1, 0.2])
+        rng = numpy.random.RandomState(42)
+        self.gmvs = rng.uniform(0, 0.9, (30, 20))
+        self.epsilons = rng.normal(size=(30, 20))
+
+    def test_error_bound(self):
+        vf = scientific.VulnerabilityFunction(
+            'VF1', 'PGA', self.imls, self.mlrs)
+        exact = vf.apply_to(self.gmvs, self.epsilons)
+        vf.set_table_resolution(101)
+        # the table step is 0.006 and the maximum slope is 1
+        aaae(vf.table_error_bound(), 0.003)
+        approx = vf.apply_to(self.gmvs, self.epsilons)
+        self.assertLessEqual(numpy.abs(approx - exact).max(),
+                             vf.table_error_bound())
+        # the imls below the minimum give zero losses also with the table
+        numpy.testing.assert_equal(approx[self.gmvs < 0.1], 0)
+
+    def test_lognormal(self):
+        exact = self.vf.apply_to(self.gmvs, self.epsilons)
+        self.vf.set_table_resolution(10001)
+        approx = self.vf.apply_to(self.gmvs, self.epsilons)
+        numpy.testing.assert_allclose(approx, exact, atol=1E-4)
+
+    def test_pickle(self):
+        self.vf.set_table_resolution(101)
+        vf = pickle.loads(pickle.dumps(self.vf))
+        self.assertEqual(vf.table_resolution, 101)
+        numpy.testing.assert_equal(
+            vf.apply_to(self.gmvs, self.epsilons),
+            self.vf.apply_to(self.gmvs, self.epsilons))
+
+    def test_invalid_resolution(self):
+        with self.assertRaises(ValueError):
+            self.vf.set_table_resolution(1)
+
+
+class EquicorrelatedSamplerTestCase(unittest.TestCase):
+    def test_blocks(self):
+        # two groups with different correlations
+        groups = ['RC~north', 'RC~north', 'W~south', 'W~south', 'RC~north']
+        sampler = scientific.EquicorrelatedSampler(groups, [0.8, 0.2])
+        corr = numpy.corrcoef(sampler.sample(20000, seed=42))
+        numpy.testing.assert_allclose(numpy.diag(corr), 1)
+        self.assertAlmostEqual(corr[0, 1], 0.8, places=1)
+        self.assertAlmostEqual(corr[0, 4], 0.8, places=1)
+        self.assertAlmostEqual(corr[2, 3], 0.2, places=1)
+        self.assertAlmostEqual(corr[0, 2], 0, places=1)
+
+    def test_no_correlation(self):
+        sampler = scientific.EquicorrelatedSampler([0, 0, 0], 0)
+        corr = numpy.corrcoef(sampler.sample(20000, seed=42))
+        self.assertAlmostEqual(corr[0, 1], 0, places=1)
+
+    def test_invalid_correlation(self):
+        with self.assertRaises(AssertionError):
+            scientific.EquicorrelatedSampler([0, 1], 1.5)
+
+
+class CounterEpsilonProviderTestCase(unittest.TestCase):
+    def test_standard_normal(self):
+        eps = scientific.counter_normals(42, range(1000), range(100))
+        self.assertLess(abs(eps.mean()), 0.01)
+        self.assertLess(abs(eps.std() - 1), 0.01)
+        # a different stream gives different numbers
+        other = scientific.counter_normals(42, range(1000), range(100), 1)
+        self.assertLess(abs(numpy.corrcoef(eps.ravel(), other.ravel())[0, 1]),
+                        0.01)
+
+    def test_independent_of_chunking(self):
+        ep = scientific.CounterEpsilonProvider(42, correlation=0.3)
+        groups = [0, 1, 1, 0, 1]
+        eps = ep.get(range(5), range(10), groups)
+        numpy.testing.assert_equal(
+            ep.get([3, 4], range(5, 10), groups[3:]), eps[3:, 5:])
+
+    def test_epsilon_sampling(self):
+        ep = scientific.CounterEpsilonProvider(42, num_samples=4)
+        eps = ep.get(range(3), range(8))
+        numpy.testing.assert_equal(eps[:, :4], eps[:, 4:])
+
+    def test_correlation(self):
+        ep = scientific.CounterEpsilonProvider(42, correlation=0.5)
+        eps = ep.get([0, 1, 2], range(20000), [0, 0, 1])
+        corr = numpy.corrcoef(eps)
+        self.assertAlmostEqual(corr[0, 1], 0.5, places=1)
+        self.assertAlmostEqual(corr[0, 2], 0, places=1)
+
+
+class EpsilonStoreTestCase(unittest.TestCase):
+    def test_same_as_provider(self):
+        ep = scientific.CounterEpsilonProvider(
+            42, correlation=0.3, num_samples=4)
+        groups = [0, 1, 1, 0, 1]
+        store = scientific.EpsilonStore.build(ep, range(5), 4, groups)
+        self.assertEqual(store.array.shape, (5, 4))
+        self.assertEqual(store.array.dtype, numpy.float64)
+        numpy.testing.assert_equal(
+            store.get([3, 4], range(2, 10)),
+            ep.get([3, 4], range(2, 10), groups[3:]))
+
+    def test_same_losses(self):
+        ep = scientific.CounterEpsilonProvider(
+            42, correlation=0.3, num_samples=4)
+        groups = [0, 1, 1, 0, 1]
+        store = scientific.EpsilonStore.build(ep, range(5), 4, groups)
+        vf = scientific.VulnerabilityFunction(
+            'VF1', 'PGA', [0.1, 0.2, 0.3, 0.5, 0.7],
+            [0.05, 0.1, 0.2, 0.4, 0.6], [0.1, 0.2, 0.3, 0.1, 0.2], 'LN')
+        gmvs = numpy.random.RandomState(42).uniform(0, 0.9, (5, 10))
+        losses = vf.apply_to(gmvs, ep.get(range(5), range(10), groups))
+        numpy.testing.assert_equal(
+            vf.apply_to(gmvs, store.get(range(5), range(10))), losses)
+
+    def test_not_ordinals(self):
+        ep = scientific.CounterEpsilonProvider(42)
+        with self.assertRaises(AssertionError):
+            scientific.EpsilonStore.build(ep, [1, 2], 4)
+
 class LogNormalDistributionTestCase(unittest.TestCase):
 
     def test_init(self):
@@ -340,7 +499,7 @@ class LogNormalDistributionTestCase(unittest.TestCase):
         samples = self.dist.sample(numpy.array([0., 0., .1, .1]),
                                    numpy.array([0., .1, 0., .1]),
                                    None)
-        numpy.testing.assert_allclose([0., 0., 0.1, 0.10228396], samples)
+        numpy.testing.assert_allclose([0., 0., 0.1, 0.09087967], samples)
 
 
 class VulnerabilityLossRatioStepsTestCase(unittest.TestCase):
@@ -561,6 +720,29 @@ class InsuredLossCurveTestCase(unittest.TestCase):
              [0, 0, 0, 0, 0, 0]],
             scientific.insured_loss_curve(curve, 0.1, 0.5))
 
+    def check_curves(self, deductibles, limits):
+        loss_ratios = numpy.linspace(0, 1, 11)
+        poes = numpy.array([numpy.linspace(1, 0, 11),
+                            numpy.linspace(0.5, 0, 11) ** 2,
+                            numpy.zeros(11)])
+        curves, averages = scientific.insured_loss_curves(
+            loss_ratios, poes, deductibles, limits)
+        for i, p in enumerate(poes):
+            expected = scientific.insured_loss_curve(
+                numpy.array([loss_ratios, p]), deductibles[i], limits[i])
+            numpy.testing.assert_allclose(curves[i], expected)
+            numpy.testing.assert_allclose(
+                averages[i], scientific.average_loss(expected))
+        return curves
+
+    def test_vectorized_curves(self):
+        curves = self.check_curves([0.2, 0.15, 0.1], [0.5, 0.5, 0.5])
+        self.assertEqual(curves.shape, (3, 2, 6))
+
+    def test_vectorized_curves_different_limits(self):
+        curves = self.check_curves([0.2, 0.15, 0.1], [0.5, 0.75, 1.])
+        self.assertEqual([curve.shape[1] for curve in curves], [6, 8, 11])
+
 
 class LossMapMatrixTest(unittest.TestCase):
     def setUp(self):
@@ -580,6 +762,96 @@ class LossMapMatrixTest(unittest.TestCase):
             [[4.5, 9], [5, 10]],
             scientific.loss_map_matrix([0.55, 0.5], self.curves))
 
+    def test_same_as_conditional_loss_ratio(self):
+        # curves with exact matches, duplicated poes and NaNs
+        losses = numpy.linspace(0, 10, 6)
+        curves = [(losses, [1, 0.8, 0.5, 0.5, 0.2, 0.1]),
+                  (losses * 2, [0.9, 0.9, 0.6, 0.4, 0.4, 0.4]),
+                  (losses, [numpy.nan] * 6),
+                  (losses, [numpy.nan, 0, 0, 0, 0, 0]),
+                  (losses, [0, 0, 0, 0, 0, 0])]
+        poes = [0, 0.05, 0.1, 0.4, 0.5, 0.65, 0.9, 1, 1.1]
+        expected = [[scientific.conditional_loss_ratio(lrs, pos, poe)
+                     for lrs, pos in curves] for poe in poes]
+        numpy.testing.assert_equal(
+            scientific.loss_map_matrix(poes, curves), expected)
+
+    def test_curves_of_different_lengths(self):
+        curves = [(numpy.linspace(0, 10, 11), numpy.linspace(1, 0, 11)),
+                  (numpy.linspace(0, 10, 6), numpy.linspace(1, 0, 6))]
+        numpy.testing.assert_allclose(
+            [[3.5, 3.5]], scientific.loss_map_matrix([0.65], curves))
+
+
+class StreamingStatsTestCase(unittest.TestCase):
+    R, shape = 50, (7, 3)
+
+    def setUp(self):
+        rng = numpy.random.RandomState(42)
+        self.curves = rng.uniform(size=(self.R,) + self.shape)
+        self.weights = rng.uniform(size=self.R)
+        self.weights /= self.weights.sum()
+
+    def feed(self, stats):
+        for rlzi, curves in enumerate(self.curves):
+            stats.add(rlzi, curves)
+        return stats
+
+    def test_buffer(self):
+        stats = self.feed(scientific.StreamingStats(
+            self.R, self.shape, [0.15, 0.85], self.weights))
+        flat = self.curves.reshape(self.R, -1)
+        mean = scientific.mean_curve(flat, list(self.weights))
+        numpy.testing.assert_allclose(stats.mean, mean.reshape(self.shape))
+        for q in stats.quantiles:
+            numpy.testing.assert_equal(
+                stats.get_quantile(q), scientific.quantile_curve(
+                    flat, q, self.weights).reshape(self.shape))
+
+    def test_sketch(self):
+        bins = 100
+        stats = self.feed(scientific.StreamingStats(
+            self.R, self.shape, [0.15, 0.85], sketch_bins=bins))
+        self.assertIsNone(stats.buffer)
+        numpy.testing.assert_allclose(stats.mean, self.curves.mean(axis=0))
+        for q in stats.quantiles:
+            # quantile of the empirical distribution with equal weights
+            idx = int(numpy.ceil(q * self.R)) - 1
+            expected = numpy.sort(self.curves, axis=0)[idx]
+            numpy.testing.assert_allclose(
+                stats.get_quantile(q), expected, atol=1. / (2 * bins))
+
+    def test_buffer_on_disk(self):
+        # a buffer bigger than max_buffer_size is a memory-mapped file
+        stats = self.feed(scientific.StreamingStats(
+            self.R, self.shape, [0.15, 0.85], self.weights,
+            max_buffer_size=1000))
+        self.assertIsInstance(stats.buffer, numpy.memmap)
+        flat = self.curves.reshape(self.R, -1)
+        for q in stats.quantiles:
+            numpy.testing.assert_allclose(
+                stats.get_quantile(q), scientific.quantile_curve(
+                    flat, q, self.weights).reshape(self.shape))
+
+    def test_sketch_range(self):
+        # losses are not in the range [0, 1]
+        losses = self.curves * 1000
+        stats = scientific.StreamingStats(
+            self.R, self.shape, [0.5], sketch_bins=10)
+        with self.assertRaises(ValueError):
+            stats.add(0, losses[0])
+        bins = 100
+        stats = scientific.StreamingStats(
+            self.R, self.shape, [0.15, 0.85], sketch_bins=bins,
+            sketch_range=(0, 1000))
+        for rlzi, curves in enumerate(losses):
+            stats.add(rlzi, curves)
+        for q in stats.quantiles:
+            idx = int(numpy.ceil(q * self.R)) - 1
+            expected = numpy.sort(losses, axis=0)[idx]
+            numpy.testing.assert_allclose(
+                stats.get_quantile(q), expected, atol=1000. / (2 * bins))
+
 
 class ClassicalDamageTestCase(unittest.TestCase):
     def test_discrete(self):
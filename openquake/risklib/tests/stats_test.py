@@ -148,6 +148,22 @@ class QuantileCurveTestCase(unittest.TestCase):
 
         numpy.testing.assert_allclose(expected_curve, actual_curve)
 
+    def test_weighted_quantile_same_as_interp(self):
+        # the vectorized kernel gives the same results of numpy.interp
+        # applied to each point, also with ties, NaNs and zero weights
+        rng = numpy.random.RandomState(42)
+        curves = rng.choice([0, 0.1, 0.2, 0.5, 1, numpy.nan], size=(6, 200))
+        weights = numpy.array([0, 0.1, 0.2, 0.3, 0.15, 0.25])
+        for quantile in [0, 0.05, 0.1, 0.3, 0.5, 0.85, 1]:
+            expected = []
+            for poes in curves.T:
+                idxs = numpy.argsort(poes)
+                expected.append(numpy.interp(
+                    quantile, numpy.cumsum(weights[idxs]), poes[idxs]))
+            numpy.testing.assert_equal(
+                scientific.quantile_curve(curves, quantile, weights),
+                expected)
+
 
 class NormalizeTestCase(unittest.TestCase):
 
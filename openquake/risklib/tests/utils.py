@@ -17,8 +17,18 @@
 
 import os
 import csv
+import time
+import logging
+import unittest
 import collections
 
+#: decorator for the slow benchmarks, which run only if OQ_BENCHMARK is set
+benchmark = unittest.skipUnless(
+    os.environ.get('OQ_BENCHMARK'), 'set OQ_BENCHMARK=1 to run it')
+
+if os.environ.get('OQ_BENCHMARK'):  # show the timings of the benchmarks
+    logging.basicConfig(level=logging.INFO)
+
 
 def new(tuple_type, **kwargs):
     '''Instantiate a namedtuple class with missing fields defaulting to None
@@ -40,3 +50,40 @@ def vectors_from_csv(name, dirname):
         ntclass = collections.namedtuple(name, fields)
         columns = zip(*[map(float, row) for row in reader])
     return ntclass(*columns)
+
+
+def timeit(func, *args, **kw):
+    """
+    Call the given function and return the result and the time spent.
+    """
+    t0 = time.time()
+    res = func(*args, **kw)
+    return res, time.time() - t0
+
+
+def log_speedup(name, old_time, new_time):
+    """
+    Log the timings of the old and the new implementation.
+    """
+    logging.info('%s: %.3fs -> %.3fs (speedup %.1fx)', name, old_time,
+                 new_time, old_time / max(new_time, 1E-9))
+
+
+@benchmark
+class BenchmarkTestCase(unittest.TestCase):
+    """
+    Base class for the benchmarks comparing a new implementation with
+    the old one.
+    """
+    def compare(self, name, old_func, new_func):
+        """
+        Call the old and the new function, log their timings and check
+        that the new function is faster.
+
+        :returns: the results of the old and the new function
+        """
+        old, old_time = timeit(old_func)
+        new, new_time = timeit(new_func)
+        log_speedup(name, old_time, new_time)
+        self.assertLess(new_time, old_time)
+        return old, new
@@ -22,7 +22,7 @@ import mock
 
 import numpy
 
-from openquake.risklib import workflows
+from openquake.risklib import scientific, workflows
 
 aaae = numpy.testing.assert_array_almost_equal
 
@@ -81,3 +81,91 @@ class DamageTest(unittest.TestCase):
                 'PGA', 'TAXO', dict(damage=fragility_functions))
             calc('damage', 'assets', 'hazard', None)
             self.assertEqual(m.call_count, 6)  # called 3 x 2 times
+
+
+class ProbabilisticEventBasedTestCase(unittest.TestCase):
+    def test_counts_matrix(self):
+        vf = scientific.VulnerabilityFunction(
+            'VF', 'PGA', [0.1, 0.2, 0.3], [0.05, 0.1, 0.2], [0, 0, 0])
+        workflow = workflows.ProbabilisticEventBased(
+            'PGA', 'RC', dict(structural=vf), 50, 50, 0, 1, 11, [],
+            loss_curves_from_counts=True)
+        assets = workflows.AssetCollection.from_assets(
+            [[asset(dict(structural=10))] * 2])
+        gmvs = numpy.array([[0.1, 0.25, 0.3], [0.15, 0.2, 0.]])
+        out = workflow('structural', assets, gmvs, numpy.zeros((2, 3)),
+                       numpy.arange(3))
+        loss_ratios = vf.apply_to(gmvs, numpy.zeros((2, 3)))
+        numpy.testing.assert_equal(
+            out.counts_matrix,
+            scientific.CurveBuilder(11).build_counts(loss_ratios))
+        self.assertIsNone(out.insured_counts_matrix)
+        aaae(out.event_loss_per_asset, loss_ratios.T * 10)
+
+class AssetCollectionTestCase(unittest.TestCase):
+    def setUp(self):
+        a0 = workflows.Asset(
+            'a0', 'RC', 2, (0, 0), dict(structural=10, fatalities=3),
+            area=5, deductibles=dict(structural=0.1),
+            insurance_limits=dict(structural=0.8))
+        a1 = workflows.Asset(
+            'a1', 'W', 3, (0, 0), dict(structural=20, fatalities=2),
+            aggregated=dict(structural=True))
+        a2 = workflows.Asset(
+            'a2', 'RC', 1, (1, 1), dict(structural=None, fatalities=1))
+        self.assets_by_site = [[a1, a0], [], [a2]]
+        self.assets = [a0, a1, a2]
+        self.assetcol = workflows.AssetCollection.from_assets(
+            self.assets_by_site)
+
+    def test_columns(self):
+        col = self.assetcol
+        self.assertEqual(list(col.ids), ['a0', 'a1', 'a2'])
+        self.assertEqual(list(col.ordinals), [0, 1, 2])
+        self.assertEqual(list(col.site_ids), [0, 0, 2])
+        self.assertEqual(col.taxonomies, ['RC', 'W'])
+        self.assertEqual(list(col.taxonomy_indices), [0, 1, 0])
+        numpy.testing.assert_equal(col.deductible('structural'),
+                                   [0.1, numpy.nan, numpy.nan])
+
+    def test_long_ids(self):
+        long_id = 'building_%s' % ('x' * 50)
+        a = workflows.Asset(long_id, 'RC', 1, (0, 0), dict(structural=10))
+        col = workflows.AssetCollection.from_assets(
+            self.assets_by_site + [[a]])
+        self.assertEqual(list(col.ids), ['a0', 'a1', 'a2', long_id])
+
+    def test_same_as_assets(self):
+        for loss_type in ('structural', 'fatalities'):
+            numpy.testing.assert_equal(
+                workflows.get_column('value', loss_type, self.assetcol),
+                workflows.get_column('value', loss_type, self.assets))
+        numpy.testing.assert_equal(
+            workflows.get_values('fatalities', self.assetcol),
+            workflows.get_values('fatalities', self.assets))
+
+    def test_indices(self):
+        by_site = self.assetcol.indices_by_site(3)
+        self.assertEqual(map(list, by_site), [[0, 1], [], [2]])
+        by_taxo = self.assetcol.indices_by_taxonomy()
+        self.assertEqual(list(by_taxo['RC']), [0, 2])
+        self.assertEqual(list(by_taxo['W']), [1])
+        sub = self.assetcol[by_taxo['RC']]
+        self.assertEqual(list(sub.ids), ['a0', 'a2'])
+        self.assertEqual(list(sub.ordinals), [0, 2])
+        self.assertEqual(sub.taxonomies, ['RC', 'W'])
+
+    def test_gen_out_by_rlz_matrices(self):
+        # the hazards can be given as matrices assets x events per rlz;
+        # the asset a2 has no structural value and must be discarded
+        class FakeWorkflow(workflows.Workflow):
+            def __call__(self, loss_type, assets, hazards, epsilons, eids):
+                return mock.Mock(assets=assets, hazards=hazards)
+        workflow = FakeWorkflow('PGA', 'RC', dict(structural=None))
+        rlz = mock.Mock(ordinal=0, weight=1.)
+        gmvs = numpy.array([[.1, .2], [.3, .4], [.5, .6]])
+        [[out]] = workflow.gen_out_by_rlz(
+            self.assetcol, {rlz: gmvs}, numpy.zeros((3, 2)), [0, 1])
+        self.assertEqual(list(out.assets.ids), ['a0', 'a1'])
+        aaae(out.hazards, [[.1, .2], [.3, .4]])
+        self.assertEqual(out.hid, 0)
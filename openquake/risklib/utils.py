@@ -66,3 +66,27 @@ def compose(*a):
 
 
 numpy_map = compose(numpy.array, map)
+
+
+def sorted_slices(keys):
+    """
+    Sort a sequence of keys with a stable sort and find the contiguous
+    slice occupied by each key in the sorted sequence.
+
+    >>> order, slices = sorted_slices(['b', 'a', 'b', 'c'])
+    >>> order
+    array([1, 0, 2, 3])
+    >>> sorted(slices)
+    ['a', 'b', 'c']
+    >>> slices['b']
+    slice(1, 3, None)
+
+    :param keys: a sequence of N sortable keys
+    :returns: a pair (order, {key: slice}) where order is an array of indices
+    """
+    keys = numpy.asarray(keys)
+    order = numpy.argsort(keys, kind='mergesort')
+    uniq, starts = numpy.unique(keys[order], return_index=True)
+    stops = numpy.append(starts[1:], len(keys))
+    return order, {key: slice(start, stop)
+                   for key, start, stop in zip(uniq, starts, stops)}
@@ -17,6 +17,7 @@
 # <http://www.gnu.org/licenses/>.
 
 import inspect
+import operator
 import functools
 import collections
 import numpy
@@ -50,7 +51,8 @@ class Asset(object):
                  deductibles=None,
                  insurance_limits=None,
                  retrofitting_values=None,
-                 aggregated=None):
+                 aggregated=None,
+                 ordinal=None):
         """
         :param asset_id:
             an unique identifier of the assets within the given exposure
@@ -72,6 +74,9 @@ class Asset(object):
             asset retrofitting values keyed by loss types
         :param dict aggregated:
             if the cost is aggregated, do not multiply by the number
+        :param int ordinal:
+            the position of the asset in the exposure sorted by asset_id
+            (if known)
         """
         self.id = asset_id
         self.taxonomy = taxonomy
@@ -83,6 +88,7 @@ class Asset(object):
         self.deductibles = deductibles
         self.insurance_limits = insurance_limits
         self.aggregated = aggregated or {}
+        self.ordinal = ordinal
 
     def value(self, loss_type):
         """
@@ -118,11 +124,189 @@ class Asset(object):
         return self.id
 
 
+class AssetCollection(object):
+    """
+    A columnar container of assets, sorted by asset ID, so that the
+    index of an asset in the full collection is its ordinal. The
+    columns are stored in a composite array with fields
+
+    - asset_ref, ordinal, site_id, taxonomy (an index in `.taxonomies`),
+      number, area
+    - value~<loss_type>, the value per unit (NaN if missing)
+    - aggregated~<loss_type>, 1 if the value must not be multiplied by
+      the number of units
+    - deductible~<loss_type>, insurance_limit~<loss_type> and
+      retrofitted~<loss_type> (NaN if missing)
+
+    The methods `.value`, `.deductible`, `.insurance_limit` and
+    `.retrofitted` mirror the ones of :class:`Asset`, but return an
+    array with an element per asset. Indexing a collection with
+    a slice, a boolean mask or an array of indices returns a
+    sub-collection.
+
+    :param array: a composite array as described above
+    :param taxonomies: the sorted list of the taxonomies of the exposure
+    """
+    def __init__(self, array, taxonomies):
+        self.array = array
+        self.taxonomies = taxonomies
+
+    @classmethod
+    def from_assets(cls, assets_by_site):
+        """
+        :param assets_by_site: a list of lists of :class:`Asset` instances
+        :returns: an AssetCollection
+        """
+        assets = sorted((a for assets in assets_by_site for a in assets),
+                        key=operator.attrgetter('id'))
+        site_ids = {}
+        for sid, assets_ in enumerate(assets_by_site):
+            for asset in assets_:
+                site_ids[asset.id] = sid
+        taxonomies = sorted(set(a.taxonomy for a in assets))
+        loss_types, names = set(), set()
+        for asset in assets:
+            loss_types.update(asset.values)
+            for name, dic in [('deductible', asset.deductibles),
+                              ('insurance_limit', asset.insurance_limits),
+                              ('retrofitted', asset.retrofitting_values)]:
+                names.update('%s~%s' % (name, lt) for lt in dic or ())
+        fields = ['value~%s' % lt for lt in sorted(loss_types)] + sorted(
+            names)
+        # the asset_ref field is large enough to contain the longest ID
+        id_len = max([1] + [len(asset.id) for asset in assets])
+        dtype = numpy.dtype(
+            [('asset_ref', (str, id_len)), ('ordinal', numpy.uint32),
+             ('site_id', numpy.uint32), ('taxonomy', numpy.uint32),
+             ('number', float), ('area', float)] +
+            [('aggregated~%s' % lt, numpy.uint8) for lt in sorted(loss_types)]
+            + [(field, float) for field in fields])
+        array = numpy.zeros(len(assets), dtype)
+        for field in fields:
+            array[field] = numpy.nan
+        taxonomy_idx = {taxo: i for i, taxo in enumerate(taxonomies)}
+        dicts = dict(value='values', deductible='deductibles',
+                     insurance_limit='insurance_limits',
+                     retrofitted='retrofitting_values')
+        for ordinal, asset in enumerate(assets):
+            rec = array[ordinal]
+            rec['asset_ref'] = asset.id
+            rec['ordinal'] = ordinal
+            rec['site_id'] = site_ids[asset.id]
+            rec['taxonomy'] = taxonomy_idx[asset.taxonomy]
+            rec['number'] = asset.number
+            rec['area'] = asset.area
+            for lt in asset.aggregated:
+                if asset.aggregated[lt] and lt in loss_types:
+                    rec['aggregated~%s' % lt] = 1
+            for field in fields:
+                name, lt = field.split('~')
+                dic = getattr(asset, dicts[name]) or {}
+                value = dic.get(lt)
+                if value is not None:
+                    rec[field] = value
+        return cls(array, taxonomies)
+
+    @property
+    def ids(self):
+        """The asset IDs, as an array of strings"""
+        return self.array['asset_ref']
+
+    @property
+    def ordinals(self):
+        """The positions of the assets in the full collection"""
+        return self.array['ordinal']
+
+    @property
+    def site_ids(self):
+        """The indices of the sites of the assets"""
+        return self.array['site_id']
+
+    @property
+    def taxonomy_indices(self):
+        """The indices of the taxonomies of the assets in `.taxonomies`"""
+        return self.array['taxonomy']
+
+    @property
+    def number(self):
+        """The number of units of each asset"""
+        return self.array['number']
+
+    def value(self, loss_type):
+        """
+        :returns: the total asset values for `loss_type`
+        """
+        number = numpy.where(
+            self.array['aggregated~' + loss_type], 1, self.array['number'])
+        return self.array['value~' + loss_type] * number * self.array['area']
+
+    def deductible(self, loss_type):
+        """
+        :returns: the deductibles of the assets for `loss_type`
+        """
+        return self.array['deductible~' + loss_type]
+
+    def insurance_limit(self, loss_type):
+        """
+        :returns: the insurance limits of the assets for `loss_type`
+        """
+        return self.array['insurance_limit~' + loss_type]
+
+    def retrofitted(self, loss_type):
+        """
+        :returns: the retrofitted values of the assets for `loss_type`
+        """
+        return self.array['retrofitted~' + loss_type]
+
+    def indices_by_site(self, num_sites):
+        """
+        :param num_sites: the total number of sites
+        :returns: a list with an array of asset indices for each site
+        """
+        idxs = numpy.argsort(self.site_ids, kind='mergesort')
+        stops = numpy.searchsorted(
+            self.site_ids[idxs], numpy.arange(1, num_sites + 1))
+        return numpy.split(idxs, stops[:-1])
+
+    def indices_by_taxonomy(self):
+        """
+        :returns: a dictionary taxonomy -> array of asset indices
+        """
+        order, slices = utils.sorted_slices(self.taxonomy_indices)
+        return {self.taxonomies[t]: order[slc] for t, slc in slices.items()}
+
+    def __getitem__(self, indices):
+        return self.__class__(self.array[indices], self.taxonomies)
+
+    def __len__(self):
+        return len(self.array)
+
+    def __repr__(self):
+        return '<%s with %d asset(s)>' % (self.__class__.__name__, len(self))
+
+
+def get_column(method, loss_type, assets):
+    """
+    :param method: 'value', 'deductible', 'insurance_limit' or 'retrofitted'
+    :param loss_type: a loss type
+    :param assets: a list of :class:`Asset` objects or an AssetCollection
+    :returns: an array with the result of the method for each asset
+    """
+    if isinstance(assets, AssetCollection):
+        return getattr(assets, method)(loss_type)
+    return numpy.array([getattr(a, method)(loss_type) for a in assets])
+
+
 def get_values(loss_type, assets):
     """
     A numpy array with the values for the given assets, depending on the
     loss_type.
     """
+    if isinstance(assets, AssetCollection):
+        # the collections are used only in oq-lite, see below
+        if loss_type == 'fatalities':
+            return assets.array['value~fatalities']
+        return assets.value(loss_type)
     if loss_type == 'fatalities' and hasattr(assets[0], 'values'):
         # this is called only in oq-lite, return naked value
         values = numpy.array([a.values['fatalities'] for a in assets])
@@ -131,20 +315,29 @@ def get_values(loss_type, assets):
     return values
 
 
-def out_by_rlz(workflow, assets, hazards, epsilons, tags, loss_type):
+def out_by_rlz(workflow, assets, hazards, epsilons, eids, loss_type):
     """
     :param workflow: a Workflow instance
     :param assets: an array of assets of homogeneous taxonomy
-    :param hazards: an array of dictionaries per each asset
+    :param hazards:
+        an array of dictionaries per each asset or a dictionary
+        rlz -> array assets x ruptures
     :param epsilons: an array of epsilons per each asset
-    :param tags: rupture tags
+    :param eids: rupture ordinals (or None)
 
     Yield lists out_by_rlz
     """
     out_by_rlz = []
-    for rlz in hazards[0]:  # extract the realizations from the first asset
-        hazs = [haz[rlz] for haz in hazards]  # hazard per each asset
-        out = workflow(loss_type, assets, hazs, epsilons, tags)
+    if isinstance(hazards, dict):
+        rlzs = list(hazards)
+    else:  # extract the realizations from the first asset
+        rlzs = list(hazards[0])
+    for rlz in rlzs:
+        if isinstance(hazards, dict):
+            hazs = hazards[rlz]  # matrix assets x ruptures
+        else:
+            hazs = [haz[rlz] for haz in hazards]  # hazard per each asset
+        out = workflow(loss_type, assets, hazs, epsilons, eids)
         out.hid = rlz.ordinal
         out.weight = rlz.weight
         out_by_rlz.append(out)
@@ -168,19 +361,21 @@ class Workflow(object):
         """
         return sorted(self.risk_functions)
 
-    def gen_out_by_rlz(self, assets, hazards, epsilons, tags):
+    def gen_out_by_rlz(self, assets, hazards, epsilons, eids):
         """
         :param assets: an array of assets of homogeneous taxonomy
-        :param hazards: an array of dictionaries per each asset
+        :param hazards:
+            an array of dictionaries per each asset or a dictionary
+            rlz -> array assets x ruptures
         :param epsilons: an array of epsilons per each asset
-        :param tags: rupture tags
+        :param eids: rupture ordinals (or None)
 
         Yield lists out_by_rlz.
         """
         for loss_type in self.loss_types:
             assets_ = assets
+            hazards_ = hazards
             epsilons_ = epsilons
-            tags_ = tags
 
             values = get_values(loss_type, assets)
             ok = ~numpy.isnan(values)
@@ -191,11 +386,13 @@ class Workflow(object):
             missing_value = not ok.all()
             if missing_value:
                 assets_ = assets[ok]
-                hazards = hazards[ok]
+                if isinstance(hazards, dict):
+                    hazards_ = {rlz: hazards[rlz][ok] for rlz in hazards}
+                else:
+                    hazards_ = hazards[ok]
                 epsilons_ = epsilons[ok]
-                tags_ = tags[ok]
             yield out_by_rlz(
-                self, assets_, hazards, epsilons_, tags_, loss_type)
+                self, assets_, hazards_, epsilons_, eids, loss_type)
 
     def __repr__(self):
         return '<%s%s>' % (self.__class__.__name__, self.risk_functions.keys())
@@ -285,12 +482,8 @@ class Classical(Workflow):
         self.imt = imt
         self.taxonomy = taxonomy
         self.risk_functions = vulnerability_functions
-        imls = hazard_imtls[self.imt]
-        self.curves = dict(
-            (loss_type,
-             functools.partial(scientific.classical, vf, imls,
-                               steps=lrem_steps_per_interval))
-            for loss_type, vf in vulnerability_functions.items())
+        self.hazard_imls = hazard_imtls[self.imt]
+        self.lrem_steps_per_interval = lrem_steps_per_interval
         self.conditional_loss_poes = conditional_loss_poes
         self.poes_disagg = poes_disagg
         self.insured_losses = insured_losses
@@ -310,19 +503,25 @@ class Classical(Workflow):
         :returns:
             a :class:`openquake.risklib.scientific.Classical.Output` instance.
         """
-        curves = utils.numpy_map(self.curves[loss_type], hazard_curves)
-        average_losses = utils.numpy_map(scientific.average_loss, curves)
+        # all the curves have the same loss ratios, so they are
+        # computed at once, as well as the average losses
+        loss_ratios, poes = scientific.classical_curves(
+            self.risk_functions[loss_type], self.hazard_imls,
+            numpy.array(list(hazard_curves)), self.lrem_steps_per_interval)
+        curves = numpy.empty((len(poes), 2, len(loss_ratios)))
+        curves[:, 0] = loss_ratios
+        curves[:, 1] = poes
+        average_losses = scientific.average_loss((loss_ratios, poes))
         maps = scientific.loss_map_matrix(self.conditional_loss_poes, curves)
         fractions = scientific.loss_map_matrix(self.poes_disagg, curves)
 
         if self.insured_losses and loss_type != 'fatalities':
-            deductibles = [a.deductible(loss_type) for a in assets]
-            limits = [a.insurance_limit(loss_type) for a in assets]
+            deductibles = get_column('deductible', loss_type, assets)
+            limits = get_column('insurance_limit', loss_type, assets)
 
-            insured_curves = utils.numpy_map(
-                scientific.insured_loss_curve, curves, deductibles, limits)
-            average_insured_losses = utils.numpy_map(
-                scientific.average_loss, insured_curves)
+            insured_curves, average_insured_losses = (
+                scientific.insured_loss_curves(
+                    loss_ratios, poes, deductibles, limits))
         else:
             insured_curves = None
             average_insured_losses = None
@@ -419,10 +618,13 @@ class ProbabilisticEventBased(Workflow):
             ses_per_logic_tree_path,
             loss_curve_resolution,
             conditional_loss_poes,
-            insured_losses=False):
+            insured_losses=False,
+            loss_curves_from_counts=False):
         """
         See :func:`openquake.risklib.scientific.event_based` for a description
-        of the input parameters.
+        of the input parameters. If `loss_curves_from_counts` is set, in
+        oq-lite the outputs contain the exceedance counts of the loss
+        ratios on a fixed grid, so that they can be merged by addition.
         """
         tses = ((hazard_investigation_time or risk_investigation_time) *
                 ses_per_logic_tree_path * (number_of_logic_tree_samples or 1))
@@ -436,6 +638,8 @@ class ProbabilisticEventBased(Workflow):
         self.conditional_loss_poes = conditional_loss_poes
         self.insured_losses = insured_losses
         self.return_loss_matrix = True
+        self.loss_curves_from_counts = loss_curves_from_counts
+        self.curve_builder = scientific.CurveBuilder(loss_curve_resolution)
 
     def event_loss(self, loss_matrix, event_ids):
         """
@@ -478,34 +682,42 @@ class ProbabilisticEventBased(Workflow):
         """
         loss_matrix = self.risk_functions[loss_type].apply_to(
             ground_motion_values, epsilons)
-        values = utils.numpy_map(lambda a: a.value(loss_type), assets)
+        values = get_column('value', loss_type, assets)
         ela = loss_matrix.T * values  # matrix with R x N elements
         if self.insured_losses and loss_type != 'fatalities':
-            deductibles = [a.deductible(loss_type) for a in assets]
-            limits = [a.insurance_limit(loss_type) for a in assets]
+            deductibles = get_column('deductible', loss_type, assets)
+            limits = get_column('insurance_limit', loss_type, assets)
             ila = utils.numpy_map(
                 scientific.insured_losses, loss_matrix, deductibles, limits)
-        else:  # build a zero matrix of size R x N
-            ila = numpy.zeros((len(ground_motion_values[0]), len(assets)))
-        if isinstance(assets[0].id, basestring):
+        else:  # build a zero matrix of size N x R
+            ila = numpy.zeros(loss_matrix.shape)
+        if (isinstance(assets, AssetCollection) or
+                isinstance(assets[0].id, basestring)):
             # in oq-lite return early, with just the losses per asset
-            cb = scientific.CurveBuilder(self.loss_curve_resolution)
+            # and possibly the exceedance counts of the loss ratios
+            counts_matrix = insured_counts_matrix = None
+            if self.loss_curves_from_counts:
+                build_counts = self.curve_builder.build_counts
+                counts_matrix = build_counts(loss_matrix)
+                if self.insured_losses and loss_type != 'fatalities':
+                    insured_counts_matrix = build_counts(ila)
             return scientific.Output(
                 assets, loss_type,
                 event_loss_per_asset=ela,
-                insured_loss_per_asset=ila,
-                counts_matrix=cb.build_counts(loss_matrix),
-                tags=event_ids)
+                insured_loss_per_asset=ila.T * values,  # R x N
+                counts_matrix=counts_matrix,  # N x C
+                insured_counts_matrix=insured_counts_matrix,  # N x C
+                eids=event_ids)
 
         # in the engine, compute more stuff on the workers
-        curves = utils.numpy_map(self.curves, loss_matrix)
+        curves = self.curves(loss_matrix)
         average_losses = utils.numpy_map(scientific.average_loss, curves)
         stddev_losses = numpy.std(loss_matrix, axis=1)
         maps = scientific.loss_map_matrix(self.conditional_loss_poes, curves)
         elt = self.event_loss(ela, event_ids)
 
         if self.insured_losses and loss_type != 'fatalities':
-            insured_curves = utils.numpy_map(self.curves, ila)
+            insured_curves = self.curves(ila)
             average_insured_losses = utils.numpy_map(
                 scientific.average_loss, insured_curves)
             stddev_insured_losses = numpy.std(ila, axis=1)
@@ -598,12 +810,14 @@ class ClassicalBCR(Workflow):
         eal_retrofitted = utils.numpy_map(
             scientific.average_loss, retrofitted_loss_curves)
 
+        values = get_column('value', loss_type, assets)
+        retrofitted = get_column('retrofitted', loss_type, assets)
         bcr_results = [
             scientific.bcr(
                 eal_original[i], eal_retrofitted[i],
                 self.interest_rate, self.asset_life_expectancy,
-                asset.value(loss_type), asset.retrofitted(loss_type))
-            for i, asset in enumerate(assets)]
+                values[i], retrofitted[i])
+            for i in range(len(assets))]
 
         return scientific.Output(
             assets, loss_type,
@@ -641,22 +855,24 @@ class ProbabilisticEventBasedBCR(Workflow):
     def __call__(self, loss_type, assets, gmfs, epsilons, event_ids):
         self.assets = assets
 
-        original_loss_curves = utils.numpy_map(
-            self.curves, self.vf_orig[loss_type].apply_to(gmfs, epsilons))
-        retrofitted_loss_curves = utils.numpy_map(
-            self.curves, self.vf_retro[loss_type].apply_to(gmfs, epsilons))
+        original_loss_curves = self.curves(
+            self.vf_orig[loss_type].apply_to(gmfs, epsilons))
+        retrofitted_loss_curves = self.curves(
+            self.vf_retro[loss_type].apply_to(gmfs, epsilons))
 
         eal_original = utils.numpy_map(
             scientific.average_loss, original_loss_curves)
         eal_retrofitted = utils.numpy_map(
             scientific.average_loss, retrofitted_loss_curves)
 
+        values = get_column('value', loss_type, assets)
+        retrofitted = get_column('retrofitted', loss_type, assets)
         bcr_results = [
             scientific.bcr(
                 eal_original[i], eal_retrofitted[i],
                 self.interest_rate, self.asset_life_expectancy,
-                asset.value(loss_type), asset.retrofitted(loss_type))
-            for i, asset in enumerate(assets)]
+                values[i], retrofitted[i])
+            for i in range(len(assets))]
 
         return scientific.Output(
             assets, loss_type,
@@ -688,8 +904,8 @@ class Scenario(Workflow):
         aggregate_losses = numpy.sum(
             loss_ratio_matrix.transpose() * values, axis=1)
         if self.insured_losses and loss_type != "fatalities":
-            deductibles = [a.deductible(loss_type) for a in assets]
-            limits = [a.insurance_limit(loss_type) for a in assets]
+            deductibles = get_column('deductible', loss_type, assets)
+            limits = get_column('insurance_limit', loss_type, assets)
             insured_loss_ratio_matrix = utils.numpy_map(
                 scientific.insured_losses,
                 loss_ratio_matrix, deductibles, limits)